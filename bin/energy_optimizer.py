@@ -3,7 +3,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import swiftmonitor.utils as smu
-from swiftmonitor import model_profile
+from swiftmonitor import model_profile, events
 from optparse import OptionParser
 
 parser = OptionParser("Usage: %prog [options] fitsfile",version="%prog 1.0")
@@ -52,21 +52,37 @@ parser.add_option("-l", "--list",
     dest="list", type='string',
     help="File with list of event files to get events from.",
     default=None)      
+parser.add_option("-t", "--table",
+    dest="table_fn", type='string',
+    help="Optimize Emin, Emax and the number of harmonics of each event file "
+         "(arguments or --list) separately, writing the best bands and their "
+         "trials-corrected false alarm probabilities to this file.",
+    default=None)
+parser.add_option("--max-harmonic",
+    dest="max_harmonic", type='int',
+    help="Largest number of harmonics searched with --table. Default is 20.",
+    default=20)
+parser.add_option("-j", "--nworkers",
+    dest="nworkers", type='int',
+    help="Number of processes optimizing files in parallel with --table. Default is 1.",
+    default=1)
  
 (options,args) = parser.parse_args()
 if options.emin ==None or options.emax == None:
     print('Must give Enegy bounds')
     raise SystemExit
+if options.table_fn:
+    EVTs = events.read_file_list(options.list) if options.list else args
+    bands = smu.optimize_bands(EVTs, options.parfile, options.emin, options.emax,
+                               nworkers=options.nworkers, steps=options.steps,
+                               scope=options.scope, max_harmonic=options.max_harmonic)
+    smu.write_band_table(bands, options.table_fn)
+    raise SystemExit
 if options.list:
-    EVTs = np.loadtxt(options.list, dtype='S')#.T[0]
-    phases = np.zeros(0)
-    Es = np.zeros(0)
-    for evt in EVTs:                     
-        phase, E = smu.fits2phase(evt,options.parfile, 
-                           scope=options.scope, Emin=options.emin, 
-                           Emax=options.emax, give_t_E=True)
-        phases=np.append(phases, phase)
-        Es=np.append(Es, E)                   
+    EVTs = events.read_file_list(options.list)
+    phases, Es = smu.fits2phase(smu.event_list(EVTs, scope=options.scope),
+                           options.parfile, scope=options.scope,
+                           Emin=options.emin, Emax=options.emax, give_t_E=True)
 
 else:                      
     phases, Es = smu.fits2phase(args[0],options.parfile, 
@@ -75,16 +91,16 @@ else:
 
 ECuts=np.linspace(options.emin, options.emax, options.steps)
 Cuts = smu.energy2chan(ECuts, scope=options.scope)
+
+# the H-test of every band Cuts[i] < E < Cuts[j] from prefix sums of moments
+bands = smu.BandMoments(phases, Es, Cuts)
 if options.twoD:
-    hs=np.zeros((options.steps, options.steps))
-    for i in range(0, options.steps):
-        for j in range(i, options.steps):
-           filt=np.where((Es>Cuts[i])*(Es<Cuts[j])) 
-           hs[i][j]=smu.h_test(phases[filt])[0]
+    i, j = np.meshgrid(np.arange(options.steps), np.arange(options.steps), indexing='ij')
+    hs = bands.h_test(i, j)[0]
     hsm=np.ma.masked_where(np.isnan(hs),hs)  
     plt.pcolor(ECuts, ECuts, hsm, cmap='Greens')
     maxhs=np.nanmax(hs)
-    bestEmin=ECuts[np.nanargmax(hs)/options.steps]
+    bestEmin=ECuts[np.nanargmax(hs)//options.steps]
     bestEmax=ECuts[np.nanargmax(hs)%options.steps]
     plt.text(0.01, 0.99, "Best $E_{min}$ = %.2f keV\nBest $E_{max}$ = %.2f keV\nBest h-score = %.2E" % (bestEmin,bestEmax, maxhs), 
              horizontalalignment="left", verticalalignment="top",
@@ -94,10 +110,7 @@ if options.twoD:
     plt.ylabel('$E_{min}$ (keV)')
          
 else:
-    hs = np.zeros((0))
-    for cut in Cuts:
-        filt=np.where(Es>cut)
-        hs=np.append(hs, smu.h_test(phases[filt])[0])    
+    hs = bands.h_test(np.arange(options.steps))[0]
     plt.plot(ECuts, hs, 'ko')
     plt.xlabel('E (keV)')
     plt.ylabel('h-score')
@@ -3,7 +3,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import swiftmonitor.utils as smu
-from swiftmonitor import model_profile
+from swiftmonitor import model_profile, events
 from optparse import OptionParser
 
 parser = OptionParser("Usage: %prog [options] fitsfile",version="%prog 1.0")
@@ -48,12 +48,10 @@ parser.add_option("-l", "--list",
 (options,args) = parser.parse_args()
 
 if options.list:
-    EVTs = np.loadtxt(options.list, dtype='S')#.T[0]
-    phases = np.zeros(0)
-    for evt in EVTs:                     
-        phases = np.append(phases,smu.fits2phase(evt,options.parfile, 
-                           scope=options.scope, Emin=options.emin, 
-                           Emax=options.emax))
+    EVTs = events.read_file_list(options.list)
+    phases = smu.fits2phase(smu.event_list(EVTs, scope=options.scope),
+                            options.parfile, scope=options.scope,
+                            Emin=options.emin, Emax=options.emax)
 
 else:                      
     phases = smu.fits2phase(args[0],options.parfile, scope=options.scope,
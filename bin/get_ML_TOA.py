@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 import numpy as np
-from swiftmonitor import ml_toa, model_profile
+from swiftmonitor import ml_toa, model_profile, events, periodogram
+from swiftmonitor.utils import TimWriter
 from optparse import OptionParser
 
 models = model_profile.list_models()
@@ -41,16 +42,36 @@ parser.add_option("--offsets",
 		  default=None)
 parser.add_option("--periodogram",
 		  dest="periodogram", type='string',
-		  help="Name of periodogram.py output file to use as input.",
+		  help="Name of periodogram.py output file to use as input: each file is timed with its epoch, frequency and fdot.",
 		  default=None)
 parser.add_option("--sim",
 		  dest="sim", action='store_true',
-		  help="Determine the error in the TOA using simulations.",
+		  help="Determine the error in the TOA using simulations, each measured with the " \
+                       + "likelihood of --method (direct is much slower than fft or harmonic).",
 		  default=False)
+parser.add_option("--Nsim",
+		  dest="nsim", type='int',
+		  help="Number of simulations used with --sim. Default is 1000.",
+		  default=1000)
+parser.add_option("--seed",
+		  dest="seed", type='int',
+		  help="Random seed for the --sim simulations.",
+		  default=None)
+parser.add_option("-j", "--jobs",
+		  dest="nworkers", type='int',
+		  help="Number of worker processes: the event files are measured in parallel, " \
+                       + "or with --periodogram, or --list with --split_days or --Nphotons, " \
+                       + "the --sim simulations of each TOA. Default is 1.",
+		  default=1)
 parser.add_option("--gauss-err",
 		  dest="gauss_err", action='store_true',
 		  help="Determine the error by fitting a gaussian.",
 		  default=False)
+parser.add_option("--curv-err",
+		  dest="curv_err", action='store_true',
+		  help="Find the offset with a coarse-to-fine search and determine the error " \
+                       + "from the curvature of the log-likelihood (not with --bright).",
+		  default=False)
 parser.add_option("--plot-dist",
 		  dest="plot_dist", action='store_true',
 		  help="Plot the offset probability distribution for debugging.",
@@ -92,16 +113,32 @@ parser.add_option("--bright",
 		  dest="bright", action='store_true',
 		  help="If true, bin profile to save CPU time.",
 		  default=False)		  
+parser.add_option("--method",
+		  dest="method", type='choice', choices=['direct','fft','harmonic'],
+		  help="Likelihood method: direct (every photon at each offset), fft " \
+                       + "(binned FFT cross-correlation, for large event lists) or harmonic " \
+                       + "(trigonometric moments, for smooth templates), also used by --sim. Default is direct.",
+		  default='direct')
+parser.add_option("--chunk-size",
+		  dest="chunk_size", type='int',
+		  help="Stream the events of each file this many at a time to bound memory " \
+                       + "use (not with the split, --correct-pf or --bright options, nor with " \
+                       + "--curv-err and the direct method).",
+		  default=None)
 parser.add_option("--tempo2",
 		  dest="tempo2", action='store_true',
 		  help="Print TOA in tempo2 format.",
 		  default=False)
 parser.add_option("--writefile",
 		  dest="writefile", type='string',
-		  help="Print TOA to file (ONLY FOR tempo2 FORMAT)",
+		  help="Write the TOAs to this file instead of printing them.",
 		  default=False)		  
  
 (options,args) = parser.parse_args()
+if options.chunk_size and options.curv_err and options.method == 'direct':
+  parser.error("--curv-err with --chunk-size needs --method fft or harmonic.")
+if options.bright and options.curv_err:
+  parser.error("--bright can not be used with --curv-err.")
 
 profile = np.loadtxt(options.profile)
 
@@ -109,13 +146,14 @@ prof_mod = model_profile.makeProfileModel(options.model, profile, n=options.num_
 if options.tempo2:
     print("FORMAT 1")
 if options.periodogram:
-  flist = np.loadtxt(options.periodogram,usecols=[0],dtype='S')
-  epoch, frequency = np.loadtxt(options.periodogram,usecols=[1,2],dtype='float',unpack=True)
+  flist, epoch, frequency, fdot = periodogram.read_table(options.periodogram)
   for i,fitsfile in enumerate(flist):
     ml_toa.get_ml_toa(fitsfile, prof_mod, None, scope=options.scope, bg_counts=options.bg_counts, \
-                      print_offs=options.offsets, frequency=frequency[i], epoch=epoch[i], sim=options.sim, \
+                      print_offs=options.offsets, frequency=frequency[i], fdot=fdot[i], epoch=epoch[i], sim=options.sim, \
                       Emin=options.emin, Emax=options.emax, gauss_err=options.gauss_err, tempo2=options.tempo2, \
-                      debug=options.plot_dist, correct_pf=options.correct_pf, split_orbits=options.orbits, split_num=options.ntoas, split_photons=options.nphotons, bright = options.bright)
+                      debug=options.plot_dist, correct_pf=options.correct_pf, split_orbits=options.orbits, split_num=options.ntoas, split_photons=options.nphotons, bright = options.bright, method=options.method, curv_err=options.curv_err, \
+                      N_sim=options.nsim, sim_seed=options.seed, nworkers=options.nworkers,
+                      chunk_size=options.chunk_size)
 
 elif options.list and options.split_n_days:
     ml_toa.get_ml_toa(options.list, prof_mod, options.parfile, scope=options.scope, \
@@ -125,7 +163,8 @@ elif options.list and options.split_n_days:
                       correct_pf=options.correct_pf,  split_n_days=options.split_n_days,
                       split_orbits=options.orbits, 
                       split_num=options.ntoas, split_photons=options.nphotons,
-                      writefile=options.writefile,bright = options.bright)
+                      writefile=options.writefile,bright = options.bright, method=options.method, curv_err=options.curv_err, \
+                      N_sim=options.nsim, sim_seed=options.seed, nworkers=options.nworkers)
                       
 elif options.list and options.nphotons:
     ml_toa.get_ml_toa(options.list, prof_mod, options.parfile, scope=options.scope, \
@@ -135,24 +174,29 @@ elif options.list and options.nphotons:
                       correct_pf=options.correct_pf,  split_n_days=options.split_n_days,
                       split_orbits=options.orbits, 
                       split_num=options.ntoas, split_photons=options.nphotons,
-                      writefile=options.writefile, bright = options.bright)                      
+                      writefile=options.writefile, bright = options.bright, method=options.method, curv_err=options.curv_err, \
+                      N_sim=options.nsim, sim_seed=options.seed, nworkers=options.nworkers)                      
 
 else:
   if options.list:
-    flist = np.loadtxt(options.list,dtype='S') 
+    flist = events.read_file_list(options.list)
   else:
     flist = args[0:]
 
-  for fitsfile in flist:
-    try:
-        ml_toa.get_ml_toa(fitsfile, prof_mod, options.parfile, scope=options.scope, \
+  # the files are measured in parallel, so the simulations within each run serially
+  results = ml_toa.get_ml_toas(flist, prof_mod, options.parfile, nworkers=options.nworkers,
+                      scope=options.scope, \
                       print_offs=options.offsets, sim=options.sim, bg_counts=options.bg_counts, \
                       Emin=options.emin, Emax=options.emax, gauss_err=options.gauss_err,
                       tempo2=options.tempo2, debug=options.plot_dist,
                       correct_pf=options.correct_pf,  split_n_days=options.split_n_days,
                       split_orbits=options.orbits, split_num=options.ntoas,
                       split_photons=options.nphotons,
-                      writefile=options.writefile, bright = options.bright)
-    except(IndexError):    
-        continue               
+                      bright = options.bright, method=options.method, curv_err=options.curv_err, \
+                      N_sim=options.nsim, sim_seed=options.seed, chunk_size=options.chunk_size)
 
+  writer = TimWriter(tempo2=options.tempo2)
+  for fitsfile, toas, error in results:
+    writer.add(toas)
+  # FORMAT 1 has already been printed when writing to stdout
+  writer.write(options.writefile, header=bool(options.writefile))
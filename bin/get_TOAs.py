@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import struct, getopt, sys, fftfit, psr_utils
+import multiprocessing
 import numpy as Num
 import numpy.fft as FFT
 from infodata import infodata
@@ -16,12 +17,35 @@ scopes = {'GBT':'1',
           'IRAM': 's',
           'Geocenter': 'o'}
 
-def getErr(profile,templatefilenm):
+_poisson_setup={}
+
+def _init_poisson(profile, template):
+  '''Store the profile and template in this process (worker pool initializer),
+     so they are sent to each worker once and not with every task'''
+  _poisson_setup['profile']=profile
+  _poisson_setup['template']=template
+
+def _poisson_offsets(args):
+  '''Measure the offsets of niter Poisson variations of the profile,
+     drawn from a random stream seeded with seed'''
+  niter, seed = args
+  profile=_poisson_setup['profile']
+  template=_poisson_setup['template']
+  rs=Num.random.RandomState(seed)
+  offsets=[]
+  for i in range(niter):
+    variation=Num.where(profile>0, rs.poisson(Num.clip(profile,0,None)), 0).astype(float)
+    offsets.append(psr_utils.measure_phase_corr(variation-min(variation), template-min(template)))
+  return offsets
+
+def getErr(profile,templatefilenm,nworkers=1,seed=None):
   '''Based off of Pulsar Timing and Relativistic Gravity,
      J.H. Taylor, Phil. Trans. R. Soc. Lond. A 1992  341, 117-134
      Appendix A
      Usage: give this a profile, a template, and a number of
-     harmonics and it will calculate the offset and output an error'''
+     harmonics and it will calculate the offset and output an error.
+     The Poisson variations can be spread over nworkers processes;
+     seed makes them reproducible (independent of nworkers)'''
   ####################################################################
   ###                   Calculate sigscal                          ###
   ####################################################################
@@ -55,15 +79,20 @@ def getErr(profile,templatefilenm):
   ### Done SigScale, start Poisson Variations                       ###
   #####################################################################
   it=1000#do 'it' iterations
-  variation=Num.zeros(len(profile))
+  nchunks=10#split over chunks with independent random streams
+  chunk_seeds=Num.random.RandomState(seed).randint(0, 2**31-1, nchunks)
+  tasks=[(it//nchunks + (i < it%nchunks), chunk_seeds[i]) for i in range(nchunks)]
+  if nworkers>1:
+    pool=multiprocessing.Pool(nworkers, _init_poisson, (profile, template))
+    results=pool.map(_poisson_offsets, tasks)
+    pool.close()
+    pool.join()
+  else:
+    _init_poisson(profile, template)
+    results=map(_poisson_offsets, tasks)
   Offsets=[]
-  for i in range (0, it):
-    for j in range (0,len(profile)):
-      if profile[j]>=0:
-        variation[j]=double(Num.random.poisson(profile[j],1))
-      if profile[j]<=0: 
-        variation[j]=0   
-    Offsets.append(psr_utils.measure_phase_corr(variation-min(variation), template-min(template))) 
+  for chunk_offsets in results:
+    Offsets.extend(chunk_offsets)
   Offsets=np.array(Offsets)
   #This fixes the error being way too big is the shift was around 0 or 1 (The std 
   # would then be averaging values near 0 and 1)
@@ -116,6 +145,8 @@ usage:  get_TOAs.py [options which must include -t or -g] pfd_file
   [-o seconds, --offset=seconds]     : Add the offset in seconds to any TOAs
   [-e, --event]                      : The .pfd file was made with events
   [-r, --norotate]                   : Do not rotate the template for FFTFIT
+  [-j numjobs, --jobs=numjobs]       : Processes for the Poisson error estimate
+  [--seed=seed]                      : Random seed for the Poisson error estimate
   pfd_file                           : The .pfd file containing the folds
 
   The program generates TOAs from a .pfd file using Joe Taylor's
@@ -150,10 +181,11 @@ usage:  get_TOAs.py [options which must include -t or -g] pfd_file
 
 if __name__ == '__main__':
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "herfs:n:d:g:t:o:k:i:",
+        opts, args = getopt.getopt(sys.argv[1:], "herfs:n:d:g:t:o:k:i:j:",
                                    ["help", "event", "norotate", "FFTFITouts",
                                     "subbands=", "numtoas=", "dm=", "gaussian=",
-                                    "template=", "offset=", "kill=", "kints="])
+                                    "template=", "offset=", "kill=", "kints=",
+                                    "jobs=", "seed="])
                                     
     except getopt.GetoptError:
         # print help information and exit:
@@ -175,6 +207,8 @@ if __name__ == '__main__':
     events = 0
     kill = []
     kints = []
+    nworkers = 1
+    seed = None
     for o, a in opts:
         if o in ("-h", "--help"):
             usage()
@@ -204,6 +238,10 @@ if __name__ == '__main__':
             templatefilenm = a
         if o in ("-o", "--offset"):
             offset = float(a)
+        if o in ("-j", "--jobs"):
+            nworkers = int(a)
+        if o in ("--seed",):
+            seed = int(a)
         if o in ("-k", "--kill"):
             for subs in a.split(','):
                 if (subs.find("-") > 0):
@@ -373,7 +411,7 @@ if __name__ == '__main__':
                     # Not enough structure in the template profile for FFTFIT
                     # so use time-domain correlations instead
                     tau = 1-psr_utils.measure_phase_corr(prof, template)
-                tau_err = getErr(prof,templatefilenm)#Use poisson error estimate
+                tau_err = getErr(prof,templatefilenm,nworkers=nworkers,seed=seed)#Use poisson error estimate
                 # Send the TOA to STDOUT
                 toaf = t0f + (tau*p + offset)/SECPERDAY + sumsubdelays[jj]
                 newdays = int(Num.floor(toaf))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+from swiftmonitor import periodogram, events
+from optparse import OptionParser
+
+parser = OptionParser("Usage: %prog [options] fitsfiles\n OR -l file_list",version="%prog 1.0")
+parser.add_option("-p", "--par",
+    dest="parfile", type='string',
+    help="Name of par file with pulsar ephemeris to scan around.",
+    default=None)
+parser.add_option("-l", "--list",
+    dest="list", type='string',
+    help="File with list of event files to get periodograms of.",
+    default=None)
+parser.add_option("--scope",
+    dest="scope", type='string',
+    help="Event files are from this telescope, default swift.",
+    default='swift')
+parser.add_option("--Emin",
+    dest="emin", type='float',
+    help="Minimum energy of events to use.",
+    default=None)
+parser.add_option("--Emax",
+    dest="emax", type='float',
+    help="Maximum energy of events to use.",
+    default=None)
+parser.add_option("-n", "--nfreq",
+    dest="nfreq", type='int',
+    help="Number of trial frequencies. Default is 201.",
+    default=201)
+parser.add_option("--df",
+    dest="df", type='float',
+    help="Spacing of trial frequencies in Hz. Default is 1/(oversample T), "
+         "T the span of the events.",
+    default=None)
+parser.add_option("--nfdot",
+    dest="nfdot", type='int',
+    help="Number of trial frequency derivatives. Default is 1 (ephemeris fdot only).",
+    default=1)
+parser.add_option("--dfdot",
+    dest="dfdot", type='float',
+    help="Spacing of trial frequency derivatives in Hz/s. Default is 8/(oversample T^2).",
+    default=None)
+parser.add_option("--oversample",
+    dest="oversample", type='float',
+    help="Oversampling of the default trial spacings. Default is 10.",
+    default=10)
+parser.add_option("--nharm",
+    dest="nharm", type='int',
+    help="Number of harmonics of the H-test. Default is 20.",
+    default=20)
+parser.add_option("-j", "--nworkers",
+    dest="nworkers", type='int',
+    help="Number of processes scanning frequencies in parallel. Default is 1.",
+    default=1)
+parser.add_option("-o", "--output",
+    dest="out_fn", type='string',
+    help="Write the table of best frequencies (input of get_ML_TOA.py --periodogram) "
+         "to this file instead of printing it.",
+    default=None)
+
+(options,args) = parser.parse_args()
+
+if options.parfile is None:
+    parser.error('Must give a par file to scan around.')
+if options.list:
+    EVTs = events.read_file_list(options.list)
+else:
+    EVTs = args
+
+results = periodogram.periodograms(EVTs, options.parfile, nfreq=options.nfreq, df=options.df,
+                                   nfdot=options.nfdot, dfdot=options.dfdot,
+                                   oversample=options.oversample, scope=options.scope,
+                                   Emin=options.emin, Emax=options.emax, nharm=options.nharm,
+                                   nworkers=options.nworkers)
+periodogram.write_table(results, options.out_fn)
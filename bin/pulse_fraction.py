@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
 import numpy as np
 import matplotlib.pyplot as plt
 import swiftmonitor.utils as smu
-from swiftmonitor import model_profile
+from swiftmonitor import model_profile, events
 from optparse import OptionParser
 from fluxtool import rms_estimator
 
@@ -42,16 +43,18 @@ parser.add_option("--normed",action="store_true",
 (options,args) = parser.parse_args()
 
 if options.list:
-    EVTs = np.loadtxt(options.list, dtype='S')#.T[0]
+    EVTs = events.read_file_list(options.list)
     phases = np.zeros(0)
-    for evt in EVTs:     
+    for evt_fn in EVTs:     
+        evt = smu.event_list(evt_fn, scope=options.scope)
         pulsed_flux, pulsed_flux_err = smu.pulsed_flux_rms(evt, options.parfile,normed = options.normed, nbins = options.nbins, scope=options.scope, Emin=options.emin,Emax=options.emax, nharm =options.nharm )
         p_frac, p_frac_err = smu.pulsed_fraction_rms(evt, options.parfile, nbins= options.nbins, scope=options.scope, Emin=options.emin,Emax=options.emax, nharm =options.nharm)
         date = np.mean(smu.fits2times(evt,scope=options.scope, Emin=options.emin,Emax=options.emax))
-        print evt, date , pulsed_flux, pulsed_flux_err, p_frac, p_frac_err 
+        print(evt_fn, date , pulsed_flux, pulsed_flux_err, p_frac, p_frac_err)
         
 else:                      
-    pulsed_flux, pulsed_flux_err = smu.pulsed_flux_rms(args[0], options.parfile,normed = options.normed, nbins = options.nbins, scope=options.scope, Emin=options.emin,Emax=options.emax, nharm =options.nharm)
-    p_frac, p_frac_err = smu.pulsed_fraction_rms(args[0], options.parfile, nbins= options.nbins, scope=options.scope, Emin=options.emin,Emax=options.emax, nharm =options.nharm)
-    date = np.mean(smu.fits2times(args[0],scope=options.scope, Emin=options.emin,Emax=options.emax))
-    print args[0], date , pulsed_flux, pulsed_flux_err, p_frac, p_frac_err 
+    evt = smu.event_list(args[0], scope=options.scope)
+    pulsed_flux, pulsed_flux_err = smu.pulsed_flux_rms(evt, options.parfile,normed = options.normed, nbins = options.nbins, scope=options.scope, Emin=options.emin,Emax=options.emax, nharm =options.nharm)
+    p_frac, p_frac_err = smu.pulsed_fraction_rms(evt, options.parfile, nbins= options.nbins, scope=options.scope, Emin=options.emin,Emax=options.emax, nharm =options.nharm)
+    date = np.mean(smu.fits2times(evt,scope=options.scope, Emin=options.emin,Emax=options.emax))
+    print(args[0], date , pulsed_flux, pulsed_flux_err, p_frac, p_frac_err) 
@@ -2,4 +2,5 @@
 
 monitor_code_path = '/home/rarchiba/swiftmonitor/'
 monitor_data_path = '/exports/data/pscholz/monitor/'
-
+cache_path = monitor_data_path + 'cache/'
+decompress_cache_size = 20 * 1024**3 # bytes of decompressed copies of gzipped files
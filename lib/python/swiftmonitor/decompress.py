@@ -0,0 +1,159 @@
+"""
+A cache of decompressed copies of gzipped files.
+
+The archive products (*po_cl.evt.gz event files, *.fits.gz attitude and
+orbit files, *.hk.gz housekeeping files) are gzipped, and every tool
+that opens one inflates the whole file again. decompressed(fn) returns
+an uncompressed copy of fn from config.cache_path instead, keyed by the
+md5 of the compressed content, so re-runs and repeated pipeline stages
+inflate each file once. The cache is kept below
+config.decompress_cache_size bytes by removing the least recently used
+copies.
+"""
+import os, sys
+import gzip
+import hashlib
+import shutil
+import tempfile
+import multiprocessing
+import multiprocessing.pool
+from swiftmonitor import config
+
+_hashes = {}
+_cache_warned = False
+
+def cache_dir():
+    """
+    Directory of the decompressed copies (within config.cache_path).
+    """
+    return os.path.join(config.cache_path, 'decompressed')
+
+def native_name(fn):
+    """
+    fn as a native str: a bytes file name (e.g. as read with
+        np.loadtxt(dtype='S') under Python 3) is decoded with the file
+        system encoding. Under Python 2 bytes is str and fn is unchanged.
+    """
+    if not isinstance(fn, str) and isinstance(fn, bytes):
+        return fn.decode(sys.getfilesystemencoding())
+    return fn
+
+def is_gzipped(fn):
+    f = open(fn, 'rb')
+    start = f.read(2)
+    f.close()
+    return start == b'\x1f\x8b'
+
+def content_hash(fn):
+    """
+    md5 of the content of fn, remembered for as long as the file's
+        modification time and size do not change.
+    """
+    stat = os.stat(fn)
+    key = (os.path.abspath(fn), stat.st_mtime, stat.st_size)
+    if key not in _hashes:
+        md5 = hashlib.md5()
+        f = open(fn, 'rb')
+        for block in iter(lambda: f.read(2**20), b''):
+            md5.update(block)
+        f.close()
+        _hashes[key] = md5.hexdigest()
+    return _hashes[key]
+
+def decompressed(fn):
+    """
+    Returns the name of an uncompressed copy of fn, decompressing it into
+        the cache if it is not there yet. Files that are not gzipped are
+        returned unchanged, as is fn if the cache can not be written (warned
+        about once).
+
+        A copy is written to a temporary file and renamed into place, so
+        concurrent callers never see a partial copy; at worst two of them
+        decompress the same file.
+    """
+    fn = native_name(fn)
+    if not is_gzipped(fn):
+        return fn
+    name = os.path.basename(fn)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    cache_fn = os.path.join(cache_dir(), content_hash(fn) + '_' + name)
+    if os.path.exists(cache_fn):
+        try:
+            os.utime(cache_fn, None) # mark as recently used
+            return cache_fn
+        except OSError:
+            pass # evicted meanwhile
+
+    global _cache_warned
+    try:
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir())
+        fd, tmp_fn = tempfile.mkstemp(dir=cache_dir(), prefix='.tmp')
+        out = os.fdopen(fd, 'wb')
+        try:
+            src = gzip.open(fn, 'rb')
+            shutil.copyfileobj(src, out, 2**20)
+            src.close()
+        finally:
+            out.close()
+        os.rename(tmp_fn, cache_fn)
+    except (IOError, OSError) as err:
+        if not _cache_warned:
+            sys.stderr.write('Warning: could not write decompressed copy of %s in %s: %s\n' % \
+                             (fn, cache_dir(), err))
+            _cache_warned = True
+        return fn
+    evict(keep=cache_fn)
+    return cache_fn
+
+def evict(max_size=None, keep=None):
+    """
+    Removes the least recently used copies until the cache holds at most
+        max_size bytes (default config.decompress_cache_size), never removing
+        keep. A copy removed while another process has it open stays readable
+        by that process.
+    """
+    if max_size is None:
+        max_size = config.decompress_cache_size
+    entries = []
+    for name in os.listdir(cache_dir()):
+        if name.startswith('.tmp'):
+            continue
+        path = os.path.join(cache_dir(), name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def decompress_files(fns, nthreads=None):
+    """
+    Decompresses many files at once on a pool of nthreads threads (default:
+        one per CPU), returning the list of names from decompressed. zlib
+        releases the GIL, so the files inflate concurrently.
+    """
+    fns = list(fns)
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    nthreads = max(1, min(nthreads, len(fns)))
+    if nthreads == 1:
+        return [ decompressed(fn) for fn in fns ]
+    pool = multiprocessing.pool.ThreadPool(nthreads)
+    try:
+        return pool.map(decompressed, fns)
+    finally:
+        pool.close()
+        pool.join()
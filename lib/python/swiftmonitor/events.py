@@ -0,0 +1,568 @@
+"""
+A columnar, memory-mapped cache of event files.
+
+Reading a (usually gzipped) FITS event file means decompressing and
+parsing the whole table every time. read_events converts an event file
+once into a directory of uncompressed .npy columns (times in MJD, both
+as float and as two-part integer day + seconds, the energy columns and
+X/Y), the GTIs and the useful header values. Later reads memory-map
+the columns. A cache is rebuilt when the modification time or size of
+the event file changes.
+
+read_event_lists merges several event files into one time-sorted
+EventList, decoding them concurrently into preallocated columns.
+"""
+import os, sys
+import gzip
+import json
+import hashlib
+import shutil
+import tempfile
+import multiprocessing.pool
+import numpy as np
+import astropy.io.fits as pyfits
+from swiftmonitor import config, decompress
+
+SECPERDAY = 86400.0
+
+header_keys = ['OBS_ID', 'EXPOSURE', 'ONTIME', 'LIVETIME', 'TSTART', 'TSTOP',
+               'DATE-OBS', 'DATE-END', 'MJDREFI', 'MJDREFF', 'MJDREF', 'TIMEZERO',
+               'TELESCOP', 'INSTRUME', 'OBJECT', 'RA_OBJ', 'DEC_OBJ']
+energy_columns = ['PI', 'PHA', 'ENERGY']
+position_columns = ['X', 'Y']
+gti_extensions = ['GTI', 'STDGTI']
+# numpy types of the FITS binary table formats of energy columns
+fits_formats = {'B': np.uint8, 'I': np.int16, 'J': np.int32, 'K': np.int64,
+                'E': np.float32, 'D': np.float64}
+
+_cache_warned = False
+
+def met2mjd(met, header, split_mjd=False):
+    """
+    Converts mission elapsed times (s) into MJD using the MJDREFI, MJDREFF
+        and TIMEZERO (or MJDREF) keywords of header. If split_mjd, returns
+        a tuple (mjdi, sec) of the integer MJD and the seconds since the
+        start of that day instead.
+    """
+    if split_mjd:
+        try:
+            mjdref = header['MJDREFI']
+            sec = met + header['MJDREFF']*SECPERDAY + header['TIMEZERO']
+        except (KeyError):
+            mjdref = np.floor(header['MJDREF'])
+            sec = met + (header['MJDREF'] - mjdref)*SECPERDAY
+        days = np.floor(sec / SECPERDAY)
+        return mjdref + days, sec - days*SECPERDAY
+
+    t = met / 86400.0
+    try:
+        return t + header['MJDREFI'] + header['MJDREFF'] + header['TIMEZERO']/3600./24.
+    except (KeyError):
+        return t + header['MJDREF']
+
+def has_time_reference(header):
+    """
+    Whether header has the full set of keywords met2mjd needs: MJDREFI,
+        MJDREFF and TIMEZERO, or MJDREF.
+    """
+    return 'MJDREF' in header or \
+           all(key in header for key in ('MJDREFI', 'MJDREFF', 'TIMEZERO'))
+
+class EventCache:
+    """
+    The cached columns of an event file. Columns are memory-mapped (read
+        only) the first time they are asked for, e.g. cache['TIME'].
+
+        Columns: TIME (MJD), MJDI and SEC (two-part MJD, see met2mjd), the
+        energy columns (PI, PHA, ENERGY) and X, Y that the file has, GTI
+        (N x 2 start/stop MJDs, empty if the file has no GTI extension) and
+        ENERGY_ORDER, ENERGY_SORTED (see energy_index) for the energy column.
+        header is a dictionary of the header_keys values found in the event
+        or primary header.
+
+        If cache_dir is None the columns are held in memory (given as a
+        dictionary together with the meta data).
+    """
+    def __init__(self, cache_dir, meta=None, columns=None):
+        self.cache_dir = cache_dir
+        if meta is None:
+            meta_file = open(os.path.join(cache_dir, 'meta.json'), 'r')
+            meta = json.load(meta_file)
+            meta_file.close()
+        self.source = meta['source']
+        self.mtime = meta['mtime']
+        self.size = meta['size']
+        self.header = meta['header']
+        self.columns = meta['columns']
+        self._columns = dict(columns) if columns is not None else {}
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            if name not in self.columns:
+                raise KeyError("No column %s in event cache of %s" % (name, self.source))
+            self._columns[name] = np.load(os.path.join(self.cache_dir, name + '.npy'),
+                                          mmap_mode='r')
+        return self._columns[name]
+
+    @property
+    def energy_column(self):
+        """
+        Name of the energy column used for energy selections (None if there is none).
+        """
+        for name in energy_columns:
+            if name in self.columns:
+                return name
+        return None
+
+    def __len__(self):
+        return len(self['TIME'])
+
+    def is_current(self):
+        """
+        Whether the event file is unchanged since the cache was built.
+        """
+        try:
+            return os.path.getmtime(self.source) == self.mtime and \
+                   os.path.getsize(self.source) == self.size
+        except OSError:
+            return False
+
+def energy_index(chans):
+    """
+    Returns the permutation that sorts events by energy channel (stable, so
+        events of equal channel stay in time order) and the sorted channels.
+    """
+    order = np.argsort(chans, kind='stable')
+    if len(order) < 2**31:
+        order = order.astype(np.int32)
+    return order, np.asarray(chans)[order]
+
+def cache_dir(fits_fn, scope='swift'):
+    """
+    Directory of the cache of an event file (within config.cache_path).
+    """
+    key = '%s:%s' % (os.path.abspath(fits_fn), scope)
+    return os.path.join(config.cache_path, 'events', hashlib.md5(key.encode()).hexdigest())
+
+def _native(array):
+    array = np.asarray(array)
+    return array.astype(array.dtype.newbyteorder('='))
+
+def read_event_file(fits_fn, scope='swift'):
+    """
+    Reads the columns, GTIs and header values of an event file, returning
+        the meta data and a dictionary of columns as stored in an EventCache.
+        A gzipped file is read from its decompressed copy (see decompress).
+    """
+    fits_fn = decompress.native_name(fits_fn)
+    stat = os.stat(fits_fn)
+    fits = pyfits.open(decompress.decompressed(fits_fn))
+    try:
+        events = fits[1]
+        names = [ name.upper() for name in events.columns.names ]
+        if scope == 'fermi':
+            met = _native(events.data['bary_time']).astype(float)
+        else:
+            met = _native(events.data['time']).astype(float)
+        mjdi, sec = met2mjd(met, events.header, split_mjd=True)
+        columns = {'TIME': met2mjd(met, events.header), 'MJDI': mjdi, 'SEC': sec}
+        for name in energy_columns + position_columns:
+            if name in names:
+                columns[name] = _native(events.data[name])
+        for name in energy_columns:
+            if name in columns:
+                columns['ENERGY_ORDER'], columns['ENERGY_SORTED'] = energy_index(columns[name])
+                break
+
+        columns['GTI'] = np.zeros((0, 2))
+        for hdu in fits[1:]:
+            if hdu.name in gti_extensions:
+                ref_header = hdu.header if has_time_reference(hdu.header) else events.header
+                columns['GTI'] = np.column_stack((met2mjd(_native(hdu.data['START']), ref_header),
+                                                  met2mjd(_native(hdu.data['STOP']), ref_header)))
+                break
+
+        header = {}
+        for key in header_keys:
+            for hdu in (events, fits[0]):
+                if key in hdu.header and isinstance(hdu.header[key], (str, int, float, bool)):
+                    header[key] = hdu.header[key]
+                    break
+    finally:
+        fits.close()
+
+    meta = {'source': os.path.abspath(fits_fn), 'mtime': stat.st_mtime, 'size': stat.st_size,
+            'scope': scope, 'header': header, 'columns': sorted(columns.keys())}
+    return meta, columns
+
+def write_event_cache(cache_dn, meta, columns):
+    """
+    Writes the output of read_event_file to cache_dn and returns it as an
+        EventCache. The cache is written to a temporary directory and renamed
+        into place, so concurrent readers never see a partial cache.
+    """
+    parent = os.path.dirname(cache_dn)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmp_dn = tempfile.mkdtemp(dir=parent)
+    for name in columns:
+        np.save(os.path.join(tmp_dn, name + '.npy'), columns[name])
+    meta_file = open(os.path.join(tmp_dn, 'meta.json'), 'w')
+    json.dump(meta, meta_file)
+    meta_file.close()
+
+    if os.path.exists(cache_dn):
+        shutil.rmtree(cache_dn, ignore_errors=True)
+    try:
+        os.rename(tmp_dn, cache_dn)
+    except OSError:
+        # another process put its cache in place first
+        shutil.rmtree(tmp_dn, ignore_errors=True)
+    return EventCache(cache_dn)
+
+def read_events(fits_fn, scope='swift'):
+    """
+    Returns the EventCache of an event file, building it if there is no
+        cache yet or if the event file changed since it was built. If the
+        cache cannot be written (warned about once), the columns that were
+        read are returned in an in-memory EventCache.
+    """
+    global _cache_warned
+    fits_fn = decompress.native_name(fits_fn)
+    cache_dn = cache_dir(fits_fn, scope)
+    try:
+        cache = EventCache(cache_dn)
+        if cache.is_current():
+            return cache
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    meta, columns = read_event_file(fits_fn, scope=scope)
+    try:
+        return write_event_cache(cache_dn, meta, columns)
+    except (IOError, OSError) as err:
+        if not _cache_warned:
+            sys.stderr.write('Warning: could not write event cache in %s: %s\n' % \
+                             (config.cache_path, err))
+            _cache_warned = True
+        return EventCache(None, meta=meta, columns=columns)
+
+class EventList:
+    """
+    The events of an event file, read in one pass through the event cache
+        (see read_events, or straight from the FITS file if cache is False):
+        times, energy channels, GTIs and the header values obsid, exposure
+        and mjdref. Energy selections (Emin < E < Emax in keV, converted to
+        channels for the scope) are contiguous slices of the energy-sorted
+        events (see energy_index) found by searchsorted, so selecting a band
+        costs O(band size) rather than a mask over all events. Bands are kept
+        once computed.
+
+        The functions in utils that take an event file name also take an
+        EventList, so a file is decoded once however many analyses use it.
+        An already read EventCache can be given as events (read_event_lists
+        does so for merged lists, whose fits_fn is the list of files).
+    """
+    def __init__(self, fits_fn, scope='swift', cache=True, events=None):
+        if events is not None:
+            self.events = events
+        elif cache:
+            self.events = read_events(fits_fn, scope=scope)
+        else:
+            meta, columns = read_event_file(fits_fn, scope=scope)
+            self.events = EventCache(None, meta=meta, columns=columns)
+        self.fits_fn = fits_fn
+        self.fits_fns = list(fits_fn) if isinstance(fits_fn, (list, tuple)) else [fits_fn]
+        self.scope = scope
+        self.header = self.events.header
+        self.obsid = self.header.get('OBS_ID', os.path.basename(self.fits_fns[0]))
+        self.exposure = self.header.get('EXPOSURE')
+        self.gti = self.events['GTI']
+        self.energy_column = self.events.energy_column
+        self._bands = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def __repr__(self):
+        return "EventList: " + str(self.fits_fn) + " (" + str(len(self)) + " events)"
+
+    @property
+    def mjdref(self):
+        if 'MJDREFI' in self.header:
+            return self.header['MJDREFI'] + self.header.get('MJDREFF', 0.0)
+        return self.header.get('MJDREF')
+
+    def energy_index(self):
+        """
+        The energy-sorting permutation and sorted channels (from the cache,
+            or computed for caches written before they were stored).
+        """
+        if 'ENERGY_ORDER' not in self.events:
+            self.events.columns = self.events.columns + ['ENERGY_ORDER', 'ENERGY_SORTED']
+            self.events._columns['ENERGY_ORDER'], self.events._columns['ENERGY_SORTED'] = \
+                energy_index(self.events[self.energy_column])
+        return self.events['ENERGY_ORDER'], self.events['ENERGY_SORTED']
+
+    def band(self, Emin=None, Emax=None, time_order=True):
+        """
+        Indices of the events with Emin < E < Emax (keV, either can be None),
+            in time order unless time_order is False, or None if there is no
+            selection to make.
+        """
+        if self.energy_column is None or not (Emin or Emax):
+            return None
+        key = (Emin, Emax, time_order)
+        if key not in self._bands:
+            from swiftmonitor.utils import energy2chan
+            order, chans = self.energy_index()
+            lo, hi = 0, len(chans)
+            if Emin:
+                lo = np.searchsorted(chans, energy2chan(Emin, self.scope), side='right')
+            if Emax:
+                hi = np.searchsorted(chans, energy2chan(Emax, self.scope), side='left')
+            index = np.asarray(order[lo:max(lo, hi)])
+            self._bands[key] = np.sort(index) if time_order else index
+        return self._bands[key]
+
+    def _column(self, name, Emin=None, Emax=None, time_order=True):
+        index = self.band(Emin, Emax, time_order=time_order)
+        if index is None:
+            return np.array(self.events[name])
+        return np.asarray(self.events[name])[index]
+
+    def times(self, Emin=None, Emax=None, split_mjd=False, time_order=True):
+        """
+        Event times (MJD) with Emin < E < Emax, or a tuple (mjdi, sec) of
+            two-part times if split_mjd (see met2mjd). With time_order False,
+            the times of an energy band come in energy order, which saves
+            sorting them when the order does not matter (folding, H-tests).
+        """
+        if split_mjd:
+            return self._column('MJDI', Emin, Emax, time_order), \
+                   self._column('SEC', Emin, Emax, time_order)
+        return self._column('TIME', Emin, Emax, time_order)
+
+    def energies(self, Emin=None, Emax=None, time_order=True):
+        """
+        Energy channels (PI, PHA or ENERGY column) of the events with
+            Emin < E < Emax, or None if the file has no energy column.
+        """
+        if self.energy_column is None:
+            return None
+        return self._column(self.energy_column, Emin, Emax, time_order)
+
+    def chunks(self, Emin=None, Emax=None, chunk_size=2**20, split_mjd=False, energies=False):
+        """
+        Yields the times (a tuple (mjdi, sec) if split_mjd) of the events with
+            Emin < E < Emax in time order, chunk_size events of the file at
+            a time, or tuples (times, energies) if energies is True. Each
+            chunk is read from the memory-mapped cache and energy-filtered on
+            its own, so memory use is bounded by chunk_size, not the number
+            of events.
+
+            This bound holds once the cache exists: building it (see
+            read_events, done when the EventList is made with cache=True)
+            decodes the whole event table and sorts its energies in memory,
+            once per file.
+        """
+        if self.energy_column is None or not (Emin or Emax):
+            Emin, Emax = None, None
+        else:
+            from swiftmonitor.utils import energy2chan
+            cmin = energy2chan(Emin, self.scope) if Emin else None
+            cmax = energy2chan(Emax, self.scope) if Emax else None
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            keep = slice(None)
+            if Emin or Emax:
+                chans = np.asarray(self.events[self.energy_column][start:stop])
+                keep = np.ones(len(chans), dtype=bool)
+                if Emin:
+                    keep &= chans > cmin
+                if Emax:
+                    keep &= chans < cmax
+            select = lambda name: np.array(self.events[name][start:stop][keep])
+            if split_mjd:
+                t = select('MJDI'), select('SEC')
+            else:
+                t = select('TIME')
+            if energies:
+                yield t, (select(self.energy_column) if self.energy_column else None)
+            else:
+                yield t
+
+    def origin(self, Emin=None, Emax=None, time_order=True):
+        """
+        Index into fits_fns of the file each event with Emin < E < Emax came
+            from (all 0 unless the list was merged by read_event_lists).
+        """
+        if 'ORIGIN' not in self.events:
+            return np.zeros(len(self.times(Emin, Emax, time_order=time_order)), dtype=np.int32)
+        return self._column('ORIGIN', Emin, Emax, time_order)
+
+def _file_start(fn, nbytes=9):
+    f = open(fn, 'rb')
+    start = f.read(nbytes)
+    f.close()
+    return start
+
+def is_event_file(fn):
+    """
+    Whether fn is a FITS file (plain or gzipped) rather than e.g. a text
+        list of event files.
+    """
+    start = _file_start(fn)
+    return start == b'SIMPLE  =' or start[:2] == b'\x1f\x8b'
+
+def read_event_header(fits_fn):
+    """
+    Returns the primary and event table headers of an event file. Only the
+        headers are read: unlike pyfits, which decompresses a gzipped file up
+        to the end of an extension to find the next one, this stops after
+        the event table header.
+    """
+    if _file_start(fits_fn, 2) == b'\x1f\x8b':
+        f = gzip.open(fits_fn, 'rb')
+    else:
+        f = open(fits_fn, 'rb')
+    try:
+        primary = pyfits.Header.fromfile(f, padding=True)
+        size = 0
+        if primary.get('NAXIS', 0):
+            size = abs(primary['BITPIX']) // 8
+            for i in range(1, primary['NAXIS'] + 1):
+                size *= primary['NAXIS%d' % i]
+        f.seek(-(-size // 2880) * 2880, 1)
+        header = pyfits.Header.fromfile(f, padding=True)
+    finally:
+        f.close()
+    return primary, header
+
+def read_file_list(list_fn):
+    """
+    Returns the event file names listed in list_fn (the first word of each
+        line, skipping blank lines and lines starting with #).
+    """
+    f = open(list_fn, 'r')
+    fns = [ line.split()[0] for line in f if line.strip() and not line.startswith('#') ]
+    f.close()
+    return fns
+
+def _column_dtype(header, name):
+    """
+    numpy type of column name of a FITS binary table header (None if the
+        table has no such column). Scaled columns are read as floats.
+    """
+    for i in range(1, header.get('TFIELDS', 0) + 1):
+        if header.get('TTYPE%d' % i, '').upper() == name:
+            if 'TSCAL%d' % i in header or 'TZERO%d' % i in header:
+                return np.float64
+            return fits_formats.get(header['TFORM%d' % i].strip()[-1:], np.float64)
+    return None
+
+def read_event_lists(fits_fns, scope='swift', cache=True, nthreads=None):
+    """
+    Merges the events of several event files into one EventList, sorted
+        by time. The event table headers are read first (see
+        read_event_header) to size the merged columns and order the files
+        by TSTART, then the files are read (through the event cache unless
+        cache is False) by a pool of nthreads threads (default: one per
+        CPU, at most one per file), each copying its events straight into
+        its slice of the merged columns.
+
+        The merged list has the TIME, MJDI and SEC columns, the first energy
+        column that every file has, ORIGIN (the index into fits_fns of each
+        event's file, see EventList.origin) and the GTIs of all the files.
+        Its header keeps the values that all files share, with EXPOSURE
+        (and ONTIME, LIVETIME) summed and the OBS_IDs joined by '+'.
+    """
+    fits_fns = list(fits_fns)
+    if not len(fits_fns):
+        raise ValueError("No event files to read")
+    headers = []
+    for fn in fits_fns:
+        primary, header = read_event_header(fn)
+        for key in primary:
+            if key not in header and key not in ('SIMPLE', 'EXTEND', 'COMMENT', 'HISTORY', ''):
+                header[key] = primary[key]
+        headers.append(header)
+    counts = np.array([ header['NAXIS2'] for header in headers ], dtype=np.int64)
+    # lay the files out in order of their start times, so that the merged
+    # events of files that do not overlap in time need no sorting
+    tstarts = []
+    for header in headers:
+        try:
+            tstarts.append(met2mjd(header['TSTART'], header))
+        except (KeyError):
+            tstarts.append(0.0)
+    slots = np.argsort(tstarts, kind='stable')
+    starts = np.empty(len(fits_fns), dtype=np.int64)
+    starts[slots] = np.cumsum(counts[slots]) - counts[slots]
+    ends = starts + counts
+
+    energy_column = None
+    for name in energy_columns:
+        dtypes = [ _column_dtype(header, name) for header in headers ]
+        if None not in dtypes:
+            energy_column = name
+            energy_dtype = np.result_type(*dtypes)
+            break
+
+    total = counts.sum()
+    columns = {'TIME': np.empty(total), 'MJDI': np.empty(total), 'SEC': np.empty(total),
+               'ORIGIN': np.empty(total, dtype=np.int32)}
+    if energy_column is not None:
+        columns[energy_column] = np.empty(total, dtype=energy_dtype)
+    metas = [None] * len(fits_fns)
+
+    def read(i):
+        evts = EventList(fits_fns[i], scope=scope, cache=cache)
+        if len(evts) != counts[i]:
+            raise ValueError("%s has %d events, its header says %d" % \
+                             (fits_fns[i], len(evts), counts[i]))
+        for name in columns:
+            if name == 'ORIGIN':
+                columns[name][starts[i]:ends[i]] = i
+            else:
+                columns[name][starts[i]:ends[i]] = evts.events[name]
+        metas[i] = (evts.header, np.array(evts.gti))
+
+    if nthreads is None:
+        nthreads = multiprocessing.cpu_count()
+    nthreads = max(1, min(nthreads, len(fits_fns)))
+    if nthreads > 1:
+        pool = multiprocessing.pool.ThreadPool(nthreads)
+        try:
+            pool.map(read, range(len(fits_fns)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for i in range(len(fits_fns)):
+            read(i)
+
+    t = columns['TIME']
+    if np.any(t[1:] < t[:-1]):
+        order = np.argsort(t, kind='stable')
+        for name in columns:
+            columns[name] = columns[name][order]
+
+    header = {}
+    for key in metas[0][0]:
+        if all(key in meta[0] and meta[0][key] == metas[0][0][key] for meta in metas):
+            header[key] = metas[0][0][key]
+    for key in ['EXPOSURE', 'ONTIME', 'LIVETIME']:
+        if all(key in meta[0] for meta in metas):
+            header[key] = sum(meta[0][key] for meta in metas)
+    if 'OBS_ID' not in header and all('OBS_ID' in meta[0] for meta in metas):
+        header['OBS_ID'] = '+'.join(str(meta[0]['OBS_ID']) for meta in metas)
+    gti = np.concatenate([ meta[1] for meta in metas ])
+    columns['GTI'] = gti[np.argsort(gti[:,0], kind='stable')]
+
+    meta = {'source': [ os.path.abspath(fn) for fn in fits_fns ], 'mtime': None, 'size': None,
+            'scope': scope, 'header': header, 'columns': sorted(columns.keys())}
+    return EventList(fits_fns, scope=scope, events=EventCache(None, meta=meta, columns=columns))
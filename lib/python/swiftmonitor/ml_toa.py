@@ -6,26 +6,64 @@ import sys
 import os.path
 from swiftmonitor.utils import SECPERDAY
 import swiftmonitor.utils as smu
-from swiftmonitor import model_profile
+from swiftmonitor import model_profile, events
 import time
 
-sys.setrecursionlimit(100000)
-
 calcprobtime = 0
 logsumtime = 0
 integratetime = 0
 
 
-def logsumexp(array):
+class LogSumExp:
     """
-    Recursive algorithm that sums numbers using the log of the exponentials of the input array.
-        This is used because the probabilities can be very small in the likelihoods.
-        Unfortunately its pretty slow.
+    Streaming accumulator of log(sum(exp(values))), used because the probabilities
+        can be very small in the likelihoods.
+
+        Values are added in chunks of any size with add(); the running sum is kept
+        relative to the largest value seen so far, so the result is numerically
+        stable and each value is only touched once. With axis given, the reduction
+        is along that axis of each chunk and the result is an array (e.g. chunks
+        of likelihood surfaces over offsets for many simulations at once).
+        Accumulators over different chunks can be combined with merge().
     """
-    if len(array) == 2:
-        return np.logaddexp(array[0],array[1])
-    else:
-        return np.logaddexp(array[0],logsumexp(array[1:]))
+    def __init__(self):
+        self.maximum = -np.inf
+        self.sum = 0.0
+
+    def add(self, values, axis=None):
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return self
+        new_max = np.maximum(self.maximum, np.max(values, axis=axis))
+        shift = np.where(np.isfinite(new_max), new_max, 0.0)
+        if axis is None:
+            chunk_sum = np.sum(np.exp(values - shift))
+        else:
+            chunk_sum = np.sum(np.exp(values - np.expand_dims(shift, axis)), axis=axis)
+        self.sum = self.sum * np.exp(self.maximum - shift) + chunk_sum
+        self.maximum = new_max
+        return self
+
+    def merge(self, other):
+        new_max = np.maximum(self.maximum, other.maximum)
+        shift = np.where(np.isfinite(new_max), new_max, 0.0)
+        self.sum = self.sum * np.exp(self.maximum - shift) + \
+                   other.sum * np.exp(other.maximum - shift)
+        self.maximum = new_max
+        return self
+
+    @property
+    def value(self):
+        with np.errstate(divide='ignore'):
+            return np.where(np.isfinite(self.maximum), self.maximum, 0.0) + np.log(self.sum)
+
+
+def logsumexp(array, axis=None):
+    """
+    Sums numbers using the log of the exponentials of the input array
+        in a single pass (see LogSumExp).
+    """
+    return LogSumExp().add(array, axis=axis).value
 
 def calc_prob(phases, offset, prof_mod):
     """
@@ -45,26 +83,227 @@ def calc_prob_bright(folded, offset, prof_mod):
     loglike = np.sum(probs)
     return loglike
 
-class PSRpar:
+def calc_probs_fft(phases, prof_mod, nbins=16384):
+    """
+    Calculates the log-likelihood of every offset on a grid of nbins trial offsets
+        (k/nbins, k=0..nbins-1) in a single pass.
+
+        The phases are histogrammed once onto nbins bins and each photon is placed
+        at the centre of its bin. The log-likelihood of every offset is then the
+        circular cross-correlation of the histogram with the log of the template
+        sampled at the bin centres, which is done with FFTs in O(nbins log nbins).
+
+        Discretisation error: the binned surface is the exact unbinned log-likelihood
+        of a photon list in which every phase has been moved by at most 1/(2*nbins).
+        For N photons it therefore differs from calc_prob by at most
+            N * max|d ln(prof_mod)/dphi| / (2*nbins)
+        at every offset, and to first order the most probable offset moves by
+        less than 1/(2*nbins) (3e-5 in phase for the default nbins), which is far
+        below the statistical error of any TOA we measure.
+
+        Returns the array of offsets and the array of log-likelihoods.
+    """
+    return fft_loglikes(fft_fold(phases, nbins), prof_mod)
+
+def fft_fold(phases, nbins=16384):
+    """
+    Histogram of phases on nbins bins as used by calc_probs_fft.
+    """
+    idx = np.floor((np.asarray(phases) % 1.0) * nbins).astype(int)
+    idx[idx == nbins] = 0 # phases within rounding of 1.0
+    return np.bincount(idx, minlength=nbins)
+
+def fft_loglikes(folded, prof_mod):
+    """
+    The offsets and log-likelihoods of calc_probs_fft from the histogram of
+        the phases (see fft_fold).
+    """
+    nbins = len(folded)
+    centres = (np.arange(nbins) + 0.5) / nbins
+    logprof = np.log(prof_mod(centres))
+
+    loglikes = np.fft.irfft(np.fft.rfft(folded) * np.conj(np.fft.rfft(logprof)), nbins)
+    offsets = np.arange(nbins) / float(nbins)
+
+    return offsets, loglikes
+
+class HarmonicLikelihood:
+    """
+    Log-likelihood of phase offsets computed from the trigonometric moments
+        of the photon phases.
+
+        Writing the log of the template as a Fourier series with coefficients a_k
+        (see model_profile.log_harmonics), the log-likelihood of an offset is
+
+            logL(offset) = N*a_0 + 2*Re( sum_k a_k * M_k * exp(-2j*pi*k*offset) )
+
+        where M_k = sum(exp(2j*pi*k*phases)) are the moments of the data. The moments
+        are computed once in O(N*nharm), after which the likelihood and its derivatives
+        cost O(nharm) per offset, independent of the number of photons.
+
+        Accuracy is set by how well nharm harmonics describe the log of the template,
+        which is excellent for smooth (e.g. Fourier_Model) templates.
+    """
+    def __init__(self, phases, prof_mod, nharm=64, moments=None, N=None):
+        self.nharm = nharm
+        self.coeffs = model_profile.log_harmonics(prof_mod, nharm)
+        if moments is None:
+            moments = smu.trig_moments(phases, nharm)
+        self.N = len(phases) if N is None else N
+        self.k = np.arange(1, nharm+1)
+        self.weights = self.coeffs[1:] * moments
+
+    def __call__(self, offsets):
+        return self.derivative(offsets, order=0)
+
+    def derivative(self, offsets, order=1):
+        """
+        Returns the order'th derivative of the log-likelihood with respect to
+            offset at offsets (scalar or array).
+        """
+        offsets = np.asarray(offsets, dtype=float)
+        terms = self.weights * (-2.j*np.pi*self.k)**order
+        loglike = 2 * np.real(np.dot(np.exp(-2.j*np.pi*offsets[...,None]*self.k), terms))
+        if order == 0:
+            loglike = loglike + self.N * np.real(self.coeffs[0])
+        return loglike
+
+    def curvature(self, offset):
+        """
+        Returns the second derivative of the log-likelihood at offset.
+        """
+        return self.derivative(offset, order=2)
+
+    def peak(self, ngrid=None, niter=10):
+        """
+        Returns the most probable offset (0-1). The maximum is found on a grid
+            fine enough to resolve the highest harmonic and then refined with
+            Newton iterations on the analytic derivatives.
+        """
+        if ngrid is None:
+            ngrid = 8 * self.nharm
+        grid = np.arange(ngrid) / float(ngrid)
+        offset = grid[np.argmax(self(grid))]
+        for i in range(niter):
+            step = self.derivative(offset, 1) / self.curvature(offset)
+            if not np.abs(step) < 1.0 / ngrid:
+                break
+            offset -= step
+        return offset % 1.0
+
+class LoglikeAccumulator:
+    """
+    Streaming accumulator of the log-likelihood of the trial offsets of
+        calc_toa_offset for a likelihood method, for phases too many to hold
+        at once.
+
+        Phases are added in chunks with add(); only what the method needs is
+        kept (the log-likelihood of each of the 1001 offsets for 'direct',
+        the fft_nbins histogram for 'fft' and the log_nharm moments for
+        'harmonic'), so memory use does not grow with the number of phases.
+        Accumulators over different chunks can be combined with merge().
+        An accumulator can be given to calc_toa_offset in place of phases.
+    """
+    def __init__(self, prof_mod, method='direct', fft_nbins=16384, log_nharm=64):
+        self.prof_mod = prof_mod
+        self.method = method
+        self.fft_nbins = fft_nbins
+        self.log_nharm = log_nharm
+        self.N = 0
+        if method == 'fft':
+            self.folded = np.zeros(fft_nbins, dtype=np.int64)
+        elif method == 'harmonic':
+            self.moments = np.zeros(log_nharm, dtype='c16')
+        elif method == 'direct':
+            self.offsets = np.append(np.arange(0,1,0.001), 1.0)
+            self.loglikes = np.zeros(len(self.offsets))
+        else:
+            raise ValueError("Unknown likelihood method '%s'" % method)
+
+    def __len__(self):
+        return self.N
+
+    def add(self, phases):
+        phases = np.asarray(phases)
+        if self.method == 'fft':
+            self.folded += fft_fold(phases, self.fft_nbins)
+        elif self.method == 'harmonic':
+            self.moments += smu.trig_moments(phases, self.log_nharm)
+        else:
+            self.loglikes += [ calc_prob(phases, offset, self.prof_mod) for offset in self.offsets ]
+        self.N += len(phases)
+        return self
+
+    def merge(self, other):
+        if self.method == 'fft':
+            self.folded += other.folded
+        elif self.method == 'harmonic':
+            self.moments += other.moments
+        else:
+            self.loglikes += other.loglikes
+        self.N += other.N
+        return self
+
+    def likelihood(self):
+        """
+        Returns a function giving the log-likelihood of a single offset (see
+            loglike_func). Not available for the 'direct' method, which only
+            keeps the grid of offsets.
+        """
+        if self.method == 'fft':
+            centres = (np.arange(self.fft_nbins) + 0.5) / self.fft_nbins
+            return lambda offset: np.dot(self.folded, np.log(self.prof_mod(centres - offset)))
+        elif self.method == 'harmonic':
+            return HarmonicLikelihood(None, self.prof_mod, nharm=self.log_nharm,
+                                      moments=self.moments, N=self.N)
+        raise ValueError("The 'direct' likelihood can not be evaluated at any offset " \
+                         "from accumulated chunks")
+
+    @property
+    def value(self):
+        """
+        The trial offsets, their log-likelihoods and the offset step, as
+            computed by calc_toa_offset.
+        """
+        if self.method == 'fft':
+            offsets, loglikes = fft_loglikes(self.folded, self.prof_mod)
+            return offsets, loglikes, 1.0 / self.fft_nbins
+        elif self.method == 'harmonic':
+            offsets = np.append(np.arange(0,1,0.001), 1.0)
+            return offsets, self.likelihood()(offsets), 0.001
+        return self.offsets, self.loglikes, 0.001
+
+def loglike_func(phases, prof_mod, method='direct', fft_nbins=16384, log_nharm=64):
+    """
+    Returns a function giving the log-likelihood of a single offset for the given
+        likelihood method (see calc_toa_offset). The data-dependent work (binning
+        or trigonometric moments) is done once, here.
+    """
+    if isinstance(phases, LoglikeAccumulator):
+        return phases.likelihood()
+    if method == 'fft':
+        folded = fft_fold(phases, fft_nbins)
+        centres = (np.arange(fft_nbins) + 0.5) / fft_nbins
+        return lambda offset: np.dot(folded, np.log(prof_mod(centres - offset)))
+    elif method == 'harmonic':
+        return HarmonicLikelihood(phases, prof_mod, nharm=log_nharm)
+    elif method == 'direct':
+        return lambda offset: calc_prob(phases, offset, prof_mod)
+    else:
+        raise ValueError("Unknown likelihood method '%s'" % method)
+
+class PSRpar(smu.Ephemeris):
     """
     This class contains all the relevant information for
-        extracting a TOA, which is extracted from a .par file.
+        extracting a TOA, which is extracted from a .par file
+        (see utils.Ephemeris, the par file is parsed once and cached).
         Currently, this supports up to 12 frequency derivatives
-        but NO GLITCH PARAMETERS (yet).
+        and glitches (GLEP_n, GLPH_n, GLF0_n, GLF1_n, GLF2_n, GLF0D_n, GLTD_n).
     """
     def __init__(self,parfile):
-        pars = smu.read_parfile(parfile)
-        self.epoch = pars['PEPOCH'].value
-        self.f0 = pars['F0'].value
-
-        self.fdots = np.zeros(12)
-        for i in range(12):
-            fdot_name = 'F' + str(i+1)
-            if fdot_name in pars.keys():
-                self.fdots[i] = pars[fdot_name].value
-
-    def __repr__(self):
-        return repr((self.f0, self.fdots, self.epoch))
+        eph = smu.read_ephemeris(parfile)
+        smu.Ephemeris.__init__(self, eph.epoch, eph.f0, eph.fdots, pars=eph.pars,
+                               glitches=eph.glitches)
 
 def get_error(offsets, prob, del_off, debug=False):
     """
@@ -73,10 +312,10 @@ def get_error(offsets, prob, del_off, debug=False):
         those two points as the sigma of the distribution.
     """
     maxoff = offsets[np.argmax(prob)]
-    prob_centered = np.roll(prob, len(offsets)/2 - np.argmax(prob))
+    prob_centered = np.roll(prob, len(offsets)//2 - np.argmax(prob))
 
     cum_prob = np.cumsum(prob_centered)*del_off
-    area_to_center = cum_prob[len(offsets)/2]
+    area_to_center = cum_prob[len(offsets)//2]
 
     lower_area = area_to_center - 0.341
     upper_area = area_to_center + 0.341
@@ -102,7 +341,7 @@ def get_error_gaussfit(offsets, prob, del_off, debug=False):
     """
 
     maxoff = offsets[np.argmax(prob)]
-    prob_centered = np.roll(prob, len(offsets)/2 - np.argmax(prob))
+    prob_centered = np.roll(prob, len(offsets)//2 - np.argmax(prob))
 
     p0 = 0.05
     errfunc = lambda p, x, y: (y - stats.norm.pdf(x, loc=0.5, scale=p))
@@ -119,7 +358,144 @@ def get_error_gaussfit(offsets, prob, del_off, debug=False):
 
     return maxoff, sigma
 
-def sim_error(prof_mod,N_counts,phases,from_template=True, debug=False):
+def get_error_curvature(loglike, ncoarse=128, debug=False):
+    """
+    Finds the most probable offset with a coarse-to-fine search and takes the
+        error from the curvature of the log-likelihood at the peak,
+        sigma = 1/sqrt(-d^2 logL / d offset^2).
+
+        The log-likelihood is scanned on ncoarse offsets, then the maximum is
+        refined with a bounded 1-D optimiser within one coarse step on either side.
+        The curvature is analytic for a HarmonicLikelihood and otherwise from
+        finite differences on a scale of half the error.
+    """
+    coarse = np.arange(ncoarse) / float(ncoarse)
+    step = 1.0 / ncoarse
+    coarse_probs = np.array([loglike(offset) for offset in coarse])
+    best = coarse[np.argmax(coarse_probs)]
+
+    output = optimize.minimize_scalar(lambda x: -loglike(x), bounds=(best-step, best+step),
+                                      method='bounded', options={'xatol':1e-8})
+    maxoff = output.x
+
+    if hasattr(loglike, 'curvature'):
+        curv = loglike.curvature(maxoff)
+    else:
+        h = step / 4.0
+        for i in range(2):
+            curv = (loglike(maxoff+h) - 2*loglike(maxoff) + loglike(maxoff-h)) / h**2
+            if curv >= 0:
+                break
+            h = max(0.5 / np.sqrt(-curv), 1e-5) # rescale to the width of the peak
+
+    if curv < 0:
+        sigma = 1.0 / np.sqrt(-curv)
+    else:
+        sys.stderr.write('Warning: log-likelihood is not peaked at offset %f, ' \
+                         'no curvature error.\n' % (maxoff % 1.0))
+        sigma = np.nan
+
+    if debug:
+        plt.plot(coarse, coarse_probs - coarse_probs.max())
+        plt.errorbar(maxoff % 1.0, 0, xerr=sigma, fmt='o')
+        plt.show()
+
+    return maxoff % 1.0, sigma
+
+def harmonic_peaks(moments, prof_mod, nharm=64, niter=10):
+    """
+    Most probable offsets for many sets of phases at once, given their
+        trigonometric moments as an (nsets, nharm) array (see HarmonicLikelihood).
+        The maximum of each set is found on a grid and refined with Newton
+        iterations, all vectorised over sets.
+    """
+    coeffs = model_profile.log_harmonics(prof_mod, nharm)
+    k = np.arange(1, nharm+1)
+    weights = coeffs[1:] * moments
+
+    ngrid = 8 * nharm
+    grid = np.arange(ngrid) / float(ngrid)
+    loglikes = np.real(np.dot(weights, np.exp(-2.j*np.pi*np.outer(k, grid))))
+    offsets = grid[np.argmax(loglikes, axis=1)]
+
+    for i in range(niter):
+        phasors = weights * np.exp(-2.j*np.pi*offsets[:,None]*k)
+        d1 = np.real(np.sum(phasors * (-2.j*np.pi*k), axis=1))
+        d2 = np.real(np.sum(phasors * (-2.j*np.pi*k)**2, axis=1))
+        step = d1 / d2
+        step[~(np.abs(step) < 1.0 / ngrid)] = 0.0
+        offsets -= step
+
+    return offsets % 1.0
+
+def fft_peaks(folded, prof_mod):
+    """
+    Most probable offsets for many sets of phases at once, given their
+        histograms on a fine grid as an (nsets, nbins) array (see calc_probs_fft).
+    """
+    nbins = folded.shape[1]
+    centres = (np.arange(nbins) + 0.5) / nbins
+    logprof = np.log(prof_mod(centres))
+    loglikes = np.fft.irfft(np.fft.rfft(folded, axis=1) * np.conj(np.fft.rfft(logprof)),
+                            nbins, axis=1)
+    return np.argmax(loglikes, axis=1) / float(nbins)
+
+def direct_peaks(phases, owner, nsets, prof_mod, block=2**22):
+    """
+    Most probable offsets on the 1001-offset grid of the direct method of
+        calc_toa_offset for nsets sets of phases at once (owner is the set
+        of each phase, in increasing order), with about block template
+        evaluations in memory at a time.
+    """
+    offsets = np.append(np.arange(0,1,0.001), 1.0)
+    bounds = np.searchsorted(owner, np.arange(nsets+1))
+    step = max(1, block // len(offsets))
+    peaks = np.empty(nsets)
+    for k in range(nsets):
+        loglikes = np.zeros(len(offsets))
+        for start in range(bounds[k], bounds[k+1], step):
+            p = phases[start:min(start+step, bounds[k+1])]
+            probs = prof_mod((p[None,:] - offsets[:,None]).ravel())
+            loglikes += np.log(probs).reshape(len(offsets), len(p)).sum(axis=1)
+        peaks[k] = offsets[np.argmax(loglikes)]
+    return peaks
+
+def _sim_batch(setup, args):
+    """
+    Simulates one batch of nsims realisations with its own random stream and
+        returns their offsets and the wall time taken (a task of sim_error).
+    """
+    nsims, seed = args
+    starttime = time.time()
+    prof_mod, N_counts, folded, method, fft_nbins, log_nharm = setup
+    rng = np.random.RandomState(seed)
+
+    if folded is None:
+        simmed = smu.randomvariate(prof_mod,nsims*N_counts,rng=rng)
+        owner = np.repeat(np.arange(nsims), N_counts)
+    else:
+        # realisations have different numbers of counts
+        simmed, owner = smu.events_from_binned_profiles(rng.poisson(folded, (nsims, len(folded))),
+                                                        rng=rng)
+
+    if method == 'fft':
+        idx = np.floor(simmed*fft_nbins).astype(int) % fft_nbins
+        sim_folded = np.bincount(owner*fft_nbins + idx, minlength=nsims*fft_nbins)
+        batch_offsets = fft_peaks(sim_folded.reshape(nsims, fft_nbins), prof_mod)
+    elif method == 'direct':
+        batch_offsets = direct_peaks(simmed, owner, nsims, prof_mod)
+    else:
+        if folded is None:
+            moments = smu.trig_moments(simmed.reshape(nsims,N_counts), log_nharm)
+        else:
+            moments = smu.trig_moments(simmed, log_nharm, owner=owner, nsets=nsims)
+        batch_offsets = harmonic_peaks(moments, prof_mod, nharm=log_nharm)
+
+    return batch_offsets, time.time() - starttime
+
+def sim_error(prof_mod,N_counts,phases,from_template=True, debug=False, method='direct',
+              N_sim=1000, seed=None, batch_size=None, fft_nbins=16384, log_nharm=64,
+              nworkers=1):
     """
     Estimate the error using simulations.
         Pulls N_counts random phases from the template where N_counts
@@ -128,30 +504,44 @@ def sim_error(prof_mod,N_counts,phases,from_template=True, debug=False):
         This is done N_sim number of times, and an offset between
         the template and each simulated profile is measured.
 
+        The realisations are drawn batch_size at a time as one 2-D array and
+        their offsets are measured with the likelihood of method, as in
+        calc_toa_offset (see direct_peaks, fft_peaks and harmonic_peaks).
+        The 'fft' and 'harmonic' methods measure a whole batch at once and
+        are much faster than 'direct'.
+
+        With nworkers > 1 the batches are spread over a pool of processes
+        (see utils.pool_map). Every batch draws from its own random stream,
+        seeded from one drawn with seed, so for a given seed the result does
+        not depend on nworkers.
+
         The standard deviation of the offsets is returned.
     """
-    sim_offsets = []
-    N_sim = 1000
+    N_counts = int(round(N_counts))
     N_bins = 32
-    run = 0
+
+    if batch_size is None:
+        batch_size = max(1, min(N_sim, int(4e6 // max(N_counts,1))))
 
     if not from_template:
-        bins = np.linspace(0,1,N_bins+1)
-        folded = np.histogram(phases,bins)[0]
+        folded = smu.fold_phases(phases, nbins=N_bins)[1]
+    else:
+        folded = None
 
-    while run < N_sim:
-        sys.stderr.write("Sim %d %% Complete \r" % (run*100.0/N_sim))
-        sys.stderr.flush()
+    nbatches = int(np.ceil(N_sim / float(batch_size)))
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, nbatches)
+    tasks = [ (min(batch_size, N_sim - i*batch_size), seeds[i]) for i in range(nbatches) ]
+    setup = (prof_mod, N_counts, folded, method, fft_nbins, log_nharm)
+    results = smu.pool_map(_sim_batch, tasks, setup=setup, nworkers=nworkers)
 
-        if from_template:
-            simmed_phases = smu.randomvariate(prof_mod,N_counts)
-        else:
-            folded = np.random.poisson(folded)
-            simmed_phases = smu.events_from_binned_profile(folded)
+    sim_offsets = []
+    for ibatch, (batch_offsets, walltime) in enumerate(results):
+        sim_offsets.extend((batch_offsets+0.5) % 1.0)
+        sys.stderr.write("Sim batch %d/%d: %d sims in %.2f s (%d %% Complete)\n" % \
+                         (ibatch+1, nbatches, len(batch_offsets), walltime, len(sim_offsets)*100.0/N_sim))
+        sys.stderr.flush()
 
-        sim_offset, sim_error = calc_toa_offset(simmed_phases,prof_mod,no_err=True)
-        sim_offsets.append((sim_offset+0.5) % 1.0)
-        run += 1
+    sim_offsets = np.array(sim_offsets)
 
     if debug:
         median = np.median(sim_offsets)
@@ -161,20 +551,25 @@ def sim_error(prof_mod,N_counts,phases,from_template=True, debug=False):
         print( "MAD offsets",mad)
         plt.show()
 
-    sys.stderr.write("Sim 100%% Complete \n")
     return np.std(sim_offsets)
 
-def correct_model(phases,prof_mod):
+def correct_model(phases,prof_mod,folded=None):
     """
     Correct the model profile to match the pulsed fraction of the data.
         The should be used when the pulsed fraction of the source is varying
         substantially (e.g. during a magnetar outburst).
+
+        The phases are folded on 32 fixed bins between 0 and 1, not over
+        the range of the phases; folded can be that profile if already
+        folded (see utils.fold_phases_multi).
     """
     import fluxtool
 
     nbins = 32
     harmonics = 5
-    folded = np.histogram(phases,nbins)
+    if folded is None:
+        folded = smu.fold_phases_multi(phases, [nbins])[0]
+    folded = (folded, np.linspace(0,1,nbins+1))
     uncertainties = np.sqrt(folded[0])
 
     # model pulsed flux from fourier components
@@ -204,38 +599,97 @@ def correct_model(phases,prof_mod):
 
 
 def calc_toa_offset(phases, prof_mod, sim_err=False, no_err=False,
-                    gauss_err=False, bg_counts=0, debug=False, bright = False):
+                    gauss_err=False, bg_counts=0, debug=False, bright = False,
+                    method='direct', fft_nbins=16384, log_nharm=64, curv_err=False,
+                    N_sim=1000, sim_seed=None, nworkers=1, folded=None):
     """
     Calculate an offset between the observation pulse profile and the template pulse profile.
        This is done using the raw events (as phases) and a continuous model of the template
        (prof mod) which is used as a probability distribution.
 
        The error in the offset can be determined by integrating the resulting likelihood
-       distribution or by using simulations (by setting sim_err=True).
+       distribution or by using simulations (by setting sim_err=True, see sim_error
+       for N_sim, sim_seed and nworkers). With curv_err=True
+       the full offset grid is skipped: the peak is found with a coarse-to-fine search and
+       the error is taken from the curvature of the log-likelihood (see get_error_curvature).
 
        The simulations use the total number of source counts, which for low S/N the contribution
        from the background can be large, so bg_counts (set to number of background counts
        expected in the source extraction region) can be used to correct for that.
+
+       The likelihood is evaluated with one of the following methods:
+           'direct' - every photon for each of 1001 trial offsets (default)
+           'fft' - phases binned onto fft_nbins bins and all offsets computed
+                   at once by FFT cross-correlation (see calc_probs_fft)
+           'harmonic' - the first log_nharm trigonometric moments of the phases,
+                        for smooth templates (see HarmonicLikelihood)
+
+       With bright=True the phases are folded onto 1024 fixed bins between 0
+       and 1 first, not over the range of the phases (folded can be that
+       profile if already folded, see utils.fold_phases_multi); it can not be
+       combined with curv_err.
+
+       phases can also be a LoglikeAccumulator to which the phases were added
+       chunk by chunk, in which case its method is used (and bright ignored).
     """
     global calcprobtime
     global logsumtime
     global integratetime
 
-    probs = []
-    del_off = 0.001
-    offsets = np.arange(0,1,del_off)
-    offsets = np.append(offsets,1.0)
+    if isinstance(phases, LoglikeAccumulator):
+        method = phases.method
+
+    if curv_err:
+        if bright:
+            raise ValueError("bright can not be used with curv_err: the curvature search " \
+                             "evaluates the likelihood of the unbinned phases")
+        starttime = time.time()
+        maxoff, error = get_error_curvature(loglike_func(phases, prof_mod, method=method,
+                                                         fft_nbins=fft_nbins, log_nharm=log_nharm),
+                                            debug=debug)
+        calcprobtime += time.time() - starttime
+        if sim_err:
+            error = sim_error(prof_mod,len(phases)-bg_counts,phases,
+                              from_template=True, debug=debug, method=method,
+                              N_sim=N_sim, seed=sim_seed, fft_nbins=fft_nbins, log_nharm=log_nharm,
+                          nworkers=nworkers)
+        elif no_err:
+            error = None
+        return maxoff, error
 
     starttime = time.time()
-    if bright:
-        folded = np.histogram(phases, 1024)
-        sys.stderr.write('WARNING: BRIGHT ON!')
-    for offset in offsets:
+    if isinstance(phases, LoglikeAccumulator):
+        offsets, probs, del_off = phases.value
+        if method == 'harmonic':
+            like = phases.likelihood()
+    elif method == 'fft':
+        offsets, probs = calc_probs_fft(phases, prof_mod, nbins=fft_nbins)
+        del_off = 1.0 / fft_nbins
+    elif method == 'harmonic':
+        like = HarmonicLikelihood(phases, prof_mod, nharm=log_nharm)
+        del_off = 0.001
+        offsets = np.arange(0,1,del_off)
+        offsets = np.append(offsets,1.0)
+        probs = like(offsets)
+    elif method == 'direct':
+        probs = []
+        del_off = 0.001
+        offsets = np.arange(0,1,del_off)
+        offsets = np.append(offsets,1.0)
+
         if bright:
-            prob = calc_prob_bright(folded, offset, prof_mod)
-        else:
-            prob =  calc_prob(phases, offset, prof_mod)
-        probs.append(prob)
+            if folded is None:
+                folded = smu.fold_phases_multi(phases, [1024])[0]
+            folded = (folded, np.linspace(0,1,1025))
+            sys.stderr.write('WARNING: BRIGHT ON!')
+        for offset in offsets:
+            if bright:
+                prob = calc_prob_bright(folded, offset, prof_mod)
+            else:
+                prob =  calc_prob(phases, offset, prof_mod)
+            probs.append(prob)
+    else:
+        raise ValueError("Unknown likelihood method '%s'" % method)
     calcprobtime += time.time() - starttime
 
     # normalise as likelihood with logsumexp
@@ -255,7 +709,9 @@ def calc_toa_offset(phases, prof_mod, sim_err=False, no_err=False,
     if sim_err:
         maxoff = offsets[np.argmax(probs)]
         error = sim_error(prof_mod,len(phases)-bg_counts,phases,
-                          from_template=True, debug=debug)
+                          from_template=True, debug=debug, method=method,
+                          N_sim=N_sim, seed=sim_seed, fft_nbins=fft_nbins, log_nharm=log_nharm,
+                          nworkers=nworkers)
     elif no_err:
         maxoff = offsets[np.argmax(probs)]
         error = None
@@ -264,27 +720,67 @@ def calc_toa_offset(phases, prof_mod, sim_err=False, no_err=False,
     else:
         maxoff, error = get_error(offsets, probs_norm, del_off, debug=debug)
 
+    if method == 'harmonic':
+        maxoff = like.peak()
+
     return maxoff, error
 
+def _split_events(fits_fn, scope):
+    """
+    The events of fits_fn for split_photons and split_n_days: an event file,
+        or a text file listing event files, which are merged.
+    """
+    if events.is_event_file(fits_fn):
+        return smu.event_list(fits_fn, scope=scope)
+    return smu.event_list(events.read_file_list(fits_fn), scope=scope)
+
+def _sorted_times(times):
+    """
+    Two-part times (mjdi, sec) (see utils.fits2times) sorted in time.
+    """
+    order = np.lexsort((times[1], times[0]))
+    return times[0][order], times[1][order]
+
+def _slice_times(times, start, stop):
+    return times[0][start:stop], times[1][start:stop]
+
+def _split_times(times, sections, stop):
+    """
+    np.split of the first stop two-part times (mjdi, sec) into sections
+        (a number of equal parts or the indices to split at).
+    """
+    return list(zip(np.split(times[0][:stop], sections), np.split(times[1][:stop], sections)))
+
 def get_ml_toa(fits_fn, prof_mod, parfile, scope='swift', print_offs=None,
                frequency=None,fdot=None, epoch=None,  sim=False, bg_counts=0, Emin=None,
                Emax=None, gauss_err=False, tempo2=False, debug=False, split_n_days=None,
-               correct_pf=False, split_num=None, split_orbits=False,split_photons=None, writefile=False, bright=False):
-
+               correct_pf=False, split_num=None, split_orbits=False,split_photons=None, writefile=False, bright=False,
+               method='direct', curv_err=False, N_sim=1000, sim_seed=None, nworkers=1,
+               par=None, writer=None, chunk_size=None):
+    """
+    Measure the TOA(s) of an event file (or list of event files for split_n_days
+        and split_photons) against a template. Returns a list of utils.TOA records.
+
+        With chunk_size the events are streamed chunk_size at a time into a
+        LoglikeAccumulator rather than read and phased all at once (not with
+        the split, correct_pf or bright options, nor with curv_err for the
+        'direct' method). The first read of a file still builds its event
+        cache in memory (see events.EventList.chunks).
+
+        par can be an already parsed PSRpar (or utils.Ephemeris) to avoid re-reading
+        parfile. If a utils.TimWriter is given as writer the TOAs are added to it, otherwise
+        they are written in tempo2 or Princeton format to writefile (or printed).
+    """
     print_timings = False # if want to print summary of runtime
     if split_n_days==None and split_photons==None:
-        fits = pyfits.open(fits_fn)
-        t = smu.fits2times(fits_fn, scope=scope, Emin=Emin, Emax=Emax)
-
-    #if scope != 'chandra':
-    #    exposure = fits[0].header['EXPOSURE']
-
-        try:
-            obsid = fits[0].header['OBS_ID']
-        except KeyError:
-            obsid = os.path.basename(fits_fn)
+        evts = smu.event_list(fits_fn, scope=scope)
+        if not chunk_size:
+            times = smu.fits2times(evts, scope=scope, Emin=Emin, Emax=Emax, split_mjd=True)
+        obsid = evts.obsid
     else:
         obsid = 'split_'+str(split_n_days)+'_days'
+        times = _sorted_times(smu.fits2times(_split_events(fits_fn, scope), scope=scope,
+                                             Emin=Emin, Emax=Emax, split_mjd=True))
 
     if bg_counts < 0:
         bg_scale = -1.0*bg_counts
@@ -294,64 +790,52 @@ def get_ml_toa(fits_fn, prof_mod, parfile, scope='swift', print_offs=None,
         print('BG Counts:',bg_counts)
         bg_fits.close()
     if frequency and epoch:
-        par = lambda: None
-        par.epoch = epoch
-        par.f0 = frequency
-        par.fdots = [fdot,0.0,0.0,0.0,0.0,0.0,0.0,0.0,0.0]
-    else:
+        par = smu.Ephemeris(epoch, frequency, [fdot if fdot else 0.0])
+    elif par is None:
         par = PSRpar(parfile)
 
-    # split times into multiple arrays if needed
-    if split_orbits:
+    # split times into multiple arrays if needed: the splits are found on the
+    # MJDs, and the two-part times (mjdi, sec) are sliced at the same events
+    t = None if chunk_size else times[0] + times[1] / SECPERDAY
+    if chunk_size:
+        if split_orbits or split_num or split_photons or split_n_days or correct_pf or bright:
+            raise ValueError("chunk_size can not be used with the split, correct_pf or bright options")
+        if curv_err and method == 'direct':
+            raise ValueError("curv_err with chunk_size needs method='fft' or 'harmonic': the " \
+                             "'direct' likelihood of streamed chunks is only kept on the grid " \
+                             "of offsets")
+        ts = [None]
+
+    elif split_orbits:
         dt = t[1:] - t[:-1]
         splits = np.where(dt > 0.0116)[0] # 1 ks in days
         if len(splits):
-            ts = [ t[:splits[0]] ]
+            ts = [ _slice_times(times, 0, splits[0]) ]
             for i in range(len(splits)-1):
-                ts.append(t[splits[i]+1:splits[i+1]])
-            ts.append(t[splits[-1]+1:])
+                ts.append(_slice_times(times, splits[i]+1, splits[i+1]))
+            ts.append(_slice_times(times, splits[-1]+1, len(t)))
         else:
-            ts = np.atleast_2d(t)
+            ts = [times]
 
     elif split_num:
         remainder = len(t) % split_num
         if remainder:
             sys.stderr.write("Warning: Number of events in %s not divisable by %d. " \
                              "Dropping last %d events.\n" % (obsid, split_num, remainder))
-            ts = np.split(t[:-remainder],split_num)
-        else:
-            ts = np.split(t,split_num)
+        ts = _split_times(times, split_num, len(t) - remainder)
 
     elif split_photons:
-        t=np.zeros(0)
-        try:
-            fits_files = np.loadtxt(fits_fn, dtype='S')
-            for fit in fits_files:
-                t = np.append(t, smu.fits2times(fit, scope=scope, Emin=Emin, Emax=Emax))
-        except (ValueError):
-             t = np.append(t, smu.fits2times(fits_fn, scope=scope, Emin=Emin, Emax=Emax))
-        t.sort()
-        n_toas = len(t)/split_photons
+        n_toas = len(t)//split_photons
         if n_toas == 0:
-           ts = np.split(t,1)
+           ts = [times]
         else:
             remainder = len(t) % n_toas
             if remainder:
                 sys.stderr.write("Warning: Number of events in %s not divisable by %d. " \
                                  "Dropping last %d events.\n" % (obsid, n_toas, remainder))
-                ts = np.split(t[:-remainder],n_toas)
-            else:
-                ts = np.split(t,n_toas)
+            ts = _split_times(times, n_toas, len(t) - remainder)
 
     elif split_n_days:
-        t=np.zeros(0)
-        fits_files = np.loadtxt(fits_fn, dtype='S')
-        try:
-            for fit in fits_files:
-                t = np.append(t, smu.fits2times(fit, scope=scope, Emin=Emin, Emax=Emax))
-        except (Exception):
-             t = np.append(t, smu.fits2times(fits_files.tostring(), scope=scope, Emin=Emin, Emax=Emax))
-        t.sort()
         dt=t[1:]-t[:-1]
         splits = np.where(dt>0.0116)[0] # 1 ks in days 0.0116
         newsplit=[]
@@ -359,14 +843,15 @@ def get_ml_toa(fits_fn, prof_mod, parfile, scope='swift', print_offs=None,
         while(gaps[-1]>split_n_days):
             newsplit.append(splits[np.where(gaps>split_n_days)[0][0]])
             gaps=gaps-gaps[np.where(gaps>split_n_days)[0][0]]
-        ts=np.split(t, np.array(newsplit)+1)
+        ts=_split_times(times, np.array(newsplit)+1, len(t))
 
     else:
-        ts = np.atleast_2d(t)
+        ts = [times]
 
     if len(ts) > 1 and debug:
         plt.figure()
-        for t in ts:
+        for mjdi, sec in ts:
+            t = mjdi + sec / SECPERDAY
             nbins = int((t[-1] - t[0]) * 8640.0)
             hist = np.histogram(t,bins=nbins)
             plt.plot(hist[1][:-1],hist[0],c='b')
@@ -375,33 +860,48 @@ def get_ml_toa(fits_fn, prof_mod, parfile, scope='swift', print_offs=None,
         plt.show()
 
 
+    toas = []
     for i,t in enumerate(ts):
         if split_n_days:
             sys.stderr.write('Measuring TOA #%d of %d\n' % (i+1,len(ts)))
         else:
             sys.stderr.write('Measuring TOA #%d for %s\n' % (i+1,obsid))
-        phases = smu.times2phases(t, parfile)
+        if t is None:
+            phases = LoglikeAccumulator(prof_mod.prof_mod, method=method)
+            first = None
+            for mjdi, sec in evts.chunks(Emin, Emax, chunk_size=chunk_size, split_mjd=True):
+                if len(mjdi):
+                    phases.add(par.phase(mjdi, sec=sec))
+                    if first is None:
+                        first = mjdi[:1], sec[:1]
+                    last = mjdi[-1:], sec[-1:]
+            if first is None:
+                raise ValueError("No events in %s between Emin=%s and Emax=%s" % \
+                                 (fits_fn, Emin, Emax))
+            t = np.append(first[0], last[0]), np.append(first[1], last[1])
+        else:
+            phases = par.phase(t[0], sec=t[1])
 
+        # fold once for both the PF correction and the bright likelihood
+        folds = [None, None]
+        if correct_pf and bright and method == 'direct' and not curv_err:
+            folds = smu.fold_phases_multi(phases, [32, 1024])
         if correct_pf:
-            old_model, new_model, corr_folded = correct_model(phases,prof_mod)
-        maxoff, error = calc_toa_offset(phases,prof_mod.prof_mod,sim_err=sim,bg_counts=bg_counts, gauss_err=gauss_err, debug=debug, bright=bright)
-        midtime = (t[-1]+t[0])/2.0
-        p_mid = 1.0/smu.calc_freq(midtime, par.epoch, par.f0, par.fdots[0], par.fdots[1], par.fdots[2], par.fdots[3],
-                                        par.fdots[4], par.fdots[5], par.fdots[6], par.fdots[7], par.fdots[8])
-
-        t0 = smu.calc_t0(midtime, par.epoch, par.f0, par.fdots[0], par.fdots[1], par.fdots[2], par.fdots[3],
-                               par.fdots[4], par.fdots[5], par.fdots[6], par.fdots[7], par.fdots[8])
-        t0i = int(t0)
-        t0f = t0 - t0i
-
-        toaf = t0f + maxoff*p_mid / SECPERDAY
-        newdays = int(np.floor(toaf))
-
-
-        if tempo2:
-            smu.write_tempo2_toa(t0i+newdays, toaf-newdays, error*p_mid*1.0e6, 0000, 0.0, name=obsid, writefile=writefile)
-        else:
-            smu.write_princeton_toa(t0i+newdays, toaf-newdays, error*p_mid*1.0e6, 0000, 0.0, name=obsid)
+            old_model, new_model, corr_folded = correct_model(phases,prof_mod,folded=folds[0])
+        maxoff, error = calc_toa_offset(phases,prof_mod.prof_mod,sim_err=sim,bg_counts=bg_counts, gauss_err=gauss_err, debug=debug, bright=bright, method=method, curv_err=curv_err,
+                                       N_sim=N_sim, sim_seed=sim_seed, nworkers=nworkers, folded=folds[1])
+        # the TOA is the pulse (at maxoff) closest before the middle of the
+        # events, kept as integer day and seconds
+        mid_day = t[0][0]
+        mid_sec = t[1][0] + ((t[0][-1] - t[0][0])*SECPERDAY + (t[1][-1] - t[1][0])) / 2.0
+        p_mid = 1.0/par.freq(mid_day, sec=mid_sec)
+
+        toa_sec = mid_sec + (maxoff - par.phase(mid_day, sec=mid_sec))*p_mid
+        newdays = np.floor(toa_sec / SECPERDAY)
+
+        toas.append(smu.TOA(int(mid_day+newdays), (toa_sec - newdays*SECPERDAY) / SECPERDAY,
+                            error*p_mid*1.0e6, offset=maxoff,
+                            counts=len(phases), obsid=obsid, index=i))
 
         if print_offs:
             offs_file = open(print_offs,'a')
@@ -409,8 +909,6 @@ def get_ml_toa(fits_fn, prof_mod, parfile, scope='swift', print_offs=None,
             offs_file.write(fits_fn + "\t" + str(maxoff) + "\t" + str(error) + "\n")
             #print obsid,"\tOffset:",maxoff,"+/-",error
             offs_file.close()
-        if split_n_days==None and split_photons==False:
-            fits.close()
 
 
         #double check PF correction with measuring binned model pulsed fraction
@@ -435,3 +933,40 @@ def get_ml_toa(fits_fn, prof_mod, parfile, scope='swift', print_offs=None,
         sys.stderr.write('\tCalc Prob: %f s\n' % calcprobtime)
         sys.stderr.write('\tLog Sum: %f s\n' % logsumtime)
         sys.stderr.write('\tIntegrate Norm: %f s\n' % integratetime)
+
+    if writer is None:
+        writer = smu.TimWriter(tempo2=tempo2)
+        writer.add(toas)
+        writer.write(writefile, header=bool(writefile))
+    else:
+        writer.add(toas)
+
+    return toas
+
+
+def _toa_task(setup, fits_fn):
+    """
+    Measures the TOA(s) of one event file (a task of get_ml_toas).
+    """
+    prof_mod, parfile, par, kwargs = setup
+    writer = smu.TimWriter()
+    get_ml_toa(fits_fn, prof_mod, parfile, par=par, writer=writer, **kwargs)
+    return writer.toas
+
+def get_ml_toas(fits_fns, prof_mod, parfile, nworkers=1, **kwargs):
+    """
+    Measure the TOAs of many event files with get_ml_toa, on nworkers
+        processes. The template and ephemeris are loaded once and shared with
+        the workers; kwargs are passed on to get_ml_toa (simulations within
+        each file run serially when nworkers > 1).
+
+        Returns a list of (fits_fn, toas, error), see utils.map_files, where
+        toas are the utils.TOA records of that file (empty if it failed).
+    """
+    par = PSRpar(parfile) if parfile else None
+    if nworkers > 1:
+        kwargs['nworkers'] = 1
+    results = smu.map_files(_toa_task, fits_fns, setup=(prof_mod, parfile, par, kwargs),
+                            nworkers=nworkers, action='get TOA for')
+    return [ (fits_fn, toas if toas is not None else [], error)
+             for fits_fn, toas, error in results ]
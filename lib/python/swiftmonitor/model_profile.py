@@ -5,6 +5,7 @@ import types
 import pickle
 import matplotlib.pyplot as plt
 import inspect
+from swiftmonitor.utils import cached_on
 verbose=False
 
 def find_model(model_name):
@@ -33,6 +34,22 @@ def list_models():
 
   return models
 
+def log_harmonics(prof_mod, nharm=64):
+  """
+  Returns the complex Fourier coefficients a_k (k=0..nharm) of the log of
+    a profile model, ln(prof_mod(x)) ~ sum_k a_k exp(2j*pi*k*x) over k=-nharm..nharm
+    with a_-k = conj(a_k).
+
+    The log of a smooth template (e.g. a Fourier_Model) is well described by
+    a few tens of harmonics; sharply peaked templates need more.
+  """
+  def build():
+    nsamp = max(1024, 8*nharm)
+    x = np.arange(nsamp) / float(nsamp)
+    return np.fft.rfft(np.log(prof_mod(x)))[:nharm+1] / nsamp
+
+  return cached_on(prof_mod, ('log_harmonics', nharm), build)
+
 class Profile_Model():
   @classmethod
   def get_name(cls):
@@ -3,7 +3,7 @@ import numpy as np
 import subprocess, re, pickle
 import astropy.io.fits as pyfits
 import swiftmonitor.config
-from swiftmonitor import ftools, utils
+from swiftmonitor import ftools, utils, decompress
 
 class TableDownError(Exception):
   def __str__(self):
@@ -198,6 +198,10 @@ class Observation:
     self.obsfile = obsfile
     self.obsroot = obsfile.split('.')[0]
 
+    # decompress both once now, for the later stages (see decompress)
+    decompress.decompress_files([ self.path + fn for fn in (obsfile, orbitfile) \
+                                  if os.path.exists(self.path + fn) ])
+
   def download_raw(self):
     print "Querying HEASARC...\n"
   
@@ -269,8 +273,11 @@ class Observation:
 
     event_file = glob.glob(os.path.join(self.path,'raw/xrt/event/sw' + self.obsid + \
                                         'x' + self.mode + '??po_cl.evt.gz'))[0]
+    auxil_files = [ fn for fn in (event_file, self.attfile, self.hdfile) if fn ]
+    event_file = decompress.decompress_files(auxil_files)[0]
     fits = pyfits.open(event_file)
     date_obs = fits[0].header['DATE-OBS']
+    fits.close()
 
     date_obs_split = date_obs.strip().strip('\'').split("T")
 
@@ -288,7 +295,7 @@ class Observation:
     if self.ra and self.dec:
         cmd += ' srcra=%s srcdec=%s' % (self.ra, self.dec)
     if self.attfile:
-        cmd += ' attfile=%s' % self.attfile
+        cmd += ' attfile=%s' % decompress.decompressed(self.attfile)
 
     cmd += " %s > %s/xrtpipeline.log" % (xrtpipeline_args, self.path)
     timed_execute(cmd)
@@ -323,8 +330,8 @@ class Observation:
     self.baryfile = self.obsroot + '_bary.evt'
 
     outfile = os.path.join(self.path,self.baryfile)
-    infile = os.path.join(self.path,self.obsfile)
-    orbitfile = os.path.join(self.path,self.orbitfile)
+    infile = decompress.decompressed(os.path.join(self.path,self.obsfile))
+    orbitfile = decompress.decompressed(os.path.join(self.path,self.orbitfile))
 
     if RA and Dec:
       ftools.barycentre(infile, outfile, orbitfile, RA=RA, Dec=Dec)
@@ -574,7 +581,8 @@ class Observation:
 
         else:
 
-            ftools.make_expomap(split_file, self.attfile, self.hdfile)
+            ftools.make_expomap(split_file, decompress.decompressed(self.attfile), \
+                                decompress.decompressed(self.hdfile))
             offaxis_angle = ftools.calc_offaxis_angle(self.ra, self.dec, split_file, self.teldeffile, \
                                                       self.alignfile, self.attfile)
 
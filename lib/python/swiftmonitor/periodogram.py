@@ -0,0 +1,205 @@
+"""
+Periodograms of event files: the Z^2_m and H tests over a grid of trial
+frequencies (and frequency derivatives) around an ephemeris.
+
+The photons are read from the event cache and phased once with the
+ephemeris (see utils.Ephemeris.phase). A trial that differs from it by df
+in frequency and dfdot in frequency derivative at the reference epoch adds
+df dt + dfdot dt^2/2 cycles to a photon dt seconds from the epoch, so the
+phases of a block of trials are one 2-D array whose trigonometric moments
+are computed together with utils.trig_moments. The blocks are spread over
+a pool of processes (see utils.pool_map).
+
+The table written by write_table has the file, epoch, frequency and fdot
+of the best trial in its first columns; read_table reads them back for
+get_ML_TOA.py --periodogram, which times each file with that ephemeris
+(tables without the header line of write_table give no fdot).
+"""
+import sys
+import numpy as np
+from swiftmonitor import utils as smu
+
+# the columns of write_table, as named in its header line
+TABLE_COLUMNS = ('file', 'epoch', 'frequency', 'fdot', 'H', 'M', 'fpp', 'nphot')
+
+def _scan_block(setup, task):
+    """
+    Moments of the trials with frequency offsets dfs and frequency
+        derivative offset dfdot, about block phases at a time (a task of
+        scan_phases).
+    """
+    dfs, dfdot = task
+    phases, dt, nharm, block = setup
+    moments = np.zeros((len(dfs), nharm), dtype='c16')
+    step = max(1, block // len(dfs))
+    for start in range(0, len(phases), step):
+        t = dt[start:start+step]
+        base = phases[start:start+step]
+        if dfdot:
+            base = base + 0.5*dfdot*t*t
+        trials = base + dfs[:,None]*t
+        moments += smu.trig_moments(trials, nharm, block=trials.size)
+    return moments
+
+def scan_phases(phases, dt, dfs, dfdots=(0.0,), nharm=20, nworkers=1, nfreq_block=64,
+                block=2**18):
+    """
+    The trigonometric moments (see utils.trig_moments) of phases shifted
+        by df*dt + dfdot*dt^2/2 for every df in dfs (Hz) and dfdot in dfdots
+        (Hz/s), where dt are the times (s) of the phases from the reference
+        epoch. Returns a complex array of shape (len(dfdots), len(dfs), nharm).
+
+        The trials are taken nfreq_block frequencies at a time with the
+        phases of about block trial-photon pairs in memory, on a pool of
+        nworkers processes.
+    """
+    phases = np.asarray(phases, dtype=float)
+    dt = np.asarray(dt, dtype=float)
+    dfs = np.asarray(dfs, dtype=float)
+    dfdots = np.atleast_1d(np.asarray(dfdots, dtype=float))
+    tasks = [ (dfs[start:start+nfreq_block], dfdot)
+              for dfdot in dfdots for start in range(0, len(dfs), nfreq_block) ]
+    results = smu.pool_map(_scan_block, tasks, setup=(phases, dt, nharm, block),
+                           nworkers=nworkers)
+    return np.concatenate(list(results)).reshape(len(dfdots), len(dfs), nharm)
+
+class Periodogram:
+    """
+    A scan of trial frequencies freqs (Hz) and frequency derivatives fdots
+        (Hz/s) at epoch (MJD), with the trigonometric moments of the n
+        photons for each trial (shape (len(fdots), len(freqs), nharm)).
+    """
+    def __init__(self, fits_fn, epoch, freqs, fdots, moments, n):
+        self.fits_fn = fits_fn
+        self.epoch = epoch
+        self.freqs = freqs
+        self.fdots = fdots
+        self.moments = moments
+        self.n = n
+
+    def z2(self):
+        """
+        Z^2_m, m=1..nharm, of every trial (see utils.z2_scores).
+        """
+        return smu.z2_scores(self.moments, self.n)
+
+    def h_test(self):
+        """
+        The H test (H, M, fpp) of every trial (see utils.h_scores).
+        """
+        return smu.h_scores(self.moments, self.n)
+
+    def best(self):
+        """
+        The trial with the largest H, as a dict of epoch, frequency, fdot,
+            H, M and fpp.
+        """
+        H, M, fpp = self.h_test()
+        i, j = np.unravel_index(np.argmax(H), H.shape)
+        return dict(epoch=self.epoch, frequency=self.freqs[j], fdot=self.fdots[i],
+                    H=H[i,j], M=M[i,j], fpp=fpp[i,j])
+
+def periodogram(fits_fn, par, nfreq=201, df=None, nfdot=1, dfdot=None, oversample=10,
+                scope='swift', Emin=None, Emax=None, nharm=20, epoch=None, nworkers=1,
+                nfreq_block=64):
+    """
+    Scan nfreq frequencies spaced by df (Hz) and nfdot frequency derivatives
+        spaced by dfdot (Hz/s), centred on the ephemeris par (a par file name
+        or a utils.Ephemeris) at epoch (MJD, default the middle of the
+        events), with the Z^2_m and H tests of the events of fits_fn (a file,
+        list of files or events.EventList) between Emin and Emax.
+
+        By default df and dfdot shift the phases at the ends of the span T of
+        the events by 1/oversample cycles: df = 1/(oversample T) and
+        dfdot = 8/(oversample T^2).
+
+        Returns a Periodogram (see scan_phases for nworkers and nfreq_block).
+    """
+    eph = par if isinstance(par, smu.Ephemeris) else smu.read_ephemeris(par)
+    evts = smu.event_list(fits_fn, scope=scope)
+    day, sec = smu.fits2times(evts, scope=scope, Emin=Emin, Emax=Emax, split_mjd=True,
+                              time_order=False)
+    if not len(day):
+        raise ValueError("No events in %s" % fits_fn)
+    phases = eph.phase(day, sec=sec)
+
+    mjd = day + sec / smu.SECPERDAY
+    if epoch is None:
+        epoch = 0.5 * (np.min(mjd) + np.max(mjd))
+    epoch_day = np.floor(epoch)
+    dt = (day - epoch_day) * smu.SECPERDAY + (sec - (epoch - epoch_day) * smu.SECPERDAY)
+    span = max((np.max(mjd) - np.min(mjd)) * smu.SECPERDAY, 1.0)
+    if df is None:
+        df = 1.0 / (oversample * span)
+    if dfdot is None:
+        dfdot = 8.0 / (oversample * span**2)
+
+    dfs = (np.arange(nfreq) - (nfreq - 1) / 2.0) * df
+    dfdots = (np.arange(nfdot) - (nfdot - 1) / 2.0) * dfdot
+    moments = scan_phases(phases, dt, dfs, dfdots, nharm=nharm, nworkers=nworkers,
+                          nfreq_block=nfreq_block)
+    return Periodogram(fits_fn, epoch, eph.freq(epoch) + dfs, eph.fdot(epoch) + dfdots,
+                       moments, len(phases))
+
+def _periodogram_task(setup, fits_fn):
+    par, kwargs = setup
+    return periodogram(fits_fn, par, **kwargs)
+
+def periodograms(fits_fns, par, **kwargs):
+    """
+    The periodogram of each of many event files (kwargs are passed on to
+        periodogram, whose frequency blocks run on nworkers processes).
+        Returns a list of (fits_fn, Periodogram, error), see utils.map_files.
+    """
+    if not isinstance(par, smu.Ephemeris):
+        par = smu.read_ephemeris(par)
+    return smu.map_files(_periodogram_task, fits_fns, setup=(par, kwargs),
+                         action='get periodogram of')
+
+def write_table(results, out_fn=None):
+    """
+    Write the best trial of each periodogram of periodograms as one row of
+        file, epoch, frequency, fdot, H, M, fpp and number of photons, to
+        out_fn or stdout (failed files are left out).
+    """
+    out = open(out_fn, 'w') if out_fn else sys.stdout
+    out.write('# %-38s %19s %22s %14s %11s %3s %10s %9s\n' % TABLE_COLUMNS)
+    for fits_fn, pgram, error in results:
+        if error:
+            continue
+        best = pgram.best()
+        out.write('%-40s %19.12f %22.16g %14.6e %11.3f %3d %10.3e %9d\n' % \
+                  (fits_fn, best['epoch'], best['frequency'], best['fdot'], best['H'],
+                   best['M'], best['fpp'], pgram.n))
+    if out_fn:
+        out.close()
+
+def read_table(table_fn):
+    """
+    Read a table of write_table. Returns the event file names and arrays of
+        the epochs (MJD), frequencies (Hz) and frequency derivatives (Hz/s)
+        of the best trials.
+
+        The fdot column is only used when the table starts with the header
+        line of write_table; other tables (e.g. of older periodograms) are
+        read as file, epoch and frequency columns with an fdot of 0.
+    """
+    f = open(table_fn, 'r')
+    lines = f.readlines()
+    f.close()
+    has_header = bool(lines) and lines[0].startswith('#') and \
+                 tuple(lines[0][1:].split()) == TABLE_COLUMNS
+    rows = [ line.split() for line in lines if line.strip() and not line.startswith('#') ]
+    if has_header:
+        for row in rows:
+            if len(row) != len(TABLE_COLUMNS):
+                raise ValueError("Row of %s in %s has %d columns, not the %d of its header" % \
+                                 (row[0], table_fn, len(row), len(TABLE_COLUMNS)))
+    fns = [ row[0] for row in rows ]
+    epoch = np.array([ float(row[1]) for row in rows ])
+    frequency = np.array([ float(row[2]) for row in rows ])
+    if has_header:
+        fdot = np.array([ float(row[3]) for row in rows ])
+    else:
+        fdot = np.zeros(len(rows))
+    return fns, epoch, frequency, fdot
@@ -4,7 +4,11 @@ from fluxtool import rms_estimator
 import sys
 import numpy as np
 import subprocess
+import multiprocessing
+import hashlib
 import re
+from numpy.polynomial import chebyshev
+from swiftmonitor import config, events, decompress
 
 
 SECPERDAY=86400.0
@@ -23,12 +27,7 @@ def calc_freq(MJD, refMJD, *args):
             list (e.g. [f0, f1, f2, ...]).
             Note: from psr_utils (PRESTO)
     """
-    t = (MJD-refMJD)*SECPERDAY
-    n = len(args) # polynomial order
-    taylor_coeffs = np.concatenate(([1.0],
-                                     np.cumprod(1.0/(np.arange(float(n-1))+1.0))))
-    p = np.poly1d((taylor_coeffs * args)[::-1])
-    return p(t)
+    return Ephemeris(refMJD, args[0], args[1:]).freq(MJD)
 
 
 def calc_t0(MJD, refMJD, *args):
@@ -42,22 +41,46 @@ def calc_t0(MJD, refMJD, *args):
     p = 1.0 / calc_freq(MJD, refMJD, *args)
     return MJD - phs*p/SECPERDAY
 
-def write_tempo2_toa(toa_MJDi, toa_MJDf, toaerr, freq, dm, obs='@', name='unk', flags="", writefile=False):
+def format_tempo2_toa(toa_MJDi, toa_MJDf, toaerr, freq, dm, obs='@', name='unk', flags=""):
     """
-    Write Tempo2 format TOAs.
-    Note that first line of file should be "FORMAT 1"
+    Return a Tempo2 format TOA line (without newline).
     TOA format is "file freq sat satErr siteID <flags>"
     Note: from psr_utils (PRESTO)
     """
     toa = "%5d"%int(toa_MJDi) + ("%.13f"%toa_MJDf)[1:]
     if dm != 0.0:
         flags += "-dm %.4f" % (dm,)
+    return "%s %f %s %.2f %s %s" % (name,freq,toa,toaerr,obs,flags)
+
+def write_tempo2_toa(toa_MJDi, toa_MJDf, toaerr, freq, dm, obs='@', name='unk', flags="", writefile=False):
+    """
+    Write Tempo2 format TOAs.
+    Note that first line of file should be "FORMAT 1"
+    TOA format is "file freq sat satErr siteID <flags>"
+    Note: from psr_utils (PRESTO)
+    """
+    line = format_tempo2_toa(toa_MJDi, toa_MJDf, toaerr, freq, dm, obs=obs, name=name, flags=flags)
     if writefile:
         text_file = open(writefile, "w")
-        text_file.write("%s %f %s %.2f %s %s\n" % (name,freq,toa,toaerr,obs,flags))
+        text_file.write(line + "\n")
         text_file.close()
     else:
-        print ("%s %f %s %.2f %s %s" % (name,freq,toa,toaerr,obs,flags))
+        print (line)
+
+def format_princeton_toa(toa_MJDi, toa_MJDf, toaerr, freq, dm, obs='@', name=' '*13):
+    """
+    Return a Princeton format TOA line (without newline).
+    See write_princeton_toa for the format.
+    Note: from psr_utils (PRESTO)
+    """
+    # Splice together the fractional and integer MJDs
+    toa = "%5d"%int(toa_MJDi) + ("%.13f"%toa_MJDf)[1:]
+    if dm!=0.0:
+        return obs+" %13s %8.3f %s %8.2f              %9.4f" % \
+              (name, freq, toa, toaerr, dm)
+    else:
+        return obs+" %13s %8.3f %s %8.2f" % \
+              (name, freq, toa, toaerr)
 
 def write_princeton_toa(toa_MJDi, toa_MJDf, toaerr, freq, dm, obs='@', name=' '*13):
     """
@@ -72,14 +95,81 @@ def write_princeton_toa(toa_MJDi, toa_MJDf, toaerr, freq, dm, obs='@', name=' '*
     69-78   DM correction (pc cm^-3)
     Note: from psr_utils (PRESTO)
     """
-    # Splice together the fractional and integer MJDs
-    toa = "%5d"%int(toa_MJDi) + ("%.13f"%toa_MJDf)[1:]
-    if dm!=0.0:
-        print (obs+" %13s %8.3f %s %8.2f              %9.4f" % \
-              (name, freq, toa, toaerr, dm))
-    else:
-        print (obs+" %13s %8.3f %s %8.2f" % \
-              (name, freq, toa, toaerr))
+    print (format_princeton_toa(toa_MJDi, toa_MJDf, toaerr, freq, dm, obs=obs, name=name))
+
+class TOA:
+    """
+    A single measured TOA. The arrival time is mjdi + mjdf (integer and
+        fractional MJD), error is in microseconds and offset is the phase
+        offset of the template that gave the TOA. counts is the number of
+        events used and index the position of the TOA within a split
+        observation.
+    """
+    def __init__(self, mjdi, mjdf, error, offset=None, counts=None, obsid='unk', index=0,
+                 freq=0.0, dm=0.0, obs='@', flags=""):
+        self.mjdi = mjdi
+        self.mjdf = mjdf
+        self.error = error
+        self.offset = offset
+        self.counts = counts
+        self.obsid = obsid
+        self.index = index
+        self.freq = freq
+        self.dm = dm
+        self.obs = obs
+        self.flags = flags
+
+    def tempo2_line(self):
+        return format_tempo2_toa(self.mjdi, self.mjdf, self.error, self.freq, self.dm,
+                                 obs=self.obs, name=self.obsid, flags=self.flags)
+
+    def princeton_line(self):
+        return format_princeton_toa(self.mjdi, self.mjdf, self.error, self.freq, self.dm,
+                                    obs=self.obs, name=self.obsid)
+
+    def __repr__(self):
+        return "TOA: " + str(self.obsid) + " #" + str(self.index) + " MJD: " + \
+               ("%5d"%int(self.mjdi) + ("%.13f"%self.mjdf)[1:]) + " Error: " + str(self.error)
+
+class TimWriter:
+    """
+    Buffers TOA records and writes them out in tempo2 or Princeton format
+        in one pass.
+    """
+    def __init__(self, tempo2=False):
+        self.tempo2 = tempo2
+        self.toas = []
+
+    def add(self, toas):
+        """
+        Add a TOA or a list of TOAs to the buffer.
+        """
+        if isinstance(toas, TOA):
+            self.toas.append(toas)
+        else:
+            self.toas.extend(toas)
+
+    def lines(self, header=True):
+        if self.tempo2:
+            lines = [toa.tempo2_line() for toa in self.toas]
+            if header:
+                lines.insert(0, "FORMAT 1")
+        else:
+            lines = [toa.princeton_line() for toa in self.toas]
+        return lines
+
+    def write(self, writefile=None, header=True):
+        """
+        Write the buffered TOAs to writefile, or print them if writefile is
+            not given. header adds the "FORMAT 1" line for tempo2.
+        """
+        text = "".join([line + "\n" for line in self.lines(header=header)])
+        if writefile:
+            text_file = open(writefile, "w")
+            text_file.write(text)
+            text_file.close()
+        else:
+            sys.stdout.write(text)
 
 def calc_phs(MJD, refMJD, *args):
     """
@@ -90,13 +180,7 @@ def calc_phs(MJD, refMJD, *args):
             list (e.g. [f0, f1, f2, ...]).
             Note: from psr_utils (PRESTO)
     """
-    t = (MJD-refMJD)*SECPERDAY
-    n = len(args) # polynomial order
-    nargs = np.concatenate(([0.0], args))
-    taylor_coeffs = np.concatenate(([0.0],
-                                     np.cumprod(1.0/(np.arange(float(n))+1.0))))
-    p = np.poly1d((taylor_coeffs * nargs)[::-1])
-    return p(t)% 1.0
+    return Ephemeris(refMJD, args[0], args[1:]).phase(MJD)
 
 
 class Par:
@@ -133,6 +217,371 @@ def read_parfile(parfn):
                                  fit=split[2])
     return pars
 
+def horner(coeffs, t):
+    """
+    Evaluates the polynomial sum(coeffs[k] * t**k) at t (can be an array)
+        by Horner's rule.
+    """
+    result = coeffs[-1] * np.ones_like(t)
+    for c in coeffs[-2::-1]:
+        result *= t
+        result += c
+    return result[()]
+
+_SPLITTER = 134217729.0 # 2**27 + 1, for Veltkamp splitting of doubles
+
+def two_sum(a, b):
+    """
+    Returns s, e with s = fl(a+b) and s + e = a + b exactly (Knuth).
+    """
+    s = a + b
+    bb = s - a
+    return s, (a - (s - bb)) + (b - bb)
+
+def two_prod(a, b):
+    """
+    Returns p, e with p = fl(a*b) and p + e = a * b exactly (Dekker).
+    """
+    p = a * b
+    c = _SPLITTER * a
+    a_hi = c - (c - a)
+    a_lo = a - a_hi
+    c = _SPLITTER * b
+    b_hi = c - (c - b)
+    b_lo = b - b_hi
+    return p, ((a_hi*b_hi - p) + a_hi*b_lo + a_lo*b_hi) + a_lo*b_lo
+
+glitch_pars = ['GLEP', 'GLPH', 'GLF0', 'GLF1', 'GLF2', 'GLF0D', 'GLTD']
+
+def glitches_from_pars(pars):
+    """
+    Returns the glitches in a dictionary of parameters from read_parfile,
+        as a list (sorted by epoch) of dictionaries of the tempo2 glitch
+        parameters GLEP, GLPH, GLF0, GLF1, GLF2, GLF0D and GLTD (missing ones
+        are zero).
+    """
+    glitches = []
+    for name in pars:
+        match = re.match(r'GLEP_(\d+)$', name)
+        if match is None:
+            continue
+        glitch = {}
+        for glitch_par in glitch_pars:
+            key = glitch_par + '_' + match.group(1)
+            glitch[glitch_par] = pars[key].value if key in pars else 0.0
+        glitches.append(glitch)
+    glitches.sort(key=lambda glitch: glitch['GLEP'])
+    return glitches
+
+class Ephemeris:
+    """
+    A spin ephemeris: reference epoch (MJD), frequency f0 and frequency
+        derivatives fdots (f1, f2, ...), and optionally glitches (see
+        glitches_from_pars). The Taylor coefficients of the phase
+        and frequency are computed once, with trailing zero terms dropped, so
+        that phases and frequencies of many times are a single Horner pass.
+        Use read_ephemeris to get one from a par file.
+
+        Each glitch adds, for times after GLEP (dt in s, tau = GLTD in s),
+            phase: GLPH + GLF0 dt + GLF1 dt^2/2 + GLF2 dt^3/6 + GLF0D tau (1 - exp(-dt/tau))
+            freq:  GLF0 + GLF1 dt + GLF2 dt^2/2 + GLF0D exp(-dt/tau)
+    """
+    def __init__(self, epoch, f0, fdots=(), pars=None, glitches=None):
+        self.epoch = epoch
+        self.f0 = f0
+        self.fdots = np.zeros(max(12, len(fdots)))
+        self.fdots[:len(fdots)] = fdots
+        self.pars = pars
+        self.glitches = sorted(glitches, key=lambda glitch: glitch['GLEP']) if glitches else []
+        # epoch as integer day and seconds, for two-part times
+        self.epoch_day = np.floor(epoch)
+        self.epoch_sec = (epoch - self.epoch_day) * SECPERDAY
+
+        self.freqs = np.concatenate(([f0], self.fdots))
+        factorials = np.cumprod(np.arange(1.0, len(self.freqs)+1))
+        # phase = sum f_k t^(k+1) / (k+1)!, evaluated as t * horner(phs_coeffs, t)
+        self.phs_coeffs = self._trim(self.freqs / factorials)
+        # d^n freq/dt^n = sum_k f_(n+k) t^k / k!
+        self.freq_coeffs = [ self._trim(self.freqs[n:] / np.concatenate(([1.0], factorials[:-n-1])))
+                             for n in range(len(self.freqs)) ]
+
+    @staticmethod
+    def _trim(coeffs):
+        nonzero = np.nonzero(coeffs)[0]
+        return coeffs[:nonzero[-1]+1] if len(nonzero) else coeffs[:1]
+
+    def _glitch_sum(self, MJD, sec, term):
+        """
+        Sums term(glitch, dt) over the glitches, for the times after each
+            glitch epoch (dt in s since it). Sorted 1-d times are sliced at the
+            epochs with searchsorted, other times are masked.
+        """
+        mjd = MJD if sec is None else MJD + sec / SECPERDAY
+        scalar = np.ndim(mjd) == 0
+        mjd = np.atleast_1d(mjd)
+        total = np.zeros(mjd.shape)
+        sorted_times = mjd.ndim == 1 and not np.any(mjd[1:] < mjd[:-1])
+        for glitch in self.glitches:
+            if sorted_times:
+                after = slice(np.searchsorted(mjd, glitch['GLEP'], side='right'), None)
+            else:
+                after = mjd > glitch['GLEP']
+            total[after] += term(glitch, (mjd[after] - glitch['GLEP']) * SECPERDAY)
+        return total[0] if scalar else total
+
+    @staticmethod
+    def _glitch_phase(glitch, dt):
+        phs = glitch['GLPH'] + dt * (glitch['GLF0'] + dt * (glitch['GLF1'] / 2.0 + dt * glitch['GLF2'] / 6.0))
+        if glitch['GLTD'] != 0.0:
+            tau = glitch['GLTD'] * SECPERDAY
+            phs += glitch['GLF0D'] * tau * (1.0 - np.exp(-dt / tau))
+        return phs
+
+    @staticmethod
+    def _glitch_freq(glitch, dt, nuder=0):
+        coeffs = np.array([glitch['GLF0'], glitch['GLF1'], glitch['GLF2'] / 2.0])
+        if nuder == 1:
+            coeffs = np.array([glitch['GLF1'], glitch['GLF2']])
+        elif nuder == 2:
+            coeffs = np.array([glitch['GLF2']])
+        elif nuder > 2:
+            coeffs = np.array([0.0])
+        freq = horner(coeffs, dt)
+        if glitch['GLTD'] != 0.0:
+            tau = glitch['GLTD'] * SECPERDAY
+            freq = freq + glitch['GLF0D'] * (-1.0 / tau)**nuder * np.exp(-dt / tau)
+        return freq
+
+    def _dt(self, MJD, sec):
+        if sec is None:
+            return (MJD - self.epoch) * SECPERDAY
+        return (MJD - self.epoch_day) * SECPERDAY + (sec - self.epoch_sec)
+
+    def phase(self, MJD, fractional=True, sec=None):
+        """
+        Rotational phase at MJD (can be an array), between 0 and 1 unless
+            fractional is False.
+
+            If sec is given, MJD is the integer day and sec the seconds since
+            its start (see fits2times split_mjd). The time since the epoch t is
+            then kept as a double-double, and the dominant f0*t term is evaluated
+            with error-free transformations (two_sum, two_prod); the higher
+            order terms, which are much smaller, are evaluated in double precision.
+            This keeps ~1e-10 cycle precision over long baselines.
+        """
+        if sec is None:
+            t = (MJD - self.epoch) * SECPERDAY
+            phs = t * horner(self.phs_coeffs, t)
+            if self.glitches:
+                phs = phs + self._glitch_sum(MJD, None, self._glitch_phase)
+            return phs % 1.0 if fractional else phs
+
+        t_hi, t_lo = two_sum((MJD - self.epoch_day) * SECPERDAY, sec - self.epoch_sec)
+        # phase = f0 t + t^2 (f1/2 + f2 t/6 + ...)
+        phs_hi, phs_lo = two_prod(self.f0, t_hi)
+        phs_lo += self.f0 * t_lo
+        if len(self.phs_coeffs) > 1:
+            rest = t_hi * t_hi * horner(self.phs_coeffs[1:], t_hi)
+            rest_int = np.floor(rest)
+        else:
+            rest = rest_int = 0.0
+        if self.glitches:
+            rest = rest + self._glitch_sum(MJD, sec, self._glitch_phase)
+            rest_int = np.floor(rest)
+        if not fractional:
+            return (phs_hi + (phs_lo + rest))[()]
+        return (((phs_hi - np.floor(phs_hi)) + (rest - rest_int) + phs_lo) % 1.0)[()]
+
+    def freq(self, MJD, nuder=0, sec=None):
+        """
+        Spin frequency (or its nuder-th derivative, in Hz/s^nuder) at MJD
+            (see phase for sec).
+        """
+        t = self._dt(MJD, sec)
+        if nuder >= len(self.freq_coeffs):
+            freq = 0.0 * t
+        else:
+            freq = horner(self.freq_coeffs[nuder], t)
+        if self.glitches:
+            freq = freq + self._glitch_sum(MJD, sec, lambda glitch, dt: self._glitch_freq(glitch, dt, nuder))
+        return freq
+
+    def fdot(self, MJD):
+        """
+        Spin frequency derivative at MJD.
+        """
+        return self.freq(MJD, nuder=1)
+
+    def t0(self, MJD):
+        """
+        Closest previous MJD corresponding to phase=0 of the pulse.
+        """
+        return MJD - self.phase(MJD) / self.freq(MJD) / SECPERDAY
+
+    def __repr__(self):
+        return repr((self.f0, self.fdots, self.epoch))
+
+def read_ephemeris(par_fn):
+    """
+    Returns the Ephemeris (PEPOCH, F0, F1-F12 and glitches) of a tempo(2) par
+        file. The par file is only parsed again if its modification time changes.
+    """
+    def build():
+        pars = read_parfile(par_fn)
+        fdots = [ pars['F' + str(i+1)].value if 'F' + str(i+1) in pars else 0.0
+                  for i in range(12) ]
+        return Ephemeris(pars['PEPOCH'].value, pars['F0'].value, fdots, pars=pars,
+                         glitches=glitches_from_pars(pars))
+
+    key = (os.path.abspath(par_fn), os.path.getmtime(par_fn))
+    return cached_on(read_ephemeris, key, build)
+
+class PhasePredictor:
+    """
+    A polyco-style predictor: the phase of an ephemeris between tstart and
+        tstop (MJD) is fitted once with piecewise Chebyshev polynomials of
+        ncoeff coefficients, on equal segments (also split at glitch epochs)
+        that are halved until the fit agrees with the ephemeris to within tol
+        cycles at check points between the fit nodes. Each segment stores the fractional phase at
+        its middle and the Chebyshev coefficients of the phase relative to it.
+
+        Phases of large, time-sorted event lists are then evaluated segment
+        by segment with a short Clenshaw recurrence, whatever the number of
+        frequency derivatives in the ephemeris. Use get_predictor to share
+        predictors between runs through the disk cache.
+    """
+    def __init__(self, ephemeris, tstart, tstop, ncoeff=6, tol=1e-8, seg_days=16.0, min_seg_days=1e-4):
+        self.tstart = tstart
+        self.tstop = tstop
+        self.ncoeff = ncoeff
+        self.tol = tol
+
+        span = float(tstop - tstart)
+        seg_len = min(seg_days, span) if span > 0 else seg_days
+        nodes = np.cos(np.pi * (np.arange(ncoeff) + 0.5) / ncoeff)
+        # just inside the segment ends, which can be glitch epochs
+        checks = np.linspace(-1.0, 1.0, 2*ncoeff + 1) * (1.0 - 1e-9)
+        # segments also break at glitch epochs, where the phase is not smooth
+        glitch_epochs = [ glitch['GLEP'] for glitch in getattr(ephemeris, 'glitches', [])
+                          if tstart < glitch['GLEP'] < tstop ]
+        while True:
+            nseg = max(int(np.ceil(span / seg_len)), 1)
+            # the last segment ends at tstop, so the span is not extrapolated
+            self.edges = np.union1d(np.minimum(tstart + np.arange(nseg + 1) * seg_len, tstop),
+                                    glitch_epochs)
+            mids = (self.edges[:-1] + self.edges[1:]) / 2.0
+            self.mid_day = np.floor(mids)
+            self.mid_sec = (mids - self.mid_day) * SECPERDAY
+            self.half_sec = (self.edges[1:] - self.edges[:-1]) * SECPERDAY / 2.0
+            self.mid_phase = ephemeris.phase(self.mid_day, sec=self.mid_sec)
+
+            dphs = self._delta_phase(ephemeris, nodes)
+            self.coeffs = chebyshev.chebfit(nodes, dphs.T, ncoeff - 1)
+
+            err = chebyshev.chebval(checks, self.coeffs) - self._delta_phase(ephemeris, checks)
+            self.max_err = np.abs(err).max()
+            if self.max_err <= tol:
+                break
+            if seg_len / 2.0 < min_seg_days:
+                raise ValueError("Cannot fit the ephemeris to %g cycles with %d Chebyshev " \
+                                 "coefficients (reached %g cycles)." % (tol, ncoeff, self.max_err))
+            seg_len /= 2.0
+
+    def _delta_phase(self, ephemeris, x):
+        """
+        Phase at x (-1 to 1) in each segment relative to the segment middle,
+            shape (nseg, len(x)). The fractional part comes from the two-part
+            ephemeris evaluation, the number of turns from a coarse one.
+        """
+        day = self.mid_day[:,np.newaxis] * np.ones_like(x)
+        sec = self.mid_sec[:,np.newaxis] + x * self.half_sec[:,np.newaxis]
+        mid = self.mid_day + self.mid_sec / SECPERDAY
+        frac = ephemeris.phase(day, sec=sec) - self.mid_phase[:,np.newaxis]
+        coarse = ephemeris.phase(day + sec / SECPERDAY, fractional=False) - \
+                 ephemeris.phase(mid, fractional=False)[:,np.newaxis]
+        return np.round(coarse - frac) + frac
+
+    def phase(self, MJD, sec=None):
+        """
+        Rotational phase (0-1) at MJD (can be an array), or at the two-part
+            times (MJD, sec) as in Ephemeris.phase. Times should be sorted;
+            unsorted ones are sorted first.
+        """
+        MJD = np.atleast_1d(MJD)
+        if sec is None:
+            day, sec = MJD, np.zeros_like(MJD, dtype=float)
+            t = MJD
+        else:
+            day, sec = MJD, np.atleast_1d(sec)
+            t = day + sec / SECPERDAY
+        if len(t) and (t.min() < self.edges[0] - 1e-9 or t.max() > self.edges[-1] + 1e-9):
+            raise ValueError("Times outside of the predictor span %f-%f." % \
+                             (self.edges[0], self.edges[-1]))
+
+        order = None
+        if np.any(t[1:] < t[:-1]):
+            order = np.argsort(t)
+            day, sec, t = day[order], sec[order], t[order]
+
+        phases = np.empty(len(t))
+        bounds = np.searchsorted(t, self.edges[1:-1], side='right')
+        bounds = np.concatenate(([0], bounds, [len(t)]))
+        for k in np.nonzero(bounds[1:] > bounds[:-1])[0]:
+            sl = slice(bounds[k], bounds[k+1])
+            x = ((day[sl] - self.mid_day[k]) * SECPERDAY + (sec[sl] - self.mid_sec[k])) / self.half_sec[k]
+            phases[sl] = chebyshev.chebval(x, self.coeffs[:,k]) + self.mid_phase[k]
+        phases %= 1.0
+
+        if order is not None:
+            unsorted = np.empty_like(phases)
+            unsorted[order] = phases
+            phases = unsorted
+        return phases
+
+    def save(self, fn):
+        np.savez(fn, tstart=self.tstart, tstop=self.tstop, ncoeff=self.ncoeff, tol=self.tol,
+                 edges=self.edges, mid_day=self.mid_day, mid_sec=self.mid_sec,
+                 half_sec=self.half_sec, mid_phase=self.mid_phase, coeffs=self.coeffs,
+                 max_err=self.max_err)
+
+    @classmethod
+    def load(cls, fn):
+        data = np.load(fn)
+        pred = cls.__new__(cls)
+        for name in data.files:
+            setattr(pred, name, data[name][()])
+        return pred
+
+def get_predictor(par_fn, tstart, tstop, ncoeff=6, tol=1e-8, cache=True):
+    """
+    Returns the PhasePredictor of a par file covering tstart to tstop (MJD,
+        extended to whole days). Predictors are cached in memory and on disk
+        in config.cache_path, per par file (path and modification time), span
+        and fit settings. If the cache directory cannot be written the
+        predictor is just not saved.
+    """
+    tstart, tstop = np.floor(tstart), np.ceil(tstop)
+    if tstop == tstart:
+        tstop += 1.0
+    key = (os.path.abspath(par_fn), os.path.getmtime(par_fn), tstart, tstop, ncoeff, tol)
+
+    def build():
+        cache_fn = os.path.join(config.cache_path, 'predictor_%s.npz' % \
+                                hashlib.md5(repr(key).encode()).hexdigest())
+        if cache and os.path.exists(cache_fn):
+            return PhasePredictor.load(cache_fn)
+        pred = PhasePredictor(read_ephemeris(par_fn), tstart, tstop, ncoeff=ncoeff, tol=tol)
+        if cache:
+            try:
+                if not os.path.isdir(config.cache_path):
+                    os.makedirs(config.cache_path)
+                pred.save(cache_fn)
+            except (IOError, OSError) as err:
+                sys.stderr.write('Warning: could not cache phase predictor: %s\n' % err)
+        return pred
+
+    return cached_on(get_predictor, key, build)
+
 def energy2chan(E, scope='swift'):
     """Takes a given Energy or array of Energies in keV, and converts them
        into the channel of either the 'PI' or 'PHA' fits column.
@@ -144,7 +593,7 @@ def energy2chan(E, scope='swift'):
     """
     if scope == 'swift':
         chans = E * 100.0
-    if scope == 'nicer':
+    elif scope == 'nicer':
         chans = E * 100.0
     elif scope == 'nustar':
         chans = (E - 1.6) / 0.04
@@ -154,7 +603,7 @@ def energy2chan(E, scope='swift'):
         chans = E*1000.
     elif scope == 'fermi':
         chans = E*1000.
-    elif scope == 'xte' or 'rxte':
+    elif scope == 'xte' or scope == 'rxte':
        xte_scale = np.loadtxt('/home/rarchiba/Scripts/XTE_ENERGY_CHANNEL_mod',
                         usecols=[0, -1]).T
        keVtoxtechan = lambda x:np.interp(x, xte_scale[1], xte_scale[0])
@@ -165,85 +614,68 @@ def energy2chan(E, scope='swift'):
     return chans
 
 
-def fits2times(evtname,scope='swift',Emin=None, Emax=None, give_t_E=False, aware_no_filt=False):
+def fits2times(evtname,scope='swift',Emin=None, Emax=None, give_t_E=False, aware_no_filt=False,
+               split_mjd=False, cache=True, time_order=True):
     """Given a FITS file, this will read the reference epochs,
        and convert MET into MJD
        INPUTS:
-              evtname - name of FITS file to read
+              evtname - name of FITS file to read (or an events.EventList, or
+                      a list of FITS files to merge)
+              split_mjd - return the times in two parts (see OUTPUTS)
+              cache - read the events through the event cache (see
+                      events.read_events) instead of decoding the FITS file
+              time_order - if False, events of an energy band are returned in
+                      energy order (cheaper, for folding and H-tests)
        OUTPUTS:
              t - Event arrival times in Modified Julian Dates
+                 if split_mjd: a tuple (mjdi, sec) of the integer MJD and the
+                 seconds since the start of that day, which keeps the full
+                 precision of the MET for Ephemeris.phase
              if  give_t_E: - E - Energy of phases
 
     """
-    fits = pyfits.open(evtname)
-    if scope =='fermi':
-        t = fits[1].data['bary_time']
-    else:
-        t = fits[1].data['time']
-        t = t
-    t = t / 86400.0
+    evts = event_list(evtname, scope=scope, cache=cache)
 
-    try:
-        t = t + fits[1].header['MJDREFI'] + fits[1].header['MJDREFF'] +fits[1].header['TIMEZERO']/3600./24.
-
-    except (KeyError):
-        t = t + fits[1].header['MJDREF']
-
-    if "PI" in fits[1].columns.names:
-      Echans = fits[1].data['PI']
-    elif "pi" in fits[1].columns.names:
-      Echans = fits[1].data['pi']
-    elif "PHA" in fits[1].columns.names:
-      Echans = fits[1].data['PHA']
-    elif "ENERGY" in fits[1].columns.names:
-      Echans = fits[1].data['ENERGY']
-    else:
+    if evts.energy_column is None:
         sys.stderr.write('No Energy Column\n')
         Emin, Emax = None, None
+    if not (Emin or Emax) and aware_no_filt!=True:
+        sys.stderr.write('No Energy Filter\n')
 
-    if (Emin and Emax):
-        PI_min = energy2chan(Emin, scope)
-        PI_max = energy2chan(Emax, scope)
-        t = t[(Echans < PI_max) & (Echans > PI_min)]
-    elif Emin:
-        PI_min = energy2chan(Emin, scope)
-        t = t[(Echans > PI_min)]
-    elif Emax:
-        PI_max = energy2chan(Emax, scope)
-        t = t[(Echans < PI_max)]
-    else:
-        if aware_no_filt!=True:
-            sys.stderr.write('No Energy Filter\n')
-
-    fits.close()
+    t = evts.times(Emin, Emax, split_mjd=split_mjd, time_order=time_order)
     if give_t_E:
-        if (Emin and Emax):
-            PI_min = energy2chan(Emin, scope)
-            PI_max = energy2chan(Emax, scope)
-            Echans = Echans[(Echans < PI_max) & (Echans > PI_min)]
-        elif Emin:
-            PI_min = energy2chan(Emin, scope)
-            Echans = Echans[(Echans > PI_min)]
-        elif Emax:
-            PI_max = energy2chan(Emax, scope)
-            Echans = Echans[(Echans < PI_max)]
-        return t, Echans
+        return t, evts.energies(Emin, Emax, time_order=time_order)
     else:
         return t
 
-def fits2phase(fits_fn, par_fn, scope='swift',Emin=None, Emax=None, give_t_E=False):
+def event_list(evtname, scope='swift', cache=True):
+    """
+    Returns evtname if it is already an events.EventList, otherwise reads
+        the event file into one. A list of event files is merged into one
+        time-sorted EventList (see events.read_event_lists).
+    """
+    if isinstance(evtname, events.EventList):
+        return evtname
+    if isinstance(evtname, (list, tuple)):
+        return events.read_event_lists([ decompress.native_name(fn) for fn in evtname ],
+                                       scope=scope, cache=cache)
+    return events.EventList(decompress.native_name(evtname), scope=scope, cache=cache)
+
+def fits2phase(fits_fn, par_fn, scope='swift',Emin=None, Emax=None, give_t_E=False, time_order=True):
     """Given a FITS file and a parfile, this will read the reference epochs,
        and convert into phases
        INPUTS:
-           fits_fn - name of FITS file to read
+           fits_fn - name of FITS file to read (or an events.EventList)
        OUTPUTS:
            phase - Pulsar phase, from 0-1.
 
     """
     if  give_t_E:
-        t, E = fits2times(fits_fn,Emin=Emin,Emax=Emax,scope=scope, give_t_E=True)
+        t, E = fits2times(fits_fn,Emin=Emin,Emax=Emax,scope=scope, give_t_E=True, split_mjd=True,
+                          time_order=time_order)
     else:
-        t = fits2times(fits_fn,Emin=Emin,Emax=Emax,scope=scope, give_t_E=False)
+        t = fits2times(fits_fn,Emin=Emin,Emax=Emax,scope=scope, give_t_E=False, split_mjd=True,
+                       time_order=time_order)
     phases = times2phases(t, par_fn)
     if  give_t_E:
         return phases, E
@@ -251,25 +683,104 @@ def fits2phase(fits_fn, par_fn, scope='swift',Emin=None, Emax=None, give_t_E=Fal
         return phases
 
 
-def fold_fits(fits_fn, par_fn, nbins=32, scope='swift', Emin=None, Emax=None):
+def event_chunks(evtname, scope='swift', Emin=None, Emax=None, chunk_size=2**20,
+                 split_mjd=False, give_t_E=False):
+    """Yields the event times of a FITS file in chunks of at most chunk_size
+       events (see events.EventList.chunks), so that very large event lists
+       can be processed with bounded memory (after the first read of a file,
+       which builds its event cache in memory).
+       INPUTS:
+           evtname - name of FITS file to read (or an events.EventList, or a
+                     list of either, which are streamed one after the other)
+           split_mjd - yield two-part times (mjdi, sec), see fits2times
+       OUTPUTS:
+           t - Event arrival times of each chunk
+           if give_t_E: tuples (t, E) with the energies of the chunk
+
+    """
+    if not isinstance(evtname, (list, tuple)):
+        evtname = [evtname]
+    for evt in evtname:
+        evts = event_list(evt, scope=scope)
+        for chunk in evts.chunks(Emin, Emax, chunk_size=chunk_size, split_mjd=split_mjd,
+                                 energies=give_t_E):
+            yield chunk
+
+def phase_chunks(fits_fn, par_fn, scope='swift', Emin=None, Emax=None, chunk_size=2**20,
+                 give_t_E=False):
+    """Yields the phases of the events of a FITS file (see event_chunks) one
+       chunk at a time. The phases are the same as those of fits2phase.
+       INPUTS:
+           par_fn - parfile, or an already read Ephemeris
+       OUTPUTS:
+           phase - Pulsar phases of each chunk, from 0-1
+           if give_t_E: tuples (phase, E)
+
+    """
+    eph = par_fn if isinstance(par_fn, Ephemeris) else read_ephemeris(par_fn)
+    for chunk in event_chunks(fits_fn, scope=scope, Emin=Emin, Emax=Emax, chunk_size=chunk_size,
+                              split_mjd=True, give_t_E=give_t_E):
+        if give_t_E:
+            (mjdi, sec), E = chunk
+            yield eph.phase(mjdi, sec=sec), E
+        else:
+            mjdi, sec = chunk
+            yield eph.phase(mjdi, sec=sec)
+
+def histogram_chunks(chunks, bins):
+    """Histogram of the values of an iterable of arrays (e.g. phase_chunks)
+       with the given bin edges, accumulated one chunk at a time. The counts
+       are those of np.histogram of all the values at once.
+    """
+    counts = np.zeros(len(bins)-1, dtype=np.int64)
+    for chunk in chunks:
+        counts += np.histogram(chunk, bins)[0]
+    return counts
+
+def fold_fits(fits_fn, par_fn, nbins=32, scope='swift', Emin=None, Emax=None, chunk_size=None):
     """Given a FITS file and a parfile, this will convert the events to phases
        and fold them, returning a histogram of folded phases.
        INPUTS:
-           fits_fn - name of FITS file to read
+           fits_fn - name of FITS file to read (or an events.EventList)
+           chunk_size - if given, stream the events chunk_size at a time
+                        (see phase_chunks) instead of reading them all
        OUTPUTS:
            bins - the left bin edges for each bin
            folded - the number of events in each bin
 
     """
-    phases = fits2phase(fits_fn, par_fn, scope=scope, Emin=Emin, Emax=Emax)
+    if chunk_size:
+        folded = np.zeros(nbins, dtype=np.int64)
+        for phases in phase_chunks(fits_fn, par_fn, scope=scope, Emin=Emin, Emax=Emax,
+                                   chunk_size=chunk_size):
+            folded += fold_phases_multi(phases, [nbins])[0]
+        return np.linspace(0,1,nbins+1)[:-1], folded
+    phases = fits2phase(fits_fn, par_fn, scope=scope, Emin=Emin, Emax=Emax, time_order=False)
 
     return fold_phases(phases, nbins=nbins)
 
-def fold_phases(phases, nbins=32):
+def energy_histogram(fits_fn, bins, scope='swift', Emin=None, Emax=None, chunk_size=2**20):
+    """Histogram of the energy channels (PI, PHA or ENERGY column) of the
+       events of a FITS file with Emin < E < Emax, streamed chunk_size events
+       at a time.
+       INPUTS:
+           fits_fn - name of FITS file to read (or an events.EventList, or a
+                     list of either)
+           bins - channel bin edges
+       OUTPUTS:
+           counts - the number of events in each bin
+
+    """
+    return histogram_chunks((E for t, E in event_chunks(fits_fn, scope=scope, Emin=Emin, Emax=Emax,
+                                                        chunk_size=chunk_size, give_t_E=True)
+                             if E is not None), bins)
+
+def fold_phases(phases, nbins=32, weights=None):
     """Given list of phase (e.g. from fits2phases), this will bin them
        into a histogram with nbins between 0 and 1.
        INPUTS:
            phases - a list or array of phases
+           weights - optional weight of each phase (see fold_phases_multi)
        OUTPUTS:
            bins - the left bin edges for each bin
            folded - the number of events in each bin
@@ -277,33 +788,89 @@ def fold_phases(phases, nbins=32):
 
     bins = np.linspace(0,1,nbins+1) # add an extra bin for np.histogram's
                                     # rightmost limit
-    folded = np.histogram(phases,bins)[0]
+    folded = fold_phases_multi(phases, [nbins], weights=weights)[0]
 
     return bins[:-1],folded
 
-def times2phases(t, par_fn):
+def fold_phases_multi(phases, nbins=(32,), weights=None):
+    """Folds phases into histograms between 0 and 1 at several resolutions
+       in one pass. The phases are binned once with np.bincount at the finest
+       resolution nfine, into the bins of
+       np.histogram(phases, np.linspace(0,1,nfine+1)): a phase of exactly 1 is
+       in the last bin and phases outside [0,1] are dropped. Each coarser
+       histogram is the sum of adjacent fine bins, so every nbins must divide
+       the largest, and its edges are every (nfine/n)th fine edge. With nfine
+       a power of two these are exactly np.linspace(0,1,n+1); otherwise they
+       can differ from it in the last bit, so a phase exactly on a coarse
+       edge may be counted in the neighbouring bin.
+       INPUTS:
+           phases - a list or array of phases
+           nbins - the numbers of bins of the histograms
+           weights - optional weight of each phase (e.g. the probability that
+                     it is from the source), summed in each bin instead of
+                     counting the phases
+       OUTPUTS:
+           folded - list of the histograms, in the order of nbins
+    """
+    nbins = [ int(n) for n in np.atleast_1d(nbins) ]
+    nfine = max(nbins)
+    for n in nbins:
+        if nfine % n:
+            raise ValueError("Numbers of bins must divide the largest (%d), got %d" % (nfine, n))
+    phases = np.ravel(phases)
+    if weights is not None:
+        weights = np.ravel(weights)
+    elif len(nbins) == 1 and nfine & (nfine - 1):
+        # a single unweighted histogram whose edges are not exact binary
+        # fractions is faster with np.histogram's own edge handling
+        return [ np.histogram(phases, np.linspace(0, 1, nfine+1))[0] ]
+    if len(phases) and (np.min(phases) < 0.0 or np.max(phases) > 1.0):
+        inside = (phases >= 0.0) & (phases <= 1.0)
+        phases = phases[inside]
+        if weights is not None:
+            weights = weights[inside]
+    if nfine & (nfine - 1):
+        edges = np.linspace(0, 1, nfine+1)
+
+    fine = np.zeros(nfine, dtype=np.int64 if weights is None else float)
+    block = 2**16 # bin in blocks that stay in cache
+    for start in range(0, len(phases), block):
+        x = phases[start:start+block]
+        idx = (x * nfine).astype(np.intp) # truncation is floor for x >= 0
+        if nfine & (nfine - 1):
+            # x*nfine is not exact: correct the bins of phases that
+            # rounded across an edge, as np.histogram does
+            np.minimum(idx, nfine-1, out=idx)
+            idx -= x < edges[idx]
+            idx += (x >= edges[idx+1]) & (idx != nfine-1)
+        else:
+            idx[idx == nfine] = nfine - 1
+        fine += np.bincount(idx, weights=None if weights is None else weights[start:start+block],
+                            minlength=nfine)
+    return [ fine.reshape(n, nfine // n).sum(axis=1) for n in nbins ]
+
+def times2phases(t, par_fn, predictor=False):
     """Given an array of times and a parfile, this will read the reference epoch
        and frequency parameters, and convert into phases
        INPUTS:
-           t -an array of photon arrival times in MJD
+           t -an array of photon arrival times in MJD, or a tuple
+              (mjdi, sec) of two-part times from fits2times(split_mjd=True)
            par_fn -
+           predictor - evaluate the phases with a PhasePredictor fitted over the
+              span of t (see get_predictor), for very large, sorted event lists
        OUTPUTS:
            phase - Pulsar phase, from 0-1.
 
     """
-    par = read_parfile(par_fn)
-
-    phs_args = [ t, par['PEPOCH'].value, par['F0'].value ]
-
-    for i in range(12):
-        fdot_name = 'F' + str(i+1)
-        if fdot_name in par.keys():
-            phs_args.append(par[fdot_name].value)
-        else:
-            phs_args.append(0.0)
-
-    phases = calc_phs(*phs_args)
-    return phases
+    if isinstance(t, tuple):
+        mjd, sec = t
+    else:
+        mjd, sec = t, None
+    if predictor:
+        tmin = np.min(mjd) if sec is None else np.min(mjd + sec / SECPERDAY)
+        tmax = np.max(mjd) if sec is None else np.max(mjd + sec / SECPERDAY)
+        return get_predictor(par_fn, tmin, tmax).phase(mjd, sec=sec)
+    return read_ephemeris(par_fn).phase(mjd, sec=sec)
 
 def times2freqs(t, par_fn, nuder=0):
     """Given an array of times and a parfile, this will read the reference epoch
@@ -316,36 +883,107 @@ def times2freqs(t, par_fn, nuder=0):
            freqs - pulsar frequency der in Hz/s^{nudir}
 
     """
-    par = read_parfile(par_fn)
+    return read_ephemeris(par_fn).freq(t, nuder=nuder)
 
-    phs_args = [ t, par['PEPOCH'].value]
+def events_from_binned_profile(profile, rng=None):
+    """Given a binned profile (counts per bin), return the phases of that many
+       events, spread uniformly within their bins.
+       INPUTS:
+           profile - integer counts in each phase bin
+           rng - numpy RandomState or Generator to draw from (default is np.random)
+       OUTPUTS:
+           phases - array of sum(profile) phases, grouped by bin
+    """
+    if rng is None:
+        rng = np.random
+    nbins = len(profile)
+    phases = np.repeat(np.arange(nbins, dtype=float), profile)
+    phases += rng.uniform(size=len(phases))
+    phases /= nbins
+    return phases
 
-    for i in range(nuder, 12):
-        fdot_name = 'F' + str(i)
-        if fdot_name in par.keys():
-            phs_args.append(par[fdot_name].value)
-        else:
-            phs_args.append(0.0)
+def events_from_binned_profiles(profiles, rng=None):
+    """Batched version of events_from_binned_profile: given a 2-D array of
+       binned profiles (one set of counts per row, e.g. Poisson resamplings of
+       a profile), return the events of all of them from one allocation.
+       INPUTS:
+           profiles - integer counts, shape (nsets, nbins)
+           rng - numpy RandomState or Generator to draw from (default is np.random)
+       OUTPUTS:
+           phases - array of all phases, grouped by set and bin
+           owner - the row of profiles each phase belongs to
+    """
+    if rng is None:
+        rng = np.random
+    profiles = np.asarray(profiles)
+    nbins = profiles.shape[1]
+    idx = np.repeat(np.arange(profiles.size), profiles.ravel())
+    owner, phases = np.divmod(idx, nbins)
+    phases = phases + rng.uniform(size=len(phases))
+    phases /= nbins
+    return phases, owner
+
+def cached_on(func, key, build):
+    """
+    Returns a quantity derived from a function (e.g. a template prof_mod),
+      building it with build() the first time it is asked for. The cache is
+      stored on the function itself, so it is dropped whenever a model is
+      refitted or recalculated (which always creates a new prof_mod function).
+    """
+    try:
+        cache = func._cache
+    except AttributeError:
+        cache = func._cache = {}
+    if key not in cache:
+        cache[key] = build()
+    return cache[key]
+
+def randomvariate(pdf,n=1000,xmin=0,xmax=1,zero_min=True,rng=None,nsamp=8192):
+  """ Generate random numbers from an arbitrary distribution by inverting its
+  tabulated cumulative distribution.
+    Inputs: pdf - probability distribution function from which you want to generate random numbers
+            n - number of random values to output (int or shape)
+            xmin, xmax  - range of random numbers
+            zero_min - if False, the minimum of the pdf is subtracted before
+                       drawing (i.e. only the pulsed part is sampled)
+            rng - numpy RandomState or Generator to draw from (default is np.random)
+            nsamp - number of points on which the pdf is tabulated
+    Output: array of random values drawn from input PDF
 
-    freqs = calc_freq(*phs_args)
-    return freqs
+  The pdf is tabulated on nsamp+1 points and the cumulative distribution is
+  built once and cached on the pdf function, after which any number of values
+  are drawn in O(n) with a single searchsorted (linear interpolation of the
+  cumulative distribution between the tabulated points).
+  """
+  if rng is None:
+    rng = np.random
 
-def events_from_binned_profile(profile):
-    binsize = 1.0 / len(profile)
-    phases = np.array([])
-    for i,counts in enumerate(profile):
-      phases = np.append(phases, np.random.rand(counts)*binsize + i*binsize)
-    return phases
+  def build():
+    x = np.linspace(xmin,xmax,nsamp+1)
+    y = pdf(x)
+    if not zero_min:
+      y = y - y.min()
+    cdf = np.concatenate(([0.0], np.cumsum((y[1:] + y[:-1]) / 2.0)))
+    return x, cdf / cdf[-1]
+
+  x, cdf = cached_on(pdf, ('inverse_cdf', xmin, xmax, zero_min, nsamp), build)
 
-def randomvariate(pdf,n=1000,xmin=0,xmax=1,zero_min=True):
+  u = rng.uniform(size=n)
+  i = np.searchsorted(cdf, u, side='right') - 1
+  return x[i] + (u - cdf[i]) / (cdf[i+1] - cdf[i]) * (x[1] - x[0])
+
+def randomvariate_rejection(pdf,n=1000,xmin=0,xmax=1,zero_min=True,rng=None):
   """ Generate random numbers from an arbitrary distribution using the rejection
   method. See Bevington pg. 83.
     Inputs: pdf - probability distribution function from which you want to generate random numbers
             n - number of random values to output
             xmin, xmax  - range of random numbers
             zero_min - (hard to explain)
+            rng - numpy RandomState or Generator to draw from (default is np.random)
     Output: array of random values drawn from input PDF
   """
+  if rng is None:
+    rng = np.random
 
   # Calculate the minimal and maximum values of the PDF in the desired interval.
   x = np.linspace(xmin,xmax,1000)
@@ -353,14 +991,14 @@ def randomvariate(pdf,n=1000,xmin=0,xmax=1,zero_min=True):
   pmin = 0 if zero_min else y.min()
   pmax = y.max()
 
-  x = np.random.uniform(xmin,xmax,n)
-  y = np.random.uniform(pmin,pmax,n)
+  x = rng.uniform(xmin,xmax,n)
+  y = rng.uniform(pmin,pmax,n)
 
   reject = True
   while np.any(reject):
     reject = y>pdf(x)
-    x[reject] = np.random.uniform(xmin,xmax,len(reject))
-    y[reject] = np.random.uniform(pmin,pmax,len(reject))
+    x[reject] = rng.uniform(xmin,xmax,reject.sum())
+    y[reject] = rng.uniform(pmin,pmax,reject.sum())
 
   return x
 
@@ -421,6 +1059,164 @@ def randomvariate_old(pdf,n=1000,xmin=0,xmax=1):
 
   return ran,ntrial
 
+def trig_moments(phases, nharm=20, owner=None, nsets=None, block=2**14):
+    """Given a list of phases, return the first nharm trigonometric moments
+       of the phases, sum(exp(2j*pi*k*phases)) for k=1..nharm.
+
+       Only the cosine and sine of the fundamental are computed; the higher
+       harmonics follow from the Chebyshev recurrences
+           cos((k+1)x) = 2cos(x)cos(kx) - cos((k-1)x)
+           sin((k+1)x) = 2cos(x)sin(kx) - sin((k-1)x)
+       The phases are processed about block at a time, so the temporaries
+       stay small however many phases there are.
+       INPUTS:
+           phases - a list or array of phases. A 2-D array is treated as
+                    one set of phases per row.
+           nharm - number of harmonics
+           owner - optional integer set index (0..nsets-1) of each phase, to
+                   accumulate the moments of many sets of a 1-D phase array
+       OUTPUTS:
+           moments - complex array of length nharm (or nsets x nharm)
+    """
+    ev = np.asarray(phases, dtype=float)
+    if owner is None:
+        moments = np.zeros(ev.shape[:-1] + (nharm,), dtype='c16')
+    else:
+        owner = np.asarray(owner)
+        if nsets is None:
+            nsets = np.max(owner) + 1 if len(owner) else 0
+        moments = np.zeros((nsets, nharm), dtype='c16')
+    if ev.shape[-1] == 0 or nharm == 0:
+        return moments
+
+    step = max(1, block // max(1, ev.size // ev.shape[-1]))
+    for start in range(0, ev.shape[-1], step):
+        x = 2*np.pi*ev[...,start:start+step]
+        # cosines and sines stacked, so each recurrence step is one operation
+        cur = np.empty((2,) + x.shape)
+        np.cos(x, out=cur[0])
+        np.sin(x, out=cur[1])
+        twoc = 2*cur[0]
+        prev = np.zeros_like(cur)
+        prev[0] = 1.0
+        nxt = np.empty_like(cur)
+        if owner is not None:
+            own = owner[start:start+step]
+        for k in range(nharm):
+            if k:
+                np.multiply(twoc, cur, out=nxt)
+                nxt -= prev
+                prev, cur, nxt = cur, nxt, prev
+            if owner is None:
+                sums = np.sum(cur, axis=-1)
+                moments[...,k] += sums[0] + 1.j*sums[1]
+            else:
+                moments[:,k] += np.bincount(own, weights=cur[0], minlength=nsets) + \
+                             1.j*np.bincount(own, weights=cur[1], minlength=nsets)
+    return moments
+
+class TrigMoments:
+    """
+    Accumulator of the trigonometric moments of phases (see trig_moments)
+        for the H and Z^2_m tests.
+
+        Phases are added in chunks of any size with add(), e.g. the chunks of
+        phase_chunks or the events of several files. Accumulators of
+        different chunks or files can be combined with merge(). moments and
+        n can be reused, e.g. by a HarmonicLikelihood or to test sums of
+        observations without recomputing them.
+    """
+    def __init__(self, nharm=20):
+        self.nharm = nharm
+        self.moments = np.zeros(nharm, dtype='c16')
+        self.n = 0
+
+    def add(self, phases):
+        phases = np.ravel(phases)
+        self.moments += trig_moments(phases, self.nharm)
+        self.n += len(phases)
+        return self
+
+    def merge(self, other):
+        self.moments += other.moments
+        self.n += other.n
+        return self
+
+    def z2(self):
+        """
+        Z^2_m for m = 1..nharm (see z2_scores).
+        """
+        return z2_scores(self.moments, self.n)
+
+    def h_test(self):
+        """
+        The H test (H, M, fpp), see h_test.
+        """
+        return h_score(self.moments, self.n)
+
+def z2_scores(moments, n):
+    """The Z^2_m statistics, m=1..nharm, of n phases given their
+       trigonometric moments (see trig_moments). moments can be an array of
+       sets of moments (nharm along the last axis) with an array of n; sets
+       of no phases have Z^2_m = 0.
+    """
+    n = np.asarray(n, dtype=float)[...,None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(n > 0, 2.0/n*np.cumsum(np.abs(moments)**2, axis=-1), 0.0)
+
+class BandMoments:
+    """
+    Trigonometric moments of the phases in every energy band between a set
+        of energy cuts, for optimising the band of a pulsation search.
+
+        Each photon is assigned once to one of the cells below, on and
+        between the cuts (E < cuts[0], E == cuts[0], cuts[0] < E < cuts[1],
+        E == cuts[1], ...) and the moments of every cell are accumulated in
+        one pass (see trig_moments). Prefix sums of the cells along the
+        energy axis then give the moments of any band cuts[i] < E < cuts[j]
+        as the difference of two sums, in O(nharm) per band instead of a
+        pass over the photons of the band. Photons on a cut are in neither
+        band next to it, as with the strict inequalities of fits2times.
+    """
+    def __init__(self, phases, energies, cuts, nharm=20):
+        self.cuts = np.asarray(cuts, dtype=float)
+        if np.any(np.diff(self.cuts) <= 0):
+            raise ValueError("Energy cuts must be increasing")
+        self.nharm = nharm
+        energies = np.ravel(energies)
+        cells = np.searchsorted(self.cuts, energies, side='left') + \
+                np.searchsorted(self.cuts, energies, side='right')
+        ncells = 2*len(self.cuts) + 1
+        moments = trig_moments(np.ravel(phases), nharm, owner=cells, nsets=ncells)
+        self.cum_moments = np.concatenate((np.zeros((1, nharm), dtype='c16'),
+                                           np.cumsum(moments, axis=0)))
+        self.cum_counts = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=ncells))))
+
+    def band(self, i=None, j=None):
+        """
+        The moments and number of photons with cuts[i] < E < cuts[j]. i and j
+            are indices into cuts (or arrays of them, which broadcast), None
+            for no lower or upper bound. Bands with j <= i are empty.
+        """
+        start = 0 if i is None else 2*np.asarray(i) + 2
+        stop = len(self.cum_counts) - 1 if j is None else 2*np.asarray(j) + 1
+        stop = np.maximum(stop, start)
+        return self.cum_moments[stop] - self.cum_moments[start], \
+               self.cum_counts[stop] - self.cum_counts[start]
+
+    def z2(self, i=None, j=None):
+        """
+        Z^2_m, m=1..nharm, of the bands (see band and z2_scores).
+        """
+        return z2_scores(*self.band(i, j))
+
+    def h_test(self, i=None, j=None):
+        """
+        The H test (H, M, fpp) of the bands (see band and h_scores), as
+            arrays if i or j are.
+        """
+        return h_scores(*self.band(i, j))
+
 def h_test(phases, max_harmonic=20):
     """Apply the H test for uniformity on [0,1).
     The H test is an extension of the Z_m^2 or Rayleigh tests for
@@ -456,53 +1252,167 @@ def h_test(phases, max_harmonic=20):
 
     Updated false alarm rate  to match Jager, Busching 2010
     """
-    if len(phases)==0:
+    return TrigMoments(max_harmonic).add(phases).h_test()
+
+def h_score(moments, n):
+    """The H test (see h_test) from the trigonometric moments
+       sum(exp(2j*pi*k*phases)), k=1..max_harmonic, of n phases
+       (e.g. from trig_moments). Returns (H, M, fpp).
+    """
+    if n==0:
         H=0
         M=0
         fpp=1
     else:
-        ev = np.reshape(phases, (-1,))
-        cs = np.sum(np.exp(2.j*np.pi*np.arange(1,max_harmonic+1)*ev[:,None]),axis=0)/len(ev)
-        Zm2 = 2*len(ev)*np.cumsum(np.abs(cs)**2)
-        Hcand = (Zm2 - 4*np.arange(1,max_harmonic+1) + 4)
+        Zm2 = z2_scores(moments, n)
+        Hcand = (Zm2 - 4*np.arange(1,len(Zm2)+1) + 4)
         M = np.argmax(Hcand)+1
         H = Hcand[M-1]
         fpp =np.exp(-0.4*H)
     return (H, M, fpp)
 
-def h_test_obs(fits_fn, par_fn):
-    '''Given a fits file name, and a par filename, will return the H-score
-       and false alarm probability.
+def h_scores(moments, n):
+    """The H test (see h_score) of many sets of moments at once, with
+       nharm along the last axis of moments and n an array of the numbers
+       of phases. Returns arrays (H, M, fpp).
+    """
+    Zm2 = z2_scores(moments, n)
+    Hcand = Zm2 - 4*np.arange(1, Zm2.shape[-1]+1) + 4
+    M = np.argmax(Hcand, axis=-1) + 1
+    H = np.take_along_axis(Hcand, (M-1)[...,None], axis=-1)[...,0]
+    empty = np.asarray(n) == 0
+    H = np.where(empty, 0.0, H)
+    M = np.where(empty, 0, M)
+    return H[()], M[()], np.exp(-0.4*H)[()]
+
+def h_test_chunks(chunks, max_harmonic=20):
+    """The H test (see h_test) of the phases of an iterable of arrays
+       (e.g. phase_chunks), accumulating their trigonometric moments one
+       chunk at a time. Returns (H, M, fpp).
+    """
+    moments = TrigMoments(max_harmonic)
+    for chunk in chunks:
+        moments.add(chunk)
+    return moments.h_test()
+
+def h_test_obs(fits_fn, par_fn, chunk_size=None):
+    '''Given a fits file name (or an events.EventList), and a par filename,
+       will return the H-score and false alarm probability. If chunk_size is
+       given the events are streamed chunk_size at a time (see h_test_chunks).
     '''
-    par = read_parfile(par_fn)
-    times = fits2times(fits_fn)
-    fits=pyfits.open(fits_fn)
-    phs_args = [ times, par['PEPOCH'].value, par['F0'].value ]
-
-    for i in range(12):
-        fdot_name = 'F' + str(i+1)
-        if fdot_name in par.keys():
-            phs_args.append(par[fdot_name].value)
-        else:
-            phs_args.append(0.0)
-
-    phases = calc_phs(*phs_args)
+    if chunk_size:
+        return h_test_chunks(phase_chunks(fits_fn, par_fn, chunk_size=chunk_size))
+    phases = fits2phase(fits_fn, par_fn, time_order=False)
     H, M, fpp=h_test(phases)
 
     return (H, M, fpp)
 
+def z2_logsf(Zm2):
+    """
+    The natural log of the single-trial false alarm probability of Z^2_m,
+        m=1..nharm along the last axis of Zm2 (e.g. from z2_scores). Z^2_m
+        follows chi^2 with 2m degrees of freedom, whose survival function is
+        exp(-y) sum_{k<m} y^k/k! with y = Z^2_m/2; summing it in logs keeps
+        it finite far beyond where the probability itself underflows.
+    """
+    y = np.maximum(np.asarray(Zm2, dtype=float)/2, 1e-300)
+    nharm = y.shape[-1]
+    log_fact = np.concatenate(([0.], np.cumsum(np.log(np.arange(1, nharm)))))
+    logsf = np.empty(y.shape)
+    for m in range(1, nharm+1):
+        ym = y[...,m-1:m]
+        logsf[...,m-1] = np.logaddexp.reduce(np.arange(m)*np.log(ym) - log_fact[:m], axis=-1) - ym[...,0]
+    return np.minimum(logsf, 0.)
+
+def optimize_band(phases, energies, Emin, Emax, steps=16, scope='swift', max_harmonic=20):
+    """
+    Search the energy band Emin < E < Emax (keV, cut into steps edges) and
+        the number of harmonics of the Z^2_m test jointly for the most
+        significant pulsations, using the prefix sums of BandMoments.
+        energies are the channels of the photons (see energy2chan).
+
+        Every band between two edges is tried with m=1..max_harmonic, and
+        the single-trial false alarm probability of Z^2_m (chi^2 with 2m
+        degrees of freedom) is corrected for the steps*(steps-1)/2 bands
+        times max_harmonic trials. The trials are not independent, so the
+        corrected probability is conservative.
+
+        Returns a dict with the best Emin, Emax (keV), nharm, Z2, the number
+        of photons nphot in the band, ntrials, and the single-trial and
+        corrected false alarm probabilities fap1 and fap with their log10
+        (which stay finite when the probabilities underflow).
+    """
+    ECuts = np.linspace(Emin, Emax, steps)
+    bands = BandMoments(phases, energies, energy2chan(ECuts, scope=scope), nharm=max_harmonic)
+    i, j = np.triu_indices(steps, 1)
+    Z2 = bands.z2(i, j)
+    nphot = bands.band(i, j)[1]
+    logp = z2_logsf(Z2)
+    best, m = np.unravel_index(np.argmin(logp), logp.shape)
+    logp = logp[best, m]
+    ntrials = len(i)*max_harmonic
+    fap1 = np.exp(logp)
+    if ntrials*fap1 < 1e-6:
+        logfap = logp + np.log(ntrials)
+        fap = np.exp(logfap)
+    else:
+        fap = -np.expm1(ntrials*np.log1p(-fap1))
+        logfap = np.log(fap)
+    return dict(Emin=ECuts[i[best]], Emax=ECuts[j[best]], nharm=m+1, Z2=Z2[best, m],
+                nphot=nphot[best], ntrials=ntrials, fap1=fap1, fap=fap,
+                log10_fap1=logp/np.log(10), log10_fap=logfap/np.log(10))
+
+def _band_task(setup, fits_fn):
+    """
+    Optimises the band of one event file (a task of optimize_bands).
+    """
+    par_fn, kwargs = setup
+    phases, E = fits2phase(fits_fn, par_fn, scope=kwargs.get('scope', 'swift'),
+                           Emin=kwargs['Emin'], Emax=kwargs['Emax'], give_t_E=True,
+                           time_order=False)
+    return optimize_band(phases, E, **kwargs)
+
+def optimize_bands(fits_fns, par_fn, Emin, Emax, nworkers=1, **kwargs):
+    """
+    Optimise the energy band and harmonic count of each of many event files
+        separately with optimize_band, on nworkers processes. kwargs (steps,
+        scope, max_harmonic) are passed on to optimize_band.
+
+        Returns a list of (fits_fn, result, error), see map_files.
+    """
+    kwargs.update(Emin=Emin, Emax=Emax)
+    return map_files(_band_task, fits_fns, setup=(par_fn, kwargs), nworkers=nworkers,
+                     action='optimise band for')
+
+def write_band_table(bands, out_fn):
+    """
+    Write the results of optimize_bands as a table with one row per
+        event file (failed files are left out).
+    """
+    out = open(out_fn, 'w')
+    out.write('# %-38s %7s %7s %5s %12s %9s %7s %11s %11s\n' % \
+              ('file', 'Emin', 'Emax', 'nharm', 'Z2', 'nphot', 'ntrials',
+               'log10_fap1', 'log10_fap'))
+    for fits_fn, result, error in bands:
+        if error:
+            continue
+        out.write('%-40s %7.3f %7.3f %5d %12.3f %9d %7d %11.3f %11.3f\n' % \
+                  (fits_fn, result['Emin'], result['Emax'], result['nharm'], result['Z2'],
+                   result['nphot'], result['ntrials'], result['log10_fap1'],
+                   result['log10_fap']))
+    out.close()
+
 def pulsed_flux_rms(fits_fn, par_fn,normed = True, nbins = 32,nharm = 5,  **kwargs):
     '''Given a fitsfilename and a par file, will return the RMS pulsed flux (see appendix of https://arxiv.org/abs/1505.03570). If normed = True, will be in counts/ s, if False, will be in counts.
     '''
-    phases = fits2phase(fits_fn, par_fn, **kwargs)
+    evts = event_list(fits_fn, scope=kwargs.get('scope', 'swift'))
+    phases = fits2phase(evts, par_fn, **kwargs)
     bins, folded = fold_phases(phases,nbins=nbins)
     rms_value, rms_uncertainty = rms_estimator(nharm)(folded,np.sqrt(folded))
     rms_value*=nbins
     rms_uncertainty*=nbins
     if normed:
-        fits = pyfits.open(fits_fn)
-        exposure = fits[1].header['Exposure']
-        del fits
+        exposure = evts.exposure
         rms_value /= exposure
         rms_uncertainty /= exposure
     return rms_value, rms_uncertainty
@@ -519,6 +1429,70 @@ def pulsed_fraction_rms(fits_fn, par_fn,nbins = 32,nharm = 5, **kwargs):
     return PF_RMS, PF_RMS_err
 
 
+def worker_pool(nworkers, initializer=None, initargs=()):
+    """
+    Return a multiprocessing Pool of nworkers processes.
+
+      Workers are forked where the platform allows it, so the initializer
+      arguments (e.g. a template prof_mod, which is a lambda and can not be
+      pickled) are inherited by each worker once rather than pickled and
+      sent with every task.
+    """
+    try:
+        context = multiprocessing.get_context('fork')
+    except (AttributeError, ValueError):
+        context = multiprocessing
+    return context.Pool(nworkers, initializer, initargs)
+
+_pool_task = {}
+
+def _init_pool_task(func, setup):
+    _pool_task.update(func=func, setup=setup)
+
+def _run_pool_task(task):
+    return _pool_task['func'](_pool_task['setup'], task)
+
+def pool_map(func, tasks, setup=None, nworkers=1):
+    """
+    Yields func(setup, task) for each of tasks, in order. With nworkers > 1
+        the tasks run on a worker_pool, which is handed func and setup once
+        through its initializer (so setup can hold e.g. a template lambda and
+        is not pickled with every task); otherwise they run in this process.
+    """
+    if nworkers <= 1:
+        for task in tasks:
+            yield func(setup, task)
+        return
+    pool = worker_pool(nworkers, initializer=_init_pool_task, initargs=(func, setup))
+    try:
+        for result in pool.imap(_run_pool_task, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def _file_task(setup, fn):
+    func, func_setup = setup
+    try:
+        return fn, func(func_setup, fn), None
+    except Exception as err:
+        return fn, None, '%s: %s' % (type(err).__name__, err)
+
+def map_files(func, fns, setup=None, nworkers=1, action='process'):
+    """
+    Applies func(setup, fn) to each of the files fns with pool_map. Returns a
+        list of (fn, result, error) in the order of fns, where error is None or
+        the message of the exception that stopped that file. A failing file is
+        reported on stderr ("Failed to <action> <fn>") and does not stop the
+        others.
+    """
+    results = []
+    for fn, result, error in pool_map(_file_task, fns, setup=(func, setup), nworkers=nworkers):
+        if error:
+            sys.stderr.write('Failed to %s %s: %s\n' % (action, fn, error))
+        results.append((fn, result, error))
+    return results
+
 def execute_cmd(cmd, stdout=sys.stdout, stderr=sys.stderr):
     """
     Execute the command 'cmd' after logging the command
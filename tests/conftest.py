@@ -0,0 +1,37 @@
+import os, sys
+import pytest
+
+LIB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lib', 'python')
+sys.path.insert(0, LIB)
+MLTEST = os.path.join(LIB, 'swiftmonitor', 'mltest')
+SWIFT_EVT = os.path.join(MLTEST, 'sw00330353004xwtw2po_cl_bary_reg.evt')
+# mltest/ephemeris.txt as a par file
+PAR = '''PSR J1841-0456
+F0 0.48277818 1
+F1 -6.63E-12 1
+F2 -6.20E-18
+PEPOCH 54743.0
+'''
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    """
+    Keep the event and decompression caches of each test in its own
+        temporary directory.
+    """
+    from swiftmonitor import config
+    monkeypatch.setattr(config, 'cache_path', str(tmp_path / 'cache') + '/')
+    return config.cache_path
+
+@pytest.fixture
+def par_fn(tmp_path):
+    fn = str(tmp_path / 'mltest.par')
+    open(fn, 'w').write(PAR)
+    return fn
+
+@pytest.fixture
+def prof_mod():
+    import numpy as np
+    from swiftmonitor import model_profile
+    profile = np.loadtxt(os.path.join(MLTEST, 'grand_prof.txt'))
+    return model_profile.makeProfileModel('fourier', profile, n=5)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from swiftmonitor import ml_toa, utils as smu
+from conftest import SWIFT_EVT
+
+# small chunks, so the 4966 events of the mltest file span several
+CHUNK = 700
+
+def test_fold_fits_chunks(par_fn):
+    bins, folded = smu.fold_fits(SWIFT_EVT, par_fn, nbins=32)
+    chunk_bins, chunk_folded = smu.fold_fits(SWIFT_EVT, par_fn, nbins=32, chunk_size=CHUNK)
+    np.testing.assert_allclose(chunk_bins, bins)
+    np.testing.assert_array_equal(chunk_folded, folded)
+    assert chunk_folded.sum() == 4966
+
+def test_h_test_chunks(par_fn):
+    H, M, fpp = smu.h_test_obs(SWIFT_EVT, par_fn)
+    chunk_H, chunk_M, chunk_fpp = smu.h_test_obs(SWIFT_EVT, par_fn, chunk_size=CHUNK)
+    assert chunk_M == M
+    assert chunk_H == pytest.approx(H, rel=1e-10)
+
+def test_energy_histogram_chunks():
+    bins = np.arange(0, 1100, 50)
+    E = smu.fits2times(SWIFT_EVT, Emin=0.5, Emax=10, give_t_E=True)[1]
+    counts = smu.energy_histogram(SWIFT_EVT, bins, Emin=0.5, Emax=10, chunk_size=CHUNK)
+    np.testing.assert_array_equal(counts, np.histogram(E, bins)[0])
+    assert counts.sum() == len(E)
+
+@pytest.mark.parametrize('method', ['direct', 'fft', 'harmonic'])
+def test_toa_chunks(par_fn, prof_mod, method):
+    toa, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, par_fn, Emin=0.5, Emax=10, method=method,
+                             writer=smu.TimWriter())
+    chunk_toa, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, par_fn, Emin=0.5, Emax=10, method=method,
+                                   chunk_size=CHUNK, writer=smu.TimWriter())
+    assert chunk_toa.counts == toa.counts
+    assert chunk_toa.offset == pytest.approx(toa.offset, abs=1e-9)
+    assert chunk_toa.error == pytest.approx(toa.error, rel=1e-6)
+    assert chunk_toa.mjdi == toa.mjdi
+    assert chunk_toa.mjdf == pytest.approx(toa.mjdf, abs=1e-10)
+
+def test_toa_chunks_curv_err_direct(par_fn, prof_mod):
+    with pytest.raises(ValueError):
+        ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, par_fn, chunk_size=CHUNK, curv_err=True,
+                          writer=smu.TimWriter())
+
+def test_toa_chunks_curv_err(par_fn, prof_mod):
+    toa, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, par_fn, method='harmonic', curv_err=True,
+                             writer=smu.TimWriter())
+    chunk_toa, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, par_fn, method='harmonic', curv_err=True,
+                                   chunk_size=CHUNK, writer=smu.TimWriter())
+    assert chunk_toa.offset == pytest.approx(toa.offset, abs=1e-6)
+    assert chunk_toa.error == pytest.approx(toa.error, rel=1e-4)
+
+def test_toa_chunks_no_events(par_fn, prof_mod):
+    with pytest.raises(ValueError, match='No events in'):
+        ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, par_fn, Emin=100, Emax=200, chunk_size=CHUNK,
+                          writer=smu.TimWriter())
@@ -0,0 +1,32 @@
+import os
+import gzip
+import shutil
+from swiftmonitor import decompress
+from conftest import SWIFT_EVT
+
+def gzipped_copy(tmp_path):
+    gz_fn = str(tmp_path / 'events.evt.gz')
+    src = open(SWIFT_EVT, 'rb')
+    out = gzip.open(gz_fn, 'wb')
+    shutil.copyfileobj(src, out)
+    out.close()
+    src.close()
+    return gz_fn
+
+def test_decompressed(tmp_path):
+    gz_fn = gzipped_copy(tmp_path)
+    copy = decompress.decompressed(gz_fn)
+    assert copy != gz_fn and copy.endswith('_events.evt')
+    assert open(copy, 'rb').read() == open(SWIFT_EVT, 'rb').read()
+    # a second call is a cache hit
+    assert decompress.decompressed(gz_fn) == copy
+    # files that are not gzipped are returned unchanged
+    assert decompress.decompressed(SWIFT_EVT) == SWIFT_EVT
+
+def test_decompressed_bytes_path(tmp_path):
+    gz_fn = gzipped_copy(tmp_path)
+    assert decompress.decompressed(gz_fn.encode()) == decompress.decompressed(gz_fn)
+
+def test_native_name():
+    assert decompress.native_name(b'a.evt') == 'a.evt'
+    assert decompress.native_name('a.evt') == 'a.evt'
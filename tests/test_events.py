@@ -0,0 +1,33 @@
+import os
+import numpy as np
+import astropy.io.fits as pyfits
+from swiftmonitor import events, utils as smu
+from conftest import SWIFT_EVT
+
+def test_read_swift_mltest():
+    # the STDGTI header has MJDREFI/MJDREFF but no TIMEZERO
+    fits = pyfits.open(SWIFT_EVT)
+    hdr = fits[1].header
+    expected = fits[1].data['TIME'] / 86400.0 + hdr['MJDREFI'] + hdr['MJDREFF'] + \
+               hdr['TIMEZERO'] / 86400.0
+    fits.close()
+
+    t = smu.fits2times(SWIFT_EVT, aware_no_filt=True)
+    assert len(t) == 4966
+    np.testing.assert_allclose(t, expected, rtol=0, atol=1e-9)
+
+    evts = smu.event_list(SWIFT_EVT)
+    assert len(evts.gti) and np.all(np.isfinite(evts.gti))
+    assert np.all(evts.gti[:,0] <= evts.gti[:,1])
+
+def test_bytes_path():
+    t = smu.fits2times(SWIFT_EVT.encode(), aware_no_filt=True)
+    assert len(t) == 4966
+    assert len(smu.event_list([SWIFT_EVT.encode()])) == 4966
+
+def test_read_file_list(tmp_path):
+    list_fn = str(tmp_path / 'files.txt')
+    open(list_fn, 'w').write('# file epoch frequency\n\na.evt 55000.5 0.5\nb.evt.gz 55001.5 0.5\n')
+    fns = events.read_file_list(list_fn)
+    assert fns == ['a.evt', 'b.evt.gz']
+    assert all(isinstance(fn, str) for fn in fns)
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from swiftmonitor import utils as smu
+
+def edge_phases(nfine, seed=0):
+    # every fine edge, 0 and 1 included, among random phases and some outside [0,1]
+    rng = np.random.RandomState(seed)
+    return np.concatenate((np.linspace(0, 1, nfine+1), rng.rand(5000), [-0.1, 1.1]))
+
+@pytest.mark.parametrize('nbins', [(32, 1024), (3, 96), (16,)])
+def test_fold_phases_multi(nbins):
+    phases = edge_phases(max(nbins))
+    for n, folded in zip(nbins, smu.fold_phases_multi(phases, nbins)):
+        np.testing.assert_array_equal(folded, np.histogram(phases, np.linspace(0, 1, n+1))[0])
+
+def test_fold_phases_multi_coarse_edges():
+    # 1000 is not a power of two: the coarse edges are every 100th fine edge
+    phases = edge_phases(1000)
+    coarse, fine = smu.fold_phases_multi(phases, (10, 1000))
+    edges = np.linspace(0, 1, 1001)
+    np.testing.assert_array_equal(fine, np.histogram(phases, edges)[0])
+    np.testing.assert_array_equal(coarse, np.histogram(phases, edges[::100])[0])
+    assert coarse.sum() == len(phases) - 2
+
+def test_fold_phases_multi_weights():
+    phases = edge_phases(64)
+    weights = np.random.RandomState(1).rand(len(phases))
+    folded, = smu.fold_phases_multi(phases, [64], weights=weights)
+    np.testing.assert_allclose(folded, np.histogram(phases, np.linspace(0, 1, 65),
+                                                    weights=weights)[0])
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from swiftmonitor import ml_toa, model_profile, utils as smu
+
+SHIFT = 0.3
+
+@pytest.fixture(scope='module')
+def single_peak():
+    # a smooth template with one peak, so the likelihood of the offset is unimodal
+    x = (np.arange(64) + 0.5) / 64
+    counts = 100 * (1 + 0.5*np.cos(2*np.pi*x) + 0.25*np.cos(4*np.pi*(x - 0.1)))
+    return model_profile.makeProfileModel('fourier', np.column_stack((np.arange(1, 65), counts)), n=5)
+
+def synthetic_phases(prof_mod, seed, n=3000):
+    return (smu.randomvariate(prof_mod.prof_mod, n=n, rng=np.random.default_rng(seed)) + SHIFT) % 1.0
+
+@pytest.mark.parametrize('seed', [0, 1])
+@pytest.mark.parametrize('method', ['direct', 'fft', 'harmonic'])
+def test_curvature_error(single_peak, seed, method):
+    phases = synthetic_phases(single_peak, seed)
+    grid_off, grid_err = ml_toa.calc_toa_offset(phases, single_peak.prof_mod)
+    gauss_off, gauss_err = ml_toa.calc_toa_offset(phases, single_peak.prof_mod, gauss_err=True)
+    curv_off, curv_err = ml_toa.calc_toa_offset(phases, single_peak.prof_mod, curv_err=True,
+                                                method=method)
+    # the grid is 0.001 in offset and the grid error quantised to 0.0005
+    assert curv_off == pytest.approx(grid_off, abs=0.002)
+    assert curv_err == pytest.approx(grid_err, rel=0.1)
+    assert curv_err == pytest.approx(float(np.ravel(gauss_err)[0]), rel=0.03)
+    assert abs(curv_off - SHIFT) < 4 * curv_err
+
+def test_curvature_error_bright(single_peak):
+    phases = synthetic_phases(single_peak, 0)
+    with pytest.raises(ValueError):
+        ml_toa.calc_toa_offset(phases, single_peak.prof_mod, curv_err=True, bright=True)
+
+def test_direct_peaks(single_peak):
+    sets = [ synthetic_phases(single_peak, seed, n=500) for seed in range(3) ]
+    owner = np.repeat(np.arange(3), [ len(p) for p in sets ])
+    peaks = ml_toa.direct_peaks(np.concatenate(sets), owner, 3, single_peak.prof_mod,
+                                block=100000)
+    expected = [ ml_toa.calc_toa_offset(p, single_peak.prof_mod, no_err=True)[0] for p in sets ]
+    np.testing.assert_allclose(peaks, expected)
+
+def test_sim_error_methods(single_peak):
+    phases = synthetic_phases(single_peak, 0, n=500)
+    curv_err = ml_toa.calc_toa_offset(phases, single_peak.prof_mod, curv_err=True)[1]
+    for method in ('direct', 'fft', 'harmonic'):
+        sim_err = ml_toa.sim_error(single_peak.prof_mod, len(phases), phases, method=method,
+                                   N_sim=100, seed=3)
+        # the standard deviation of 100 offsets is good to about 7%
+        assert sim_err == pytest.approx(curv_err, rel=0.2)
+
+def test_fft_likelihood(single_peak):
+    prof = single_peak.prof_mod
+    phases = synthetic_phases(single_peak, 0)
+    nbins = 16384
+    offsets, loglikes = ml_toa.calc_probs_fft(phases, prof, nbins=nbins)
+    # the bound of calc_probs_fft, N max|d ln(prof_mod)/dphi| / (2 nbins)
+    x = np.linspace(0, 1, 100001)
+    bound = len(phases) * np.max(np.abs(np.gradient(np.log(prof(x)), x))) / (2.0 * nbins)
+    direct = np.array([ ml_toa.calc_prob(phases, off, prof) for off in offsets[::64] ])
+    assert np.max(np.abs(loglikes[::64] - direct)) <= bound
+
+    # the most probable offset agrees with the 0.001 grid of the direct method
+    fft_off, fft_err = ml_toa.calc_toa_offset(phases, prof, method='fft')
+    grid_off, grid_err = ml_toa.calc_toa_offset(phases, prof)
+    assert fft_off == pytest.approx(grid_off, abs=0.0005 + 0.5 / nbins)
+    assert fft_err == pytest.approx(grid_err, rel=0.05)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from swiftmonitor import ml_toa, periodogram, utils as smu
+from conftest import SWIFT_EVT
+
+def test_read_table(tmp_path, par_fn):
+    results = periodogram.periodograms([SWIFT_EVT], par_fn, nfreq=5, nfdot=3)
+    table_fn = str(tmp_path / 'pgram.txt')
+    periodogram.write_table(results, table_fn)
+    best = results[0][1].best()
+    fns, epoch, frequency, fdot = periodogram.read_table(table_fn)
+    assert fns == [SWIFT_EVT]
+    np.testing.assert_allclose([epoch[0], frequency[0], fdot[0]],
+                               [best['epoch'], best['frequency'], best['fdot']], rtol=1e-6)
+
+    # tables without the header of write_table have no fdot column, whatever
+    # else follows the frequency
+    for extra in ('', ' 1.5e-10'):
+        old_fn = str(tmp_path / 'old.txt')
+        open(old_fn, 'w').write('%s %.12f %.16g%s\n' % (SWIFT_EVT, epoch[0], frequency[0], extra))
+        fns, old_epoch, old_frequency, old_fdot = periodogram.read_table(old_fn)
+        assert fns == [SWIFT_EVT] and old_fdot[0] == 0.0
+        assert (old_epoch[0], old_frequency[0]) == (epoch[0], frequency[0])
+
+    # a row that does not match the header is rejected
+    lines = open(table_fn).readlines()
+    open(table_fn, 'w').write(lines[0] + lines[1].strip() + ' 7\n')
+    with pytest.raises(ValueError):
+        periodogram.read_table(table_fn)
+
+def test_toa_uses_fdot(prof_mod):
+    epoch, frequency, fdot = 54743.0, 0.48277818, -6.63e-12
+    toa_args = dict(frequency=frequency, epoch=epoch)
+    toa, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, None, fdot=fdot, writer=smu.TimWriter(),
+                             **toa_args)
+    par_toa, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, None, writer=smu.TimWriter(),
+                                 par=smu.Ephemeris(epoch, frequency, [fdot]))
+    no_fdot, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, None, writer=smu.TimWriter(), **toa_args)
+    assert (toa.mjdi, toa.mjdf) == (par_toa.mjdi, par_toa.mjdf)
+    assert toa.mjdf != no_fdot.mjdf
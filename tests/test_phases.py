@@ -0,0 +1,141 @@
+import os, glob, math
+from fractions import Fraction
+import numpy as np
+import pytest
+from swiftmonitor import ml_toa, utils as smu
+from conftest import SWIFT_EVT, PAR
+
+def exact_phase(eph, mjdi, sec):
+    dt = (Fraction(mjdi) - Fraction(eph.epoch)) * 86400 + Fraction(sec)
+    phase = sum( Fraction(f) * dt**(k+1) / math.factorial(k+1)
+                 for k, f in enumerate(eph.freqs) if f )
+    for glitch in eph.glitches:
+        dt = (Fraction(mjdi) - Fraction(glitch['GLEP'])) * 86400 + Fraction(sec)
+        if dt > 0:
+            phase += Fraction(glitch['GLPH']) + Fraction(glitch['GLF0']) * dt + \
+                     Fraction(glitch['GLF1']) * dt**2 / 2 + Fraction(glitch['GLF2']) * dt**3 / 6
+            # the recovery is a small, smooth term: double precision is enough
+            tau = glitch['GLTD'] * 86400
+            phase += Fraction(-glitch['GLF0D'] * tau * math.expm1(-float(dt) / tau))
+    return float(phase - math.floor(phase))
+
+def cycle_diff(a, b):
+    return np.abs((np.asarray(a) - np.asarray(b) + 0.5) % 1.0 - 0.5)
+
+def test_two_part_phase_long_baseline():
+    # a fast pulsar 20 years from its epoch
+    eph = smu.Ephemeris(50000.0, 300.123456789012, [-1.2345e-13])
+    rng = np.random.RandomState(1)
+    mjdi = 50000.0 + 7300 + np.arange(20)
+    sec = rng.rand(20) * 86400.0
+    exact = np.array([ exact_phase(eph, d, s) for d, s in zip(mjdi, sec) ])
+
+    two_part = eph.phase(mjdi, sec=sec)
+    single = eph.phase(mjdi + sec / smu.SECPERDAY)
+    assert np.max(cycle_diff(two_part, exact)) < 1e-9
+    # the float MJD alone only resolves the time to ~1e-6 s
+    assert np.max(cycle_diff(single, exact)) > 1e-5
+
+def test_fits2times_split_mjd():
+    t = smu.fits2times(SWIFT_EVT, aware_no_filt=True)
+    mjdi, sec = smu.fits2times(SWIFT_EVT, aware_no_filt=True, split_mjd=True)
+    assert np.all(mjdi == np.floor(mjdi)) and np.all((sec >= 0) & (sec < 86400))
+    np.testing.assert_allclose(mjdi + sec / smu.SECPERDAY, t, rtol=0, atol=1e-10)
+
+def test_toa_two_part(par_fn, prof_mod):
+    # the TOA of get_ml_toa is on the pulse nearest before the middle of the events
+    toa, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, par_fn, writer=smu.TimWriter())
+    mjdi, sec = smu.fits2times(SWIFT_EVT, split_mjd=True)
+    eph = smu.read_ephemeris(par_fn)
+    phase = eph.phase(toa.mjdi, sec=toa.mjdf * smu.SECPERDAY)
+    assert cycle_diff(phase, toa.offset) < 1e-6
+    mid = 0.5 * ((mjdi[0] + sec[0] / 86400.) + (mjdi[-1] + sec[-1] / 86400.))
+    assert abs(toa.mjdi + toa.mjdf - mid) < 1.0 / eph.f0 / smu.SECPERDAY
+
+def test_predictor(par_fn):
+    pred = smu.get_predictor(par_fn, 54700.2, 54799.7)
+    assert (pred.edges[0], pred.edges[-1]) == (54700.0, 54800.0)
+    assert pred.max_err <= 1e-8
+    eph = smu.read_ephemeris(par_fn)
+    rng = np.random.RandomState(2)
+    mjdi = np.sort(rng.randint(54700, 54800, 2000)).astype(float)
+    sec = rng.rand(2000) * 86400.0
+    # unsorted and sorted times
+    for order in (np.arange(2000), np.argsort(mjdi + sec / smu.SECPERDAY)):
+        day, s = mjdi[order], sec[order]
+        assert np.max(cycle_diff(pred.phase(day, sec=s), eph.phase(day, sec=s))) < 1e-8
+    mjd = np.linspace(54700, 54800, 1001)
+    assert np.max(cycle_diff(pred.phase(mjd), eph.phase(mjd))) < 1e-8
+
+    # the predictor does not extrapolate
+    with pytest.raises(ValueError):
+        pred.phase(54800.5)
+    with pytest.raises(ValueError):
+        pred.phase([54699.0], sec=[86000.0])
+
+def test_get_predictor_cache(par_fn, cache_path):
+    pred = smu.get_predictor(par_fn, 54700.2, 54710.7)
+    # the span is extended to whole days
+    assert smu.get_predictor(par_fn, 54700, 54711) is pred
+    assert len(glob.glob(os.path.join(cache_path, 'predictor_*.npz'))) == 1
+
+    # read back from disk once the in-memory cache is dropped
+    del smu.get_predictor._cache
+    loaded = smu.get_predictor(par_fn, 54700, 54711)
+    assert loaded is not pred
+    np.testing.assert_array_equal(loaded.coeffs, pred.coeffs)
+    mjd = np.linspace(54700, 54711, 101)
+    np.testing.assert_array_equal(loaded.phase(mjd), pred.phase(mjd))
+
+    # an edited par file gets a new predictor
+    stat = os.stat(par_fn)
+    os.utime(par_fn, (stat.st_atime, stat.st_mtime + 10))
+    assert smu.get_predictor(par_fn, 54700, 54711) is not loaded
+
+GLITCH_PAR = PAR + '''GLEP_1 54760.5
+GLPH_1 0.1
+GLF0_1 2.0E-6
+GLF1_1 -1.0E-13
+GLF0D_1 5.0E-7
+GLTD_1 20.0
+'''
+
+def test_two_sum_two_prod():
+    rng = np.random.RandomState(3)
+    a = rng.randn(100) * 10.0**rng.randint(-10, 10, 100)
+    b = rng.randn(100) * 10.0**rng.randint(-10, 10, 100)
+    s, e = smu.two_sum(a, b)
+    p, f = smu.two_prod(a, b)
+    for i in range(100):
+        assert Fraction(s[i]) + Fraction(e[i]) == Fraction(a[i]) + Fraction(b[i])
+        assert Fraction(p[i]) + Fraction(f[i]) == Fraction(a[i]) * Fraction(b[i])
+
+def test_glitch_phase(tmp_path):
+    par_fn = str(tmp_path / 'glitch.par')
+    open(par_fn, 'w').write(GLITCH_PAR)
+    eph = smu.read_ephemeris(par_fn)
+    assert eph.glitches == [dict(GLEP=54760.5, GLPH=0.1, GLF0=2.0e-6, GLF1=-1.0e-13, GLF2=0.0,
+                                 GLF0D=5.0e-7, GLTD=20.0)]
+    quiet = smu.Ephemeris(eph.epoch, eph.f0, eph.fdots)
+
+    rng = np.random.RandomState(4)
+    mjdi = np.sort(rng.randint(54740, 54790, 200)).astype(float)
+    sec = rng.rand(200) * 86400.0
+    # either side of the glitch epoch
+    mjdi = np.append(mjdi, [54760.0, 54760.0])
+    sec = np.append(sec, [43199.9, 43200.1])
+    before = mjdi + sec / smu.SECPERDAY < 54760.5
+    phases = eph.phase(mjdi, sec=sec)
+    exact = np.array([ exact_phase(eph, d, s) for d, s in zip(mjdi, sec) ])
+    assert np.max(cycle_diff(phases, exact)) < 1e-9
+    assert np.max(cycle_diff(phases[before], quiet.phase(mjdi[before], sec=sec[before]))) < 1e-12
+    # the phase jumps by GLPH at the glitch
+    assert cycle_diff(phases[-1] - quiet.phase(54760.0, sec=43200.1), 0.1) < 1e-6
+
+    # frequency just after the glitch, and the predictor across it
+    after = quiet.freq(54760.5 + 1e-6) + 2.0e-6 + 5.0e-7
+    assert eph.freq(54760.5 + 1e-6) == pytest.approx(after, rel=1e-12, abs=1e-14)
+    pred = smu.PhasePredictor(eph, 54740.0, 54790.0)
+    assert 54760.5 in pred.edges
+    order = np.argsort(mjdi + sec / smu.SECPERDAY)
+    assert np.max(cycle_diff(pred.phase(mjdi[order], sec=sec[order]), phases[order])) < 1e-8
@@ -0,0 +1,50 @@
+import numpy as np
+from swiftmonitor import ml_toa, periodogram, utils as smu
+from conftest import SWIFT_EVT
+
+def scaled(setup, x):
+    return setup(x)
+
+def failing(setup, fn):
+    if fn == 'bad':
+        raise ValueError('no such file')
+    return fn.upper()
+
+def test_pool_map():
+    # the setup is handed to the workers once, so it can be a lambda
+    setup = lambda x: 3*x
+    assert list(smu.pool_map(scaled, range(10), setup=setup)) == list(range(0, 30, 3))
+    assert list(smu.pool_map(scaled, range(10), setup=setup, nworkers=2)) == list(range(0, 30, 3))
+
+def test_map_files(capsys):
+    for nworkers in (1, 2):
+        results = smu.map_files(failing, ['a', 'bad', 'c'], nworkers=nworkers, action='read')
+        assert [ r[:2] for r in results ] == [('a', 'A'), ('bad', None), ('c', 'C')]
+        assert results[1][2] == 'ValueError: no such file'
+        assert 'Failed to read bad: ValueError: no such file' in capsys.readouterr().err
+
+def test_sim_error_nworkers(prof_mod):
+    phases = smu.randomvariate(prof_mod.prof_mod, n=500, rng=np.random.default_rng(0))
+    kwargs = dict(method='harmonic', N_sim=40, seed=7, batch_size=10)
+    assert ml_toa.sim_error(prof_mod.prof_mod, 500, phases, **kwargs) == \
+           ml_toa.sim_error(prof_mod.prof_mod, 500, phases, nworkers=2, **kwargs)
+
+def test_get_ml_toas(par_fn, prof_mod):
+    results = ml_toa.get_ml_toas([SWIFT_EVT, 'missing.evt'], prof_mod, par_fn, nworkers=2)
+    toa, = ml_toa.get_ml_toa(SWIFT_EVT, prof_mod, par_fn, writer=smu.TimWriter())
+    assert results[0][1][0].mjdf == toa.mjdf and results[0][2] is None
+    assert results[1][1] == [] and results[1][2]
+
+def test_optimize_bands(par_fn):
+    serial = smu.optimize_bands([SWIFT_EVT, 'missing.evt'], par_fn, 0.5, 10, steps=8)
+    pooled = smu.optimize_bands([SWIFT_EVT, 'missing.evt'], par_fn, 0.5, 10, steps=8, nworkers=2)
+    assert serial[0][1] == pooled[0][1]
+    assert serial[1][1] is None and serial[1][2]
+
+def test_periodogram_nworkers(par_fn):
+    serial = periodogram.periodogram(SWIFT_EVT, par_fn, nfreq=21, nfdot=3, nfreq_block=8)
+    pooled = periodogram.periodogram(SWIFT_EVT, par_fn, nfreq=21, nfdot=3, nfreq_block=8,
+                                     nworkers=2)
+    np.testing.assert_array_equal(serial.moments, pooled.moments)
+    results = periodogram.periodograms([SWIFT_EVT, 'missing.evt'], par_fn, nfreq=5)
+    assert results[0][2] is None and results[1][1] is None
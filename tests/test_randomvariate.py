@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from scipy import stats
+from swiftmonitor import utils as smu
+
+WIDTH = 0.03
+
+def pulse(x):
+    return 1.0 + 3.0*np.exp(-0.5*((x - 0.4)/WIDTH)**2)
+
+def pulse_cdf(x, zero_min=True):
+    gauss = 3.0*WIDTH*np.sqrt(2*np.pi)*(stats.norm.cdf((x - 0.4)/WIDTH) - stats.norm.cdf(-0.4/WIDTH))
+    total = 3.0*WIDTH*np.sqrt(2*np.pi)*(stats.norm.cdf(0.6/WIDTH) - stats.norm.cdf(-0.4/WIDTH))
+    if zero_min:
+        return (x + gauss) / (1.0 + total)
+    # only the pulsed part (the minimum of the pdf, ~1, removed)
+    return gauss / total
+
+N = 20000
+
+@pytest.mark.parametrize('zero_min', [True, False])
+def test_randomvariate_ks_cdf(zero_min):
+    x = smu.randomvariate(pulse, n=N, zero_min=zero_min, rng=np.random.default_rng(1))
+    assert np.all((x >= 0) & (x <= 1))
+    assert stats.kstest(x, lambda v: pulse_cdf(v, zero_min)).pvalue > 0.01
+
+@pytest.mark.parametrize('zero_min', [True, False])
+def test_randomvariate_chi2_cdf(zero_min):
+    x = smu.randomvariate(pulse, n=N, zero_min=zero_min, rng=np.random.default_rng(2))
+    edges = np.linspace(0, 1, 65)
+    observed = np.histogram(x, edges)[0]
+    expected = N * np.diff(pulse_cdf(edges, zero_min))
+    keep = expected > 5
+    chi2 = np.sum((observed[keep] - expected[keep])**2 / expected[keep])
+    assert stats.chi2.sf(chi2, keep.sum() - 1) > 0.01
+
+@pytest.mark.parametrize('zero_min', [True, False])
+def test_randomvariate_vs_rejection(zero_min):
+    x = smu.randomvariate(pulse, n=N, zero_min=zero_min, rng=np.random.default_rng(3))
+    y = smu.randomvariate_rejection(pulse, n=N, zero_min=zero_min, rng=np.random.default_rng(4))
+    assert stats.ks_2samp(x, y).pvalue > 0.01
+
+def test_randomvariate_template_vs_rejection(prof_mod):
+    x = smu.randomvariate(prof_mod.prof_mod, n=N, rng=np.random.default_rng(5))
+    y = smu.randomvariate_rejection(prof_mod.prof_mod, n=N, rng=np.random.default_rng(6))
+    assert stats.ks_2samp(x, y).pvalue > 0.01